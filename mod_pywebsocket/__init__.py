@@ -165,6 +165,42 @@ You can send a message by the following statement.
     request.ws_stream.send_message(message)
 
 
+Receiving Messages by Callback
+------------------------------
+
+Instead of web_socket_transfer_data, a handler can define
+
+    web_socket_receive_message(request, message)
+
+which is called for each received message, and with None as message on
+receiving client-initiated closing handshake. When both are defined,
+web_socket_transfer_data is used unless the server supports callbacks. The
+standalone server started with --server-mode=epoll calls
+web_socket_receive_message on a pool of worker threads without holding a
+thread for each connection. Messages of a connection are passed one at a
+time in the order received. request.ws_stream.receive_message() must not
+be called from web_socket_receive_message, and close_connection() called
+there returns without waiting for closing handshake acknowledgement.
+
+
+Coroutine Handlers
+------------------
+
+web_socket_transfer_data can also be a generator function. Such a
+coroutine handler yields operations on request.ws_stream instead of
+calling the blocking methods, and the yield expression evaluates to the
+result of the operation.
+
+    message = yield request.ws_stream.receive_message_async()
+    yield request.ws_stream.send_message_async(message)
+    yield request.ws_stream.close_connection_async(code, reason)
+
+close_connection_async completes when the closing handshake completes.
+The standalone server started with --server-mode=epoll runs coroutine
+handlers on a pool of worker threads without holding a thread while
+they wait. Other servers run the operations synchronously.
+
+
 Closing Connection
 ------------------
 
@@ -186,6 +222,25 @@ use in web_socket_passive_closing_handshake.
 - ws_close_reason
 
 
+Socket Options
+--------------
+
+On the standalone server, a handler can enable or disable TCP_NODELAY for
+the connection, overriding the --tcp-nodelay option of the server, e.g. in
+web_socket_do_extra_handshake so that it also applies to the handshake
+response.
+
+    request.connection.set_tcp_nodelay(True)
+
+request.connection.get_tcp_nodelay() returns whether TCP_NODELAY is enabled.
+The connection of mod_python doesn't have these methods. On a connection
+accepted on a Unix-domain socket of the standalone server, set_tcp_nodelay
+does nothing, get_tcp_nodelay returns False, request.connection.local_addr
+is a tuple of the path of the socket and None, and
+request.connection.remote_addr is a tuple of the path the client is bound
+to, usually empty, and None.
+
+
 Threading
 ---------
 
@@ -89,6 +89,52 @@ class InvalidUTF8Exception(Exception):
     pass
 
 
+class MessageTooBigException(Exception):
+    """This exception will be raised when we receive a message which is too
+    big to process, e.g. a compressed message which inflates beyond the
+    configured limit.
+    """
+
+    pass
+
+
+class StreamOperation(object):
+    """An operation on a stream which a coroutine handler yields to wait for
+    its completion. The yield expression evaluates to the result of the
+    operation, or raises the exception the operation raised.
+    """
+
+    RECEIVE_MESSAGE = 'receive_message'
+    SEND_MESSAGE = 'send_message'
+    CLOSE_CONNECTION = 'close_connection'
+
+    def __init__(self, stream, name, args=(), kwargs=None):
+        """Construct an instance.
+
+        Args:
+            stream: the stream to operate on.
+            name: one of RECEIVE_MESSAGE, SEND_MESSAGE and CLOSE_CONNECTION.
+            args: positional arguments for the method of the stream named
+                name.
+            kwargs: keyword arguments for the method, or None for no
+                arguments.
+        """
+
+        self.stream = stream
+        self.name = name
+        self.args = args
+        if kwargs is None:
+            kwargs = {}
+        self.kwargs = kwargs
+
+    def run(self):
+        """Runs the operation blocking until it completes and returns its
+        result.
+        """
+
+        return getattr(self.stream, self.name)(*self.args, **self.kwargs)
+
+
 class StreamBase(object):
     """Base stream class."""
 
@@ -177,5 +223,29 @@ class StreamBase(object):
             read_bytes.append(ch)
         return ''.join(read_bytes)
 
+    def receive_message_async(self):
+        """Returns a StreamOperation of receive_message for coroutine
+        handlers.
+        """
+
+        return StreamOperation(self, StreamOperation.RECEIVE_MESSAGE)
+
+    def send_message_async(self, *args, **kwargs):
+        """Returns a StreamOperation of send_message with the given arguments
+        for coroutine handlers.
+        """
+
+        return StreamOperation(
+            self, StreamOperation.SEND_MESSAGE, args, kwargs)
+
+    def close_connection_async(self, *args, **kwargs):
+        """Returns a StreamOperation of close_connection with the given code
+        and reason for coroutine handlers. It completes when the closing
+        handshake completes.
+        """
+
+        return StreamOperation(
+            self, StreamOperation.CLOSE_CONNECTION, args, kwargs)
+
 
 # vi:sts=4 sw=4 et
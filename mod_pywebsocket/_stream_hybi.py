@@ -309,7 +309,7 @@ class FragmentedFrameBuilder(object):
         # frames in the message are all the same.
         self._opcode = common.OPCODE_TEXT
 
-    def build(self, payload_data, end, binary):
+    def _get_opcode_and_fin(self, end, binary):
         if binary:
             frame_type = common.OPCODE_BINARY
         else:
@@ -330,6 +330,20 @@ class FragmentedFrameBuilder(object):
             self._started = True
             fin = 0
 
+        return opcode, fin
+
+    def build_header(self, payload_length, end, binary):
+        """Builds only the header of a frame whose payload is payload_length
+        bytes long. Must not be used when frames are masked or frame filters
+        are set since they need the payload itself.
+        """
+
+        opcode, fin = self._get_opcode_and_fin(end, binary)
+        return create_header(opcode, payload_length, fin, 0, 0, 0, False)
+
+    def build(self, payload_data, end, binary):
+        opcode, fin = self._get_opcode_and_fin(end, binary)
+
         if binary or not self._encode_utf8:
             return create_binary_frame(
                 payload_data, opcode, fin, self._mask, self._frame_filters)
@@ -401,6 +415,16 @@ class StreamOptions(object):
         self.mask_send = False
         self.unmask_receive = True
 
+        # If positive, messages longer than this (in characters for text
+        # messages given as unicode) are split before applying the outgoing
+        # message filters and sent as fragmented frames.
+        self.outgoing_fragment_size = 0
+        # util.WorkerPool instance on which the outgoing message filters
+        # process the next fragment while the current one is being written.
+        # None to process fragments one after the other on the calling
+        # thread.
+        self.outgoing_worker_pool = None
+
 
 class Stream(StreamBase):
     """A class for parsing/building frames of the WebSocket protocol
@@ -505,8 +529,16 @@ class Stream(StreamBase):
             raise BadOperationException(
                 'Message for binary frame must be instance of str')
 
-        for message_filter in self._options.outgoing_message_filters:
-            message = message_filter.filter(message, end, binary)
+        fragment_size = self._options.outgoing_fragment_size
+        if fragment_size > 0 and len(message) > fragment_size:
+            try:
+                self._send_message_in_fragments(
+                    message, end, binary, fragment_size)
+            except ValueError, e:
+                raise BadOperationException(e)
+            return
+
+        message = self._filter_outgoing_message(message, end, binary)
 
         try:
             # Set this to any positive integer to limit maximum size of data in
@@ -541,6 +573,123 @@ class Stream(StreamBase):
         except ValueError, e:
             raise BadOperationException(e)
 
+    def send_binary_buffers(self, buffers, end=True):
+        """Send a binary message whose payload is the concatenation of
+        buffers.
+
+        The frame header is built from the total length of the buffers, and
+        the header and the buffers are joined only once right before being
+        written, instead of building the payload first and copying it again
+        into the frame. Extensions which process outgoing data and masking
+        are applied to the joined payload, and a message which is to be
+        fragmented is sent via send_message.
+
+        Args:
+            buffers: list of str which form the payload.
+
+        Raises:
+            BadOperationException: when called on a server-terminated
+                connection or called while sending a text message.
+        """
+
+        self._send_binary_buffers_list([buffers], end)
+
+    def send_binary_messages(self, messages):
+        """Send binary messages, each of which is given as a list of buffers
+        as for send_binary_buffers(). The frames are written to the connection
+        at once.
+
+        Args:
+            messages: list of lists of str.
+
+        Raises:
+            BadOperationException: when called on a server-terminated
+                connection or called while sending a text message.
+        """
+
+        self._send_binary_buffers_list(messages, True)
+
+    def _send_binary_buffers_list(self, messages, end):
+        if self._request.server_terminated:
+            raise BadOperationException(
+                'Requested send_message after sending out a closing handshake')
+
+        fragment_size = self._options.outgoing_fragment_size
+        frame_buffers = []
+        try:
+            for buffers in messages:
+                payload_length = 0
+                for buffer in buffers:
+                    payload_length += len(buffer)
+
+                if fragment_size > 0 and payload_length > fragment_size:
+                    if frame_buffers:
+                        self._write(''.join(frame_buffers))
+                        frame_buffers = []
+                    self.send_message(''.join(buffers), end=end, binary=True)
+                elif (self._options.outgoing_message_filters or
+                      self._options.outgoing_frame_filters or
+                      self._options.mask_send):
+                    message = self._filter_outgoing_message(
+                        ''.join(buffers), end, True)
+                    frame_buffers.append(
+                        self._writer.build(message, end, True))
+                else:
+                    frame_buffers.append(
+                        self._writer.build_header(payload_length, end, True))
+                    frame_buffers.extend(buffers)
+        except ValueError, e:
+            raise BadOperationException(e)
+
+        if frame_buffers:
+            self._write(''.join(frame_buffers))
+
+    def _filter_outgoing_message(self, message, end, binary):
+        for message_filter in self._options.outgoing_message_filters:
+            message = message_filter.filter(message, end, binary)
+        return message
+
+    def _send_message_in_fragments(self, message, end, binary, fragment_size):
+        """Splits message into chunks of fragment_size and sends each of them
+        as a frame. If self._options.outgoing_worker_pool is set, the outgoing
+        message filters (e.g. permessage-deflate compression) process the next
+        chunk on the pool while the current frame is being written so that
+        compression and network I/O overlap. Only one filtered chunk is held
+        at a time.
+        """
+
+        worker_pool = self._options.outgoing_worker_pool
+
+        def filter_chunk(position):
+            next_position = position + fragment_size
+            end_for_this_chunk = end and len(message) <= next_position
+            return (self._filter_outgoing_message(
+                        message[position:next_position],
+                        end_for_this_chunk,
+                        binary),
+                    end_for_this_chunk)
+
+        position = 0
+        filtered, end_for_this_chunk = filter_chunk(position)
+        while True:
+            # Build the frame before the next chunk is filtered since frame
+            # filters use state set by message filters (e.g. the compression
+            # bit of permessage-deflate).
+            frame = self._writer.build(filtered, end_for_this_chunk, binary)
+
+            position += fragment_size
+            if len(message) <= position:
+                self._write(frame)
+                return
+
+            if worker_pool is None:
+                self._write(frame)
+                filtered, end_for_this_chunk = filter_chunk(position)
+            else:
+                job = worker_pool.submit(filter_chunk, position)
+                self._write(frame)
+                filtered, end_for_this_chunk = job.result()
+
     def _get_message_from_frame(self, frame):
         """Gets a message from frame. If the message is composed of fragmented
         frames and the frame is not the last fragmented frame, this method
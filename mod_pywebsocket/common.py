@@ -144,6 +144,7 @@ STATUS_MANDATORY_EXT = STATUS_MANDATORY_EXTENSION
 HTTP_STATUS_BAD_REQUEST = 400
 HTTP_STATUS_FORBIDDEN = 403
 HTTP_STATUS_NOT_FOUND = 404
+HTTP_STATUS_SERVICE_UNAVAILABLE = 503
 
 
 def is_control_opcode(opcode):
@@ -32,11 +32,14 @@
 """
 
 
+import inspect
 import logging
 import os
 import re
+import sys
 
 from mod_pywebsocket import common
+from mod_pywebsocket import extensions
 from mod_pywebsocket import handshake
 from mod_pywebsocket import msgutil
 from mod_pywebsocket import mux
@@ -50,6 +53,7 @@ _DO_EXTRA_HANDSHAKE_HANDLER_NAME = 'web_socket_do_extra_handshake'
 _TRANSFER_DATA_HANDLER_NAME = 'web_socket_transfer_data'
 _PASSIVE_CLOSING_HANDSHAKE_HANDLER_NAME = (
     'web_socket_passive_closing_handshake')
+_RECEIVE_MESSAGE_HANDLER_NAME = 'web_socket_receive_message'
 
 
 class DispatchException(Exception):
@@ -66,6 +70,59 @@ def _default_passive_closing_handshake_handler(request):
     return common.STATUS_NORMAL_CLOSURE, ''
 
 
+def _create_transfer_data_handler(receive_message):
+    """Returns a web_socket_transfer_data handler which calls the given
+    web_socket_receive_message handler for each received message until a
+    closing handshake is received or sent.
+    """
+
+    def transfer_data(request):
+        while True:
+            message = request.ws_stream.receive_message()
+            receive_message(request, message)
+            if message is None or request.server_terminated:
+                return
+
+    return transfer_data
+
+
+def _run_coroutine(coroutine):
+    """Runs a coroutine handler, running each StreamOperation it yields
+    synchronously.
+    """
+
+    result = None
+    exc_info = None
+    while True:
+        try:
+            if exc_info is None:
+                operation = coroutine.send(result)
+            else:
+                operation = coroutine.throw(*exc_info)
+        except StopIteration:
+            return
+        result = None
+        exc_info = None
+        try:
+            if not isinstance(operation, stream.StreamOperation):
+                raise TypeError('Coroutine handler yielded %r, not a '
+                                'StreamOperation' % (operation,))
+            result = operation.run()
+        except Exception:
+            exc_info = sys.exc_info()
+
+
+def _create_coroutine_runner(transfer_data_coroutine):
+    """Returns a web_socket_transfer_data handler which runs the given
+    coroutine handler synchronously.
+    """
+
+    def transfer_data(request):
+        _run_coroutine(transfer_data_coroutine(request))
+
+    return transfer_data
+
+
 def _normalize_path(path):
     """Normalize path.
 
@@ -127,10 +184,16 @@ class _HandlerSuite(object):
     """A handler suite holder class."""
 
     def __init__(self, do_extra_handshake, transfer_data,
-                 passive_closing_handshake):
+                 passive_closing_handshake, receive_message=None,
+                 transfer_data_coroutine=None):
         self.do_extra_handshake = do_extra_handshake
         self.transfer_data = transfer_data
         self.passive_closing_handshake = passive_closing_handshake
+        # None unless the handler defines web_socket_receive_message.
+        self.receive_message = receive_message
+        # None unless web_socket_transfer_data is a generator function. Then
+        # transfer_data runs it synchronously.
+        self.transfer_data_coroutine = transfer_data_coroutine
 
 
 def _source_handler_file(handler_definition):
@@ -154,10 +217,30 @@ def _source_handler_file(handler_definition):
     except Exception:
         passive_closing_handshake_handler = (
             _default_passive_closing_handshake_handler)
+    do_extra_handshake_handler = _extract_handler(
+        global_dic, _DO_EXTRA_HANDSHAKE_HANDLER_NAME)
+    receive_message_handler = None
+    if _RECEIVE_MESSAGE_HANDLER_NAME in global_dic:
+        receive_message_handler = _extract_handler(
+            global_dic, _RECEIVE_MESSAGE_HANDLER_NAME)
+    if (receive_message_handler is not None and
+        _TRANSFER_DATA_HANDLER_NAME not in global_dic):
+        transfer_data_handler = _create_transfer_data_handler(
+            receive_message_handler)
+    else:
+        transfer_data_handler = _extract_handler(
+            global_dic, _TRANSFER_DATA_HANDLER_NAME)
+    transfer_data_coroutine = None
+    if inspect.isgeneratorfunction(transfer_data_handler):
+        transfer_data_coroutine = transfer_data_handler
+        transfer_data_handler = _create_coroutine_runner(
+            transfer_data_coroutine)
     return _HandlerSuite(
-        _extract_handler(global_dic, _DO_EXTRA_HANDSHAKE_HANDLER_NAME),
-        _extract_handler(global_dic, _TRANSFER_DATA_HANDLER_NAME),
-        passive_closing_handshake_handler)
+        do_extra_handshake_handler,
+        transfer_data_handler,
+        passive_closing_handshake_handler,
+        receive_message_handler,
+        transfer_data_coroutine)
 
 
 def _extract_handler(dic, name):
@@ -315,6 +398,9 @@ class Dispatcher(object):
             self._logger.debug('%s', e)
             request.ws_stream.close_connection(
                 common.STATUS_INVALID_FRAME_PAYLOAD_DATA)
+        except stream.MessageTooBigException, e:
+            self._logger.debug('%s', e)
+            request.ws_stream.close_connection(common.STATUS_MESSAGE_TOO_BIG)
         except msgutil.ConnectionTerminatedException, e:
             self._logger.debug('%s', e)
         except Exception, e:
@@ -325,6 +411,10 @@ class Dispatcher(object):
                     _TRANSFER_DATA_HANDLER_NAME, request.ws_resource),
                 e)
             raise
+        finally:
+            # Nothing is compressed or decompressed once the handler has
+            # returned.
+            extensions.close_compression_stats(request)
 
     def passive_closing_handshake(self, request):
         """Prepare code and reason for responding client initiated closing
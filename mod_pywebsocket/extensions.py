@@ -28,8 +28,13 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+import threading
+import weakref
+import zlib
+
 from mod_pywebsocket import common
 from mod_pywebsocket import util
+from mod_pywebsocket._stream_base import MessageTooBigException
 from mod_pywebsocket.http_header_util import quote_if_necessary
 
 
@@ -37,6 +42,326 @@ from mod_pywebsocket.http_header_util import quote_if_necessary
 _available_processors = {}
 _compression_extension_names = []
 
+# Messages (frames for deflate-frame) of this size or larger are handed to
+# DeflateOptions.worker_pool if it's set.
+_DEFAULT_DEFLATE_OFFLOAD_THRESHOLD = 64 * 1024
+
+# Incoming compressed messages (frames for deflate-frame) which inflate to more
+# than this are rejected with MessageTooBigException.
+_DEFAULT_DEFLATE_MAX_INFLATED_SIZE = 64 * 1024 * 1024
+
+
+class DeflateOptions(object):
+    """Holds option values applied to deflate based extension processors
+    (deflate-frame and permessage-deflate). Processors created after
+    set_deflate_options() is called use the new values.
+    """
+
+    def __init__(self):
+        """Constructs DeflateOptions."""
+
+        # util.WorkerPool instance on which compression and decompression of
+        # large messages run. None to run them on the handler thread.
+        self.worker_pool = None
+        self.offload_threshold = _DEFAULT_DEFLATE_OFFLOAD_THRESHOLD
+
+        # If positive, permessage-deflate splits outgoing messages longer
+        # than this into fragments which are compressed and sent one by one.
+        # Combined with worker_pool, the next fragment is compressed while
+        # the current one is being sent.
+        self.fragment_size = 0
+
+        # Compression level (0-9 or zlib.Z_DEFAULT_COMPRESSION) and memLevel
+        # (1-9) of zlib used by permessage-deflate. They trade CPU time and
+        # memory against compression ratio.
+        self.level = zlib.Z_DEFAULT_COMPRESSION
+        self.mem_level = zlib.DEF_MEM_LEVEL
+
+        # Maximum size of an incoming message (frame for deflate-frame) after
+        # decompression. Negative for no limit.
+        self.max_inflated_size = _DEFAULT_DEFLATE_MAX_INFLATED_SIZE
+
+
+_deflate_options = DeflateOptions()
+
+
+def set_deflate_options(options):
+    """Replaces the DeflateOptions instance used by deflate based extension
+    processors.
+    """
+
+    global _deflate_options
+    _deflate_options = options
+
+
+def get_deflate_options():
+    return _deflate_options
+
+
+class CompressionStats(object):
+    """Counters of a compression extension. Messages mean frames for
+    deflate-frame.
+
+    Attributes:
+        outgoing_compressed_messages: number of messages compressed.
+        outgoing_uncompressed_messages: number of messages sent without
+            compression.
+        outgoing_original_bytes: size of compressed messages before
+            compression.
+        outgoing_compressed_bytes: size of compressed messages after
+            compression.
+        deflate_time: seconds spent in compression.
+        incoming_compressed_messages: number of compressed messages received.
+        incoming_uncompressed_messages: number of uncompressed messages
+            received.
+        incoming_compressed_bytes: size of compressed messages received.
+        incoming_original_bytes: size of received compressed messages after
+            decompression.
+        inflate_time: seconds spent in decompression.
+    """
+
+    _FIELDS = ['outgoing_compressed_messages',
+               'outgoing_uncompressed_messages',
+               'outgoing_original_bytes',
+               'outgoing_compressed_bytes',
+               'deflate_time',
+               'incoming_compressed_messages',
+               'incoming_uncompressed_messages',
+               'incoming_compressed_bytes',
+               'incoming_original_bytes',
+               'inflate_time']
+
+    def __init__(self, aggregator=None):
+        """Construct an instance.
+
+        Args:
+            aggregator: _CompressionStatsAggregator which sums the values
+                recorded on this instance with those of other connections.
+                None for no aggregator.
+        """
+
+        self._aggregator = aggregator
+        self._lock = threading.Lock()
+
+        self.outgoing_compressed_messages = 0
+        self.outgoing_uncompressed_messages = 0
+        self.outgoing_original_bytes = 0
+        self.outgoing_compressed_bytes = 0
+        self.deflate_time = 0.0
+
+        self.incoming_compressed_messages = 0
+        self.incoming_uncompressed_messages = 0
+        self.incoming_compressed_bytes = 0
+        self.incoming_original_bytes = 0
+        self.inflate_time = 0.0
+
+        if aggregator is not None:
+            aggregator.add(self)
+
+    def record_deflate(self, original_bytes, compressed_bytes, elapsed_time,
+                       message_end=True):
+        """Records compression of (a part of) an outgoing message. The
+        message is counted when message_end is True.
+        """
+
+        self._lock.acquire()
+        try:
+            if message_end:
+                self.outgoing_compressed_messages += 1
+            self.outgoing_original_bytes += original_bytes
+            self.outgoing_compressed_bytes += compressed_bytes
+            self.deflate_time += elapsed_time
+        finally:
+            self._lock.release()
+
+    def record_outgoing_uncompressed(self, message_end=True):
+        self._lock.acquire()
+        try:
+            if message_end:
+                self.outgoing_uncompressed_messages += 1
+        finally:
+            self._lock.release()
+
+    def record_inflate(self, compressed_bytes, original_bytes, elapsed_time):
+        """Records decompression of an incoming message."""
+
+        self._lock.acquire()
+        try:
+            self.incoming_compressed_messages += 1
+            self.incoming_compressed_bytes += compressed_bytes
+            self.incoming_original_bytes += original_bytes
+            self.inflate_time += elapsed_time
+        finally:
+            self._lock.release()
+
+    def record_incoming_uncompressed(self):
+        self._lock.acquire()
+        try:
+            self.incoming_uncompressed_messages += 1
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Merges the values into the total of the aggregator. Called when
+        the connection has been closed.
+        """
+
+        if self._aggregator is not None:
+            self._aggregator.remove(self)
+
+    def add(self, stats):
+        """Adds the values of another CompressionStats instance to this
+        instance.
+        """
+
+        self._add_values(stats._get_values())
+
+    def copy(self):
+        """Returns a consistent snapshot of the values as a new
+        CompressionStats instance without aggregator.
+        """
+
+        stats = CompressionStats()
+        stats._add_values(self._get_values())
+        return stats
+
+    def _get_values(self):
+        self._lock.acquire()
+        try:
+            return [getattr(self, name) for name in self._FIELDS]
+        finally:
+            self._lock.release()
+
+    def _add_values(self, values):
+        self._lock.acquire()
+        try:
+            for name, value in zip(self._FIELDS, values):
+                setattr(self, name, getattr(self, name) + value)
+        finally:
+            self._lock.release()
+
+
+class _CompressionStatsAggregator(object):
+    """Sums CompressionStats of connections.
+
+    Recording a value takes only the lock of the CompressionStats of the
+    connection. The values of open connections are read when a snapshot is
+    taken, and those of a connection are merged into a total by remove()
+    when it's closed.
+
+    The open connections and the total are kept in an immutable state which
+    is replaced as a whole. _lock only guards the replacement, so nothing is
+    allocated while it's held and a garbage collection can't run with it
+    acquired.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # A frozenset of weak references to CompressionStats of open
+        # connections and a tuple of the sums of the values of closed
+        # connections. Weak references let the CompressionStats of a
+        # connection which never gets to remove(), e.g. one whose opening
+        # handshake has failed, be collected.
+        self._state = (frozenset(), (0,) * len(CompressionStats._FIELDS))
+
+    def _replace_state(self, old_state, new_state):
+        """Replaces the state with new_state if it's still old_state.
+        Returns True on success.
+        """
+
+        self._lock.acquire()
+        try:
+            if self._state is not old_state:
+                return False
+            self._state = new_state
+            return True
+        finally:
+            self._lock.release()
+
+    def add(self, stats):
+        ref = weakref.ref(stats)
+        while True:
+            state = self._state
+            open_refs, total = state
+            # Drop references to collected instances on the way.
+            new_open_refs = set(
+                [open_ref for open_ref in open_refs if open_ref() is not None])
+            new_open_refs.add(ref)
+            if self._replace_state(state, (frozenset(new_open_refs), total)):
+                return
+
+    def remove(self, stats):
+        values = stats._get_values()
+        ref = weakref.ref(stats)
+        while True:
+            state = self._state
+            open_refs, total = state
+            if ref not in open_refs:
+                # Already removed.
+                return
+            new_total = tuple(
+                [sum_value + value for sum_value, value in zip(total, values)])
+            if self._replace_state(state,
+                                   (open_refs - frozenset([ref]), new_total)):
+                return
+
+    def copy(self):
+        """Returns a snapshot of the sum as a new CompressionStats
+        instance.
+        """
+
+        # Connections closed from now on are merged into a newer state, so
+        # each of them is counted once.
+        open_refs, total = self._state
+        result = CompressionStats()
+        result._add_values(total)
+        for ref in open_refs:
+            stats = ref()
+            if stats is not None:
+                result.add(stats)
+        return result
+
+
+# Sum of CompressionStats of all connections served by this process.
+_server_compression_stats = _CompressionStatsAggregator()
+
+
+def get_server_compression_stats():
+    """Returns a snapshot of CompressionStats aggregated over all connections
+    served by this process.
+    """
+
+    return _server_compression_stats.copy()
+
+
+def get_compression_stats(request):
+    """Returns CompressionStats of the compression extension in use on the
+    given WebSocket request, or None if no compression extension is in use.
+    """
+
+    for processor in getattr(request, 'ws_extension_processors', None) or []:
+        if not processor.is_active():
+            continue
+        get_stats = getattr(processor, 'get_compression_stats', None)
+        if get_stats is not None:
+            return get_stats()
+    return None
+
+
+def close_compression_stats(request):
+    """Merges CompressionStats of the extensions of the given WebSocket
+    request into the server-wide total. Called when the connection has been
+    closed.
+    """
+
+    for processor in getattr(request, 'ws_extension_processors', None) or []:
+        get_stats = getattr(processor, 'get_compression_stats', None)
+        if get_stats is None:
+            continue
+        stats = get_stats()
+        if stats is not None:
+            stats.close()
+
 
 class ExtensionProcessorInterface(object):
 
@@ -173,9 +498,15 @@ class DeflateFrameExtensionProcessor(ExtensionProcessorInterface):
         #     (Total incoming bytes obtained after applying this filter)
         self._incoming_average_ratio_calculator = _AverageRatioCalculator()
 
+        self._compression_stats = CompressionStats(
+            aggregator=_server_compression_stats)
+
     def name(self):
         return common.DEFLATE_FRAME_EXTENSION
 
+    def get_compression_stats(self):
+        return self._compression_stats
+
     def _get_extension_response_internal(self):
         # Any unknown parameter will be just ignored.
 
@@ -195,10 +526,16 @@ class DeflateFrameExtensionProcessor(ExtensionProcessorInterface):
                 self._NO_CONTEXT_TAKEOVER_PARAM) is not None):
             return None
 
+        deflate_options = get_deflate_options()
+        self._max_inflated_size = deflate_options.max_inflated_size
         self._rfc1979_deflater = util._RFC1979Deflater(
-            window_bits, no_context_takeover)
+            window_bits, no_context_takeover,
+            worker_pool=deflate_options.worker_pool,
+            offload_threshold=deflate_options.offload_threshold)
 
-        self._rfc1979_inflater = util._RFC1979Inflater()
+        self._rfc1979_inflater = util._RFC1979Inflater(
+            worker_pool=deflate_options.worker_pool,
+            offload_threshold=deflate_options.offload_threshold)
 
         self._compress_outgoing = True
 
@@ -274,15 +611,20 @@ class DeflateFrameExtensionProcessor(ExtensionProcessorInterface):
             common.is_control_opcode(frame.opcode)):
             self._outgoing_average_ratio_calculator.add_result_bytes(
                     original_payload_size)
+            if not common.is_control_opcode(frame.opcode):
+                self._compression_stats.record_outgoing_uncompressed()
             return
 
         frame.payload = self._rfc1979_deflater.filter(
             frame.payload, bfinal=self._bfinal)
+        elapsed_time = self._rfc1979_deflater.get_filter_time()
         frame.rsv1 = 1
 
         filtered_payload_size = len(frame.payload)
         self._outgoing_average_ratio_calculator.add_result_bytes(
                 filtered_payload_size)
+        self._compression_stats.record_deflate(
+            original_payload_size, filtered_payload_size, elapsed_time)
 
         _log_outgoing_compression_ratio(
                 self._logger,
@@ -302,14 +644,25 @@ class DeflateFrameExtensionProcessor(ExtensionProcessorInterface):
         if frame.rsv1 != 1 or common.is_control_opcode(frame.opcode):
             self._incoming_average_ratio_calculator.add_original_bytes(
                     received_payload_size)
+            if not common.is_control_opcode(frame.opcode):
+                self._compression_stats.record_incoming_uncompressed()
             return
 
-        frame.payload = self._rfc1979_inflater.filter(frame.payload)
+        frame.payload = self._rfc1979_inflater.filter(
+            frame.payload, self._max_inflated_size)
+        elapsed_time = self._rfc1979_inflater.get_filter_time()
+        if (self._max_inflated_size >= 0 and
+            len(frame.payload) > self._max_inflated_size):
+            raise MessageTooBigException(
+                'Frame payload inflates to more than %d bytes' %
+                self._max_inflated_size)
         frame.rsv1 = 0
 
         filtered_payload_size = len(frame.payload)
         self._incoming_average_ratio_calculator.add_original_bytes(
                 filtered_payload_size)
+        self._compression_stats.record_inflate(
+            received_payload_size, filtered_payload_size, elapsed_time)
 
         _log_incoming_compression_ratio(
                 self._logger,
@@ -348,11 +701,22 @@ class PerMessageDeflateExtensionProcessor(ExtensionProcessorInterface):
         self._preferred_client_max_window_bits = None
         self._client_no_context_takeover = False
 
+        self._framer = None
+
     def name(self):
         # This method returns "deflate" (not "permessage-deflate") for
         # compatibility.
         return 'deflate'
 
+    def get_compression_stats(self):
+        """Returns CompressionStats of this extension, or None if the
+        extension hasn't been accepted.
+        """
+
+        if self._framer is None:
+            return None
+        return self._framer.get_compression_stats()
+
     def _get_extension_response_internal(self):
         for name in self._request.get_parameter_names():
             if name not in [self._SERVER_MAX_WINDOW_BITS_PARAM,
@@ -397,16 +761,24 @@ class PerMessageDeflateExtensionProcessor(ExtensionProcessorInterface):
                                client_client_max_window_bits)
             return None
 
+        deflate_options = get_deflate_options()
         self._rfc1979_deflater = util._RFC1979Deflater(
-            server_max_window_bits, server_no_context_takeover)
+            server_max_window_bits, server_no_context_takeover,
+            worker_pool=deflate_options.worker_pool,
+            offload_threshold=deflate_options.offload_threshold,
+            level=deflate_options.level,
+            mem_level=deflate_options.mem_level)
 
         # Note that we prepare for incoming messages compressed with window
         # bits upto 15 regardless of the client_max_window_bits value to be
         # sent to the client.
-        self._rfc1979_inflater = util._RFC1979Inflater()
+        self._rfc1979_inflater = util._RFC1979Inflater(
+            worker_pool=deflate_options.worker_pool,
+            offload_threshold=deflate_options.offload_threshold)
 
         self._framer = _PerMessageDeflateFramer(
-            server_max_window_bits, server_no_context_takeover)
+            server_max_window_bits, server_no_context_takeover,
+            deflate_options)
         self._framer.set_bfinal(False)
         self._framer.set_compress_outgoing_enabled(True)
 
@@ -492,13 +864,24 @@ class PerMessageDeflateExtensionProcessor(ExtensionProcessorInterface):
 class _PerMessageDeflateFramer(object):
     """A framer for extensions with per-message DEFLATE feature."""
 
-    def __init__(self, deflate_max_window_bits, deflate_no_context_takeover):
+    def __init__(self, deflate_max_window_bits, deflate_no_context_takeover,
+                 deflate_options=None):
         self._logger = util.get_class_logger(self)
 
+        if deflate_options is None:
+            deflate_options = DeflateOptions()
+        self._deflate_options = deflate_options
+
         self._rfc1979_deflater = util._RFC1979Deflater(
-            deflate_max_window_bits, deflate_no_context_takeover)
+            deflate_max_window_bits, deflate_no_context_takeover,
+            worker_pool=deflate_options.worker_pool,
+            offload_threshold=deflate_options.offload_threshold,
+            level=deflate_options.level,
+            mem_level=deflate_options.mem_level)
 
-        self._rfc1979_inflater = util._RFC1979Inflater()
+        self._rfc1979_inflater = util._RFC1979Inflater(
+            worker_pool=deflate_options.worker_pool,
+            offload_threshold=deflate_options.offload_threshold)
 
         self._bfinal = False
 
@@ -517,6 +900,12 @@ class _PerMessageDeflateFramer(object):
         #     (Total incoming bytes obtained after applying this filter)
         self._incoming_average_ratio_calculator = _AverageRatioCalculator()
 
+        self._compression_stats = CompressionStats(
+            aggregator=_server_compression_stats)
+
+    def get_compression_stats(self):
+        return self._compression_stats
+
     def set_bfinal(self, value):
         self._bfinal = value
 
@@ -525,17 +914,25 @@ class _PerMessageDeflateFramer(object):
 
     def _process_incoming_message(self, message, decompress):
         if not decompress:
+            self._compression_stats.record_incoming_uncompressed()
             return message
 
         received_payload_size = len(message)
         self._incoming_average_ratio_calculator.add_result_bytes(
                 received_payload_size)
 
-        message = self._rfc1979_inflater.filter(message)
+        max_inflated_size = self._deflate_options.max_inflated_size
+        message = self._rfc1979_inflater.filter(message, max_inflated_size)
+        elapsed_time = self._rfc1979_inflater.get_filter_time()
+        if max_inflated_size >= 0 and len(message) > max_inflated_size:
+            raise MessageTooBigException(
+                'Message inflates to more than %d bytes' % max_inflated_size)
 
         filtered_payload_size = len(message)
         self._incoming_average_ratio_calculator.add_original_bytes(
                 filtered_payload_size)
+        self._compression_stats.record_inflate(
+            received_payload_size, filtered_payload_size, elapsed_time)
 
         _log_incoming_compression_ratio(
                 self._logger,
@@ -550,6 +947,7 @@ class _PerMessageDeflateFramer(object):
             message = message.encode('utf-8')
 
         if not self._compress_outgoing_enabled:
+            self._compression_stats.record_outgoing_uncompressed(end)
             return message
 
         original_payload_size = len(message)
@@ -558,10 +956,13 @@ class _PerMessageDeflateFramer(object):
 
         message = self._rfc1979_deflater.filter(
             message, end=end, bfinal=self._bfinal)
+        elapsed_time = self._rfc1979_deflater.get_filter_time()
 
         filtered_payload_size = len(message)
         self._outgoing_average_ratio_calculator.add_result_bytes(
             filtered_payload_size)
+        self._compression_stats.record_deflate(
+            original_payload_size, filtered_payload_size, elapsed_time, end)
 
         _log_outgoing_compression_ratio(
                 self._logger,
@@ -651,6 +1052,11 @@ class _PerMessageDeflateFramer(object):
 
         stream_options.encode_text_message_to_utf8 = False
 
+        stream_options.outgoing_fragment_size = (
+            self._deflate_options.fragment_size)
+        stream_options.outgoing_worker_pool = (
+            self._deflate_options.worker_pool)
+
 
 _available_processors[common.PERMESSAGE_DEFLATE_EXTENSION] = (
         PerMessageDeflateExtensionProcessor)
@@ -105,7 +105,8 @@ def _build_location(request):
     location_parts.append('://')
     host, port = parse_host_header(request)
     connection_port = request.connection.local_addr[1]
-    if port != connection_port:
+    # Connections on Unix-domain sockets have no port to check against.
+    if connection_port is not None and port != connection_port:
         raise HandshakeException('Header/connection port mismatch: %d/%d' %
                                  (port, connection_port))
     location_parts.append(host)
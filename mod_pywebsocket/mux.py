@@ -43,6 +43,7 @@ import logging
 import math
 import struct
 import threading
+import time
 import traceback
 
 from mod_pywebsocket import common
@@ -56,7 +57,6 @@ from mod_pywebsocket._stream_hybi import Stream
 from mod_pywebsocket._stream_hybi import StreamOptions
 from mod_pywebsocket._stream_hybi import create_binary_frame
 from mod_pywebsocket._stream_hybi import create_closing_handshake_body
-from mod_pywebsocket._stream_hybi import create_header
 from mod_pywebsocket._stream_hybi import create_length_header
 from mod_pywebsocket._stream_hybi import parse_frame
 from mod_pywebsocket.handshake import hybi
@@ -76,12 +76,26 @@ _MAX_CHANNEL_ID = 2 ** 29 - 1
 _INITIAL_NUMBER_OF_CHANNEL_SLOTS = 64
 _INITIAL_QUOTA_FOR_CLIENT = 8 * 1024
 
+# The writer thread writes pending physical messages to the physical
+# connection at once until their payloads reach this size.
+_MAX_WRITE_BATCH_SIZE = 64 * 1024
+
+_DEFAULT_FRAGMENT_QUANTUM = 16 * 1024
+_DEFAULT_WRITE_WINDOW = 64 * 1024
+_DEFAULT_MAX_RECEIVE_WINDOW = 1024 * 1024
+
+# Used to read integer fields of multiplexed frame payloads in place.
+_UINT16 = struct.Struct('!H')
+_UINT32 = struct.Struct('!L')
+_UINT64 = struct.Struct('!Q')
+
 _HANDSHAKE_ENCODING_IDENTITY = 0
 _HANDSHAKE_ENCODING_DELTA = 1
 
 # We need only these status code for now.
 _HTTP_BAD_RESPONSE_MESSAGES = {
     common.HTTP_STATUS_BAD_REQUEST: 'Bad Request',
+    common.HTTP_STATUS_SERVICE_UNAVAILABLE: 'Service Unavailable',
 }
 
 # DropChannel reason code
@@ -103,6 +117,105 @@ _DROP_CODE_ACKNOWLEDGED = 3008
 _DROP_CODE_BAD_FRAGMENTATION = 3009
 
 
+class MuxOptions(object):
+    """Holds option values applied to multiplexed connections. Physical
+    connections which start multiplexing after set_mux_options() is called use
+    the new values.
+    """
+
+    def __init__(self):
+        """Constructs MuxOptions."""
+
+        # Outgoing inner frames are fragmented at this many bytes multiplied
+        # by the send weight of the logical channel, and the writer thread
+        # grants each logical channel as many bytes per deficit round-robin
+        # round, so that a large message on one logical channel doesn't
+        # block the other logical channels. Must be positive.
+        self.fragment_quantum = _DEFAULT_FRAGMENT_QUANTUM
+
+        # Number of bytes a logical connection can have queued for the
+        # writer thread. Writes block while the window is full. A write is
+        # always accepted when nothing is queued, so 0 makes logical
+        # connections wait for each write to complete before queueing the
+        # next one.
+        self.write_window = _DEFAULT_WRITE_WINDOW
+
+        # Receive window of logical channels, i.e. the send quota the client
+        # holds plus the data received but not yet read by the handler. The
+        # window starts at min_receive_window, which is given to the client
+        # as the initial quota of the default channel and of channel slots,
+        # and grows up to max_receive_window while the client keeps running
+        # out of quota. See _ReceiveWindow.
+        self.min_receive_window = _INITIAL_QUOTA_FOR_CLIENT
+        self.max_receive_window = _DEFAULT_MAX_RECEIVE_WINDOW
+
+        # util.WorkerPool instance on which handlers of logical channels run.
+        # A logical channel holds a thread until it's closed, so the number
+        # of threads also limits the logical channels open on the whole
+        # server. Only default channels wait for a thread when all of them
+        # are busy. None to run each handler on its own thread.
+        self.worker_pool = None
+
+        # Maximum number of logical channels open on a physical connection
+        # and on the whole server. AddChannelRequests beyond them are
+        # rejected with 503. Non-positive for no limit.
+        self.max_channels_per_connection = 0
+        self.max_channels = 0
+
+
+class _ChannelCounter(object):
+    """Counts logical channels open on all physical connections."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def acquire(self, limit):
+        """Counts a new logical channel. Returns False without counting it
+        when limit (if positive) channels are already open.
+        """
+
+        self._lock.acquire()
+        try:
+            if limit > 0 and self._count >= limit:
+                return False
+            self._count += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def release(self):
+        self._lock.acquire()
+        self._count -= 1
+        self._lock.release()
+
+    def count(self):
+        return self._count
+
+
+_channel_counter = _ChannelCounter()
+
+
+def get_logical_channel_count():
+    """Returns the number of logical channels open on the server."""
+
+    return _channel_counter.count()
+
+
+_mux_options = MuxOptions()
+
+
+def set_mux_options(options):
+    """Replaces the MuxOptions instance used by multiplexed connections."""
+
+    global _mux_options
+    _mux_options = options
+
+
+def get_mux_options():
+    return _mux_options
+
+
 class MuxUnexpectedException(Exception):
 
     """Exception in handling multiplexing extension."""
@@ -257,12 +370,17 @@ class _ControlBlock(object):
 
 class _MuxFramePayloadParser(object):
 
-    """A class that parses multiplexed frame payload."""
+    """A class that parses multiplexed frame payload.
+
+    Fields are read in place. Only the contents handed to the caller (the
+    payload of an inner frame, encoded handshakes and DropChannel reasons)
+    are copied out of the payload.
+    """
 
     def __init__(self, payload):
         self._data = payload
+        self._data_length = len(payload)
         self._read_position = 0
-        self._logger = util.get_class_logger(self)
 
     def read_channel_id(self):
         """Read channel id.
@@ -271,8 +389,8 @@ class _MuxFramePayloadParser(object):
             ValueError: when the payload doesn't contain
                 valid channel id.
         """
-        remaining_length = len(self._data) - self._read_position
         pos = self._read_position
+        remaining_length = self._data_length - pos
         if remaining_length == 0:
             raise ValueError('Invalid channel id format')
 
@@ -281,22 +399,20 @@ class _MuxFramePayloadParser(object):
         if channel_id & 0xe0 == 0xe0:
             if remaining_length < 4:
                 raise ValueError('Invalid channel id format')
-            channel_id = struct.unpack('!L',
-                                       self._data[pos:pos+4])[0] & 0x1fffffff
+            channel_id = _UINT32.unpack_from(self._data, pos)[0] & 0x1fffffff
             channel_id_length = 4
         elif channel_id & 0xc0 == 0xc0:
             if remaining_length < 3:
                 raise ValueError('Invalid channel id format')
             channel_id = (((channel_id & 0x1f) << 16) +
-                          struct.unpack('!H', self._data[pos+1:pos+3])[0])
+                          _UINT16.unpack_from(self._data, pos + 1)[0])
             channel_id_length = 3
         elif channel_id & 0x80 == 0x80:
             if remaining_length < 2:
                 raise ValueError('Invalid channel id format')
-            channel_id = struct.unpack('!H',
-                                       self._data[pos:pos+2])[0] & 0x3fff
+            channel_id = _UINT16.unpack_from(self._data, pos)[0] & 0x3fff
             channel_id_length = 2
-        self._read_position += channel_id_length
+        self._read_position = pos + channel_id_length
 
         return channel_id
 
@@ -306,40 +422,40 @@ class _MuxFramePayloadParser(object):
         Raises:
             PhysicalConnectionError: when the inner frame is invalid.
         """
-        if len(self._data) == self._read_position:
+        pos = self._read_position
+        if self._data_length == pos:
             raise PhysicalConnectionError(
                 _DROP_CODE_ENCAPSULATED_FRAME_IS_TRUNCATED)
 
-        bits = ord(self._data[self._read_position])
-        self._read_position += 1
+        bits = ord(self._data[pos])
         fin = (bits & 0x80) == 0x80
         rsv1 = (bits & 0x40) == 0x40
         rsv2 = (bits & 0x20) == 0x20
         rsv3 = (bits & 0x10) == 0x10
         opcode = bits & 0xf
-        payload = self.remaining_data()
         # Consume rest of the message which is payload data of the original
         # frame.
-        self._read_position = len(self._data)
+        payload = self._data[pos + 1:]
+        self._read_position = self._data_length
         return fin, rsv1, rsv2, rsv3, opcode, payload
 
     def _read_number(self):
-        if self._read_position + 1 > len(self._data):
+        pos = self._read_position
+        if pos + 1 > self._data_length:
             raise ValueError(
                 'Cannot read the first byte of number field')
 
-        number = ord(self._data[self._read_position])
+        number = ord(self._data[pos])
         if number & 0x80 == 0x80:
             raise ValueError(
                 'The most significant bit of the first byte of number should '
                 'be unset')
-        self._read_position += 1
-        pos = self._read_position
+        pos += 1
         if number == 127:
-            if pos + 8 > len(self._data):
+            if pos + 8 > self._data_length:
                 raise ValueError('Invalid number field')
-            self._read_position += 8
-            number = struct.unpack('!Q', self._data[pos:pos+8])[0]
+            number = _UINT64.unpack_from(self._data, pos)[0]
+            self._read_position = pos + 8
             if number > 0x7FFFFFFFFFFFFFFF:
                 raise ValueError('Encoded number(%d) >= 2^63' % number)
             if number <= 0xFFFF:
@@ -347,20 +463,21 @@ class _MuxFramePayloadParser(object):
                     '%d should not be encoded by 9 bytes encoding' % number)
             return number
         if number == 126:
-            if pos + 2 > len(self._data):
+            if pos + 2 > self._data_length:
                 raise ValueError('Invalid number field')
-            self._read_position += 2
-            number = struct.unpack('!H', self._data[pos:pos+2])[0]
+            number = _UINT16.unpack_from(self._data, pos)[0]
+            self._read_position = pos + 2
             if number <= 125:
                 raise ValueError(
                     '%d should not be encoded by 3 bytes encoding' % number)
+            return number
+        self._read_position = pos
         return number
 
-    def _read_size_and_contents(self):
-        """Read data that consists of the following:
-            - the size of the contents encoded the same way as payload length
-              of the WebSocket Protocol with 1 bit padding at the head.
-            - the contents.
+    def _read_size(self):
+        """Read the size of contents encoded the same way as payload length
+        of the WebSocket Protocol with 1 bit padding at the head, and skip
+        the contents. Returns the position and the size of the contents.
         """
         try:
             size = self._read_number()
@@ -368,13 +485,22 @@ class _MuxFramePayloadParser(object):
             raise PhysicalConnectionError(_DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
                                           str(e))
         pos = self._read_position
-        if pos + size > len(self._data):
+        if pos + size > self._data_length:
             raise PhysicalConnectionError(
                 _DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
                 'Cannot read %d bytes data' % size)
 
-        self._read_position += size
-        return self._data[pos:pos+size]
+        self._read_position = pos + size
+        return pos, size
+
+    def _read_size_and_contents(self):
+        """Read data that consists of the following:
+            - the size of the contents encoded the same way as payload length
+              of the WebSocket Protocol with 1 bit padding at the head.
+            - the contents.
+        """
+        pos, size = self._read_size()
+        return self._data[pos:pos + size]
 
     def _read_add_channel_request(self, first_byte, control_block):
         reserved = (first_byte >> 2) & 0x7
@@ -437,13 +563,13 @@ class _MuxFramePayloadParser(object):
             control_block.channel_id = self.read_channel_id()
         except ValueError, e:
             raise PhysicalConnectionError(_DROP_CODE_INVALID_MUX_CONTROL_BLOCK)
-        reason = self._read_size_and_contents()
-        if len(reason) == 0:
+        pos, size = self._read_size()
+        if size == 0:
             control_block.drop_code = None
             control_block.drop_message = ''
-        elif len(reason) >= 2:
-            control_block.drop_code = struct.unpack('!H', reason[:2])[0]
-            control_block.drop_message = reason[2:]
+        elif size >= 2:
+            control_block.drop_code = _UINT16.unpack_from(self._data, pos)[0]
+            control_block.drop_message = self._data[pos + 2:pos + size]
         else:
             raise PhysicalConnectionError(
                 _DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
@@ -473,7 +599,7 @@ class _MuxFramePayloadParser(object):
                block(s).
            StopIteration: when no control blocks left.
         """
-        while self._read_position < len(self._data):
+        while self._read_position < self._data_length:
             first_byte = ord(self._data[self._read_position])
             self._read_position += 1
             opcode = (first_byte >> 5) & 0x7
@@ -494,7 +620,7 @@ class _MuxFramePayloadParser(object):
                     _DROP_CODE_UNKNOWN_MUX_OPCODE,
                     'Invalid opcode %d' % opcode)
 
-        assert self._read_position == len(self._data)
+        assert self._read_position == self._data_length
         raise StopIteration
 
     def remaining_data(self):
@@ -553,12 +679,22 @@ class _LogicalConnection(object):
         """
         self._mux_handler = mux_handler
         self._channel_id = channel_id
-        self._incoming_data = ''
+        # Inner frames parsed by the mux handler are queued as Frame objects
+        # and handed to _LogicalStream without being serialized again.
+        self._incoming_frames = collections.deque()
 
-        # - Protects _waiting_write_completion
-        # - Signals the thread waiting for completion of write by mux handler
+        # - Protects _pending_write_bytes, _pending_writes and _writer_done
+        # - Signals the threads waiting for completion of writes by mux
+        #   handler
         self._write_condition = threading.Condition()
-        self._waiting_write_completion = False
+        # Number of bytes and writes queued for the writer thread and not yet
+        # written to the physical connection.
+        self._pending_write_bytes = 0
+        self._pending_writes = 0
+        # Set when the writer thread has finished, normally or not.
+        self._writer_done = False
+        self._write_window = get_mux_options().write_window
+        self._send_weight = 1
 
         self._read_condition = threading.Condition()
         self._read_state = self.STATE_ACTIVE
@@ -581,29 +717,72 @@ class _LogicalConnection(object):
     def write(self, data):
         """Write data. mux_handler sends data asynchronously.
 
-        The caller will be suspended until write done.
+        The caller will be suspended while the write window is full.
 
         Args:
             data: data to be written.
 
         Raises:
-            MuxUnexpectedException: when called before finishing the previous
-                write.
+            BadOperationException: when the writer thread has stopped.
+        """
+        self.write_buffers([data])
+
+    def write_buffers(self, buffers):
+        """Write the concatenation of buffers. The buffers are passed to the
+        physical stream as they are so that they are copied only once when
+        the physical frame is written.
+
+        The buffers are queued for the writer thread without waiting for
+        them to be written unless the write window is full, in which case
+        the caller will be suspended until enough queued data is written.
+
+        Args:
+            buffers: list of data to be written.
+
+        Raises:
+            BadOperationException: when the writer thread has stopped.
         """
+        size = 0
+        for buffer in buffers:
+            size += len(buffer)
+
         try:
             self._write_condition.acquire()
-            if self._waiting_write_completion:
-                raise MuxUnexpectedException(
-                    'Logical connection %d is already waiting the completion '
-                    'of write' % self._channel_id)
+            while (not self._writer_done and self._pending_writes > 0 and
+                   self._pending_write_bytes + size > self._write_window):
+                self._write_condition.wait()
+            if self._writer_done:
+                raise BadOperationException(
+                    'Writer thread of logical connection %d has stopped' %
+                    self._channel_id)
+
+            self._mux_handler.send_data(self._channel_id, buffers,
+                                        self._send_weight)
+            self._pending_write_bytes += size
+            self._pending_writes += 1
+        finally:
+            self._write_condition.release()
 
-            self._waiting_write_completion = True
-            self._mux_handler.send_data(self._channel_id, data)
-            self._write_condition.wait()
-            # TODO(tyoshino): Raise an exception if woke up by on_writer_done.
+    def wait_until_write_done(self):
+        """Blocks until all data written to this connection has been written
+        to the physical connection, or the writer thread has stopped.
+        """
+        try:
+            self._write_condition.acquire()
+            while self._pending_writes > 0:
+                self._write_condition.wait()
         finally:
             self._write_condition.release()
 
+    def set_send_weight(self, weight):
+        """Sets the weight given to this connection when the writer thread
+        schedules data of logical connections.
+        """
+        self._send_weight = weight
+
+    def get_send_weight(self):
+        return self._send_weight
+
     def write_control_data(self, data):
         """Write data via the control channel.
 
@@ -615,16 +794,27 @@ class _LogicalConnection(object):
         """
         self._mux_handler.send_control_data(data)
 
-    def on_write_data_done(self):
-        """Called when sending data is completed."""
+    def write_flow_control(self, replenished_quota):
+        """Sends FlowControl for this logical channel. FlowControl not yet
+        written is merged with it.
+
+        Args:
+            replenished_quota: send quota to be given to the client.
+        """
+        self._mux_handler.send_flow_control(self._channel_id,
+                                            replenished_quota)
+
+    def on_write_data_done(self, size):
+        """Called when sending data of size bytes is completed."""
         try:
             self._write_condition.acquire()
-            if not self._waiting_write_completion:
+            if self._pending_writes == 0:
                 raise MuxUnexpectedException(
                     'Invalid call of on_write_data_done for logical '
                     'connection %d' % self._channel_id)
-            self._waiting_write_completion = False
-            self._write_condition.notify()
+            self._pending_write_bytes -= size
+            self._pending_writes -= 1
+            self._write_condition.notifyAll()
         finally:
             self._write_condition.release()
 
@@ -632,32 +822,32 @@ class _LogicalConnection(object):
         """Called by the mux handler when the writer thread has finished."""
         try:
             self._write_condition.acquire()
-            self._waiting_write_completion = False
-            self._write_condition.notify()
+            self._pending_write_bytes = 0
+            self._pending_writes = 0
+            self._writer_done = True
+            self._write_condition.notifyAll()
         finally:
             self._write_condition.release()
 
-    def append_frame_data(self, frame_data):
-        """Append incoming frame data.
+    def append_frame(self, frame):
+        """Append an incoming inner frame.
 
-        Called when mux_handler dispatches frame data to the corresponding
-        application.
+        Called when mux_handler dispatches a parsed inner frame to the
+        corresponding application.
 
         Args:
-            frame_data: incoming frame data.
+            frame: incoming inner frame (Frame instance).
         """
         self._read_condition.acquire()
-        self._incoming_data += frame_data
+        self._incoming_frames.append(frame)
         self._read_condition.notify()
         self._read_condition.release()
 
-    def read(self, length):
-        """Read data.
+    def read_frame(self):
+        """Read an inner frame.
 
-        Blocks until enough data has arrived via physical connection.
+        Blocks until an inner frame has arrived via physical connection.
 
-        Args:
-            length: length of data to be read.
         Raises:
             LogicalConnectionClosedException: when closing handshake for this
                 logical channel has been received.
@@ -666,7 +856,7 @@ class _LogicalConnection(object):
         """
         self._read_condition.acquire()
         while (self._read_state == self.STATE_ACTIVE and
-               len(self._incoming_data) < length):
+               not self._incoming_frames):
             self._read_condition.wait()
 
         try:
@@ -675,16 +865,13 @@ class _LogicalConnection(object):
                     'Logical channel %d has closed.' % self._channel_id)
             elif self._read_state == self.STATE_TERMINATED:
                 raise ConnectionTerminatedException(
-                    'Receiving %d byte failed. Logical channel (%d) closed' %
-                    (length, self._channel_id))
+                    'Receiving a frame failed. Logical channel (%d) closed' %
+                    self._channel_id)
 
-            value = self._incoming_data[:length]
-            self._incoming_data = self._incoming_data[length:]
+            return self._incoming_frames.popleft()
         finally:
             self._read_condition.release()
 
-        return value
-
     def set_read_state(self, new_state):
         """Set the state of this connection.
 
@@ -814,6 +1001,105 @@ class _InnerMessageBuilder(object):
         return self._frame_handler(frame)
 
 
+class _ReceiveWindow(object):
+
+    """Receive quota accounting of a logical channel with window auto-tuning
+    similar to TCP receive window auto-tuning.
+
+    The window is the send quota the client holds plus the data received
+    but not yet read. Each read gives the client back the quota of the data
+    read. When the client has used up its quota, the time from giving it
+    quota back to receiving the next frame is taken as a round-trip time
+    sample. Every round-trip time, the window grows to twice the amount read
+    during the last round-trip time, so that the client isn't blocked by
+    quota when the handler keeps up, up to the maximum. The window never
+    shrinks.
+    """
+
+    def __init__(self, initial_window, max_window, timer=time.time):
+        """Construct an instance.
+
+        Args:
+            initial_window: quota given to the client so far.
+            max_window: maximum of the window.
+            timer: function returning the current time in seconds.
+        """
+
+        self._timer = timer
+        self._lock = threading.Lock()
+
+        self._quota = initial_window
+        self._window = initial_window
+        self._max_window = max_window
+
+        self._rtt = None
+        self._stall_time = None
+        self._measure_start = None
+        self._read_bytes = 0
+
+    def get_window(self):
+        return self._window
+
+    def get_rtt(self):
+        """Returns the smoothed round-trip time in seconds, or None when no
+        sample has been taken.
+        """
+
+        return self._rtt
+
+    def consume(self, amount):
+        """Consumes quota for a received frame. Returns False when the
+        client violates the quota.
+        """
+
+        self._lock.acquire()
+        try:
+            if self._quota < amount:
+                return False
+            self._quota -= amount
+
+            if self._stall_time is not None:
+                sample = self._timer() - self._stall_time
+                self._stall_time = None
+                if self._rtt is None:
+                    self._rtt = sample
+                else:
+                    self._rtt = (self._rtt * 7 + sample) / 8
+            return True
+        finally:
+            self._lock.release()
+
+    def replenish(self, amount):
+        """Called when a frame which consumed amount quota has been read.
+        Returns the quota to be given back to the client.
+        """
+
+        self._lock.acquire()
+        try:
+            now = self._timer()
+            replenished = amount
+            if self._measure_start is None:
+                self._measure_start = now
+            self._read_bytes += amount
+            elapsed = now - self._measure_start
+            if self._rtt is not None and elapsed >= self._rtt and elapsed > 0:
+                read_per_rtt = self._read_bytes * self._rtt / elapsed
+                target = min(self._max_window, int(2 * read_per_rtt))
+                if target > self._window:
+                    replenished += target - self._window
+                    self._window = target
+                self._measure_start = now
+                self._read_bytes = 0
+
+            if self._quota == 0:
+                # The client can't send until it receives this quota.
+                self._stall_time = now
+            self._quota += replenished
+            return replenished
+        finally:
+            self._lock.release()
+
+
 class _LogicalStream(Stream):
 
     """Mimics the Stream class.
@@ -845,8 +1131,10 @@ class _LogicalStream(Stream):
         # True when the last message was fragmented.
         self._last_message_was_fragmented = False
 
-        self._receive_quota = receive_quota
+        self._receive_window = _ReceiveWindow(
+            receive_quota, get_mux_options().max_receive_window)
         self._write_inner_frame_semaphore = threading.Semaphore()
+        self._fragment_quantum = get_mux_options().fragment_quantum
 
         self._inner_message_builder = _InnerMessageBuilder()
 
@@ -862,7 +1150,9 @@ class _LogicalStream(Stream):
 
         first_byte = ((frame.fin << 7) | (frame.rsv1 << 6) |
                       (frame.rsv2 << 5) | (frame.rsv3 << 4) | frame.opcode)
-        return chr(first_byte) + frame.payload
+        # Keep the header and the payload apart so that the payload is not
+        # copied until the physical frame is written.
+        return [chr(first_byte), frame.payload]
 
     def _write_inner_frame(self, opcode, payload, end=True):
         payload_length = len(payload)
@@ -908,7 +1198,10 @@ class _LogicalStream(Stream):
                             self.request._channel_id)
 
                     remaining = payload_length - write_position
-                    write_length = min(self._send_quota, remaining)
+                    write_length = min(
+                        self._send_quota, remaining,
+                        self._fragment_quantum *
+                        self._request.connection.get_send_weight())
                     inner_frame_end = (
                         end and
                         (write_position + write_length == payload_length))
@@ -926,7 +1219,7 @@ class _LogicalStream(Stream):
                 # Writing data will block the worker so we need to release
                 # _send_condition before writing.
                 self._logger.debug('Sending inner frame: %r' % inner_frame)
-                self._request.connection.write(inner_frame)
+                self._request.connection.write_buffers(inner_frame)
                 write_position += write_length
 
                 opcode = common.OPCODE_CONTINUATION
@@ -936,6 +1229,19 @@ class _LogicalStream(Stream):
         finally:
             self._write_inner_frame_semaphore.release()
 
+    def set_send_weight(self, weight):
+        """Sets the weight of this logical channel relative to the other
+        logical channels on the same physical connection. A channel with
+        weight n can send n times as many bytes as a channel with weight 1
+        while both are busy. The default weight is 1.
+
+        Args:
+            weight: positive integer.
+        """
+        if not isinstance(weight, (int, long)) or weight <= 0:
+            raise BadOperationException('Invalid send weight: %r' % weight)
+        self._request.connection.set_send_weight(weight)
+
     def replenish_send_quota(self, send_quota):
         """Replenish send quota."""
         try:
@@ -953,12 +1259,10 @@ class _LogicalStream(Stream):
 
     def consume_receive_quota(self, amount):
         """Consume receive quota. Returns False on failure."""
-        if self._receive_quota < amount:
-            self._logger.debug('Violate quota on channel id %d: %d < %d' %
-                               (self._request.channel_id,
-                                self._receive_quota, amount))
+        if not self._receive_window.consume(amount):
+            self._logger.debug('Violate quota on channel id %d: %d' %
+                               (self._request.channel_id, amount))
             return False
-        self._receive_quota -= amount
         return True
 
     def send_message(self, message, end=True, binary=False):
@@ -991,26 +1295,25 @@ class _LogicalStream(Stream):
         self._write_inner_frame(opcode, message, end)
         self._last_message_was_fragmented = not end
 
-    def _receive_frame(self):
-        """Override Stream._receive_frame.
+    def _receive_frame_as_frame_object(self):
+        """Override Stream._receive_frame_as_frame_object.
 
-        In addition to call Stream._receive_frame, this method adds the amount
-        of payload to receiving quota and sends FlowControl to the client.
-        We need to do it here because Stream.receive_message() handles
-        control frames internally.
+        Takes an inner frame which the mux handler has already parsed from
+        the logical connection, gives back the quota the frame consumed (plus
+        the growth of the receive window) to the client by FlowControl. We
+        need to do it here because Stream.receive_message() handles control
+        frames internally.
         """
-        opcode, payload, fin, rsv1, rsv2, rsv3 = Stream._receive_frame(self)
-        amount = len(payload)
+        frame = self._request.connection.read_frame()
+        amount = len(frame.payload)
         # Replenish extra one octet when receiving the first fragmented frame.
-        if opcode != common.OPCODE_CONTINUATION:
+        if frame.opcode != common.OPCODE_CONTINUATION:
             amount += 1
-        self._receive_quota += amount
-        frame_data = _create_flow_control(self._request.channel_id,
-                                          amount)
+        replenished = self._receive_window.replenish(amount)
         self._logger.debug('Sending flow control for %d, replenished=%d' %
-                           (self._request.channel_id, amount))
-        self._request.connection.write_control_data(frame_data)
-        return opcode, payload, fin, rsv1, rsv2, rsv3
+                           (self._request.channel_id, replenished))
+        self._request.connection.write_flow_control(replenished)
+        return frame
 
     def _get_message_from_frame(self, frame):
         """Override Stream._get_message_from_frame."""
@@ -1079,12 +1382,114 @@ class _OutgoingData(object):
     """Simple data/channel container.
 
     A structure that holds data to be sent via physical connection and
-    origin of the data.
+    origin of the data. The data is held as a list of buffers whose
+    concatenation forms the payload following the channel id.
     """
 
-    def __init__(self, channel_id, data):
+    def __init__(self, channel_id, buffers, weight=1):
         self.channel_id = channel_id
-        self.data = data
+        self.buffers = buffers
+        self.weight = weight
+        self.size = 0
+        for buffer in buffers:
+            self.size += len(buffer)
+
+
+class _OutgoingDataScheduler(object):
+
+    """Deficit round-robin scheduler of _OutgoingData.
+
+    Data for the control channel is always taken first. FlowControl for a
+    logical channel queued while an earlier one for the same channel is
+    still queued is merged into the earlier one. Data for logical
+    channels is queued per channel, and the channels which have queued data
+    take turns in round-robin order. At the start of its turn, a channel
+    earns fragment_quantum times the weight of its data as deficit and its
+    data is taken while the deficit covers its size. A channel which runs
+    out of data loses the remaining deficit.
+
+    This class is not thread-safe.
+    """
+
+    def __init__(self, quantum):
+        self._quantum = quantum
+        self._control_data = collections.deque()
+        # Maps channel ids to lists of the channel id and the replenished
+        # quota of FlowControl queued in _control_data.
+        self._flow_controls = {}
+        # Maps channel ids of the channels in _active_channels to deques of
+        # their data.
+        self._channel_data = {}
+        self._active_channels = collections.deque()
+        self._deficits = {}
+        self._turn_started = False
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, outgoing_data):
+        """Queues outgoing_data (_OutgoingData instance)."""
+
+        self._length += 1
+        channel_id = outgoing_data.channel_id
+        if channel_id == _CONTROL_CHANNEL_ID:
+            self._control_data.append(outgoing_data)
+            return
+        if channel_id not in self._channel_data:
+            self._channel_data[channel_id] = collections.deque()
+            self._deficits[channel_id] = 0
+            self._active_channels.append(channel_id)
+        self._channel_data[channel_id].append(outgoing_data)
+
+    def append_flow_control(self, channel_id, replenished_quota):
+        """Queues FlowControl for channel_id."""
+
+        flow_control = self._flow_controls.get(channel_id)
+        if flow_control is not None:
+            flow_control[1] += replenished_quota
+            return
+        flow_control = [channel_id, replenished_quota]
+        self._flow_controls[channel_id] = flow_control
+        self._control_data.append(flow_control)
+        self._length += 1
+
+    def popleft(self):
+        """Removes the next _OutgoingData to be sent and returns it. Must not
+        be called when nothing is queued.
+        """
+
+        self._length -= 1
+        if self._control_data:
+            outgoing_data = self._control_data.popleft()
+            if isinstance(outgoing_data, list):
+                channel_id, replenished_quota = outgoing_data
+                del self._flow_controls[channel_id]
+                outgoing_data = _OutgoingData(
+                    channel_id=_CONTROL_CHANNEL_ID,
+                    buffers=[_create_flow_control(channel_id,
+                                                  replenished_quota)])
+            return outgoing_data
+
+        while True:
+            channel_id = self._active_channels[0]
+            queue = self._channel_data[channel_id]
+            if not self._turn_started:
+                self._deficits[channel_id] += self._quantum * queue[0].weight
+                self._turn_started = True
+            if queue[0].size <= self._deficits[channel_id]:
+                break
+            self._active_channels.rotate(-1)
+            self._turn_started = False
+
+        outgoing_data = queue.popleft()
+        self._deficits[channel_id] -= outgoing_data.size
+        if not queue:
+            del self._channel_data[channel_id]
+            del self._deficits[channel_id]
+            self._active_channels.popleft()
+            self._turn_started = False
+        return outgoing_data
 
 
 class _PhysicalConnectionWriter(threading.Thread):
@@ -1111,10 +1516,11 @@ class _PhysicalConnectionWriter(threading.Thread):
         self._stop_requested = False
         # The close code of the physical connection.
         self._close_code = common.STATUS_NORMAL_CLOSURE
-        # Deque for passing write data. It's protected by _deque_condition
-        # until _stop_requested is set.
-        self._deque = collections.deque()
-        # - Protects _deque, _stop_requested and _close_code
+        # Scheduler for passing write data. It's protected by
+        # _deque_condition until _stop_requested is set.
+        self._scheduler = _OutgoingDataScheduler(
+            mux_handler.options.fragment_quantum)
+        # - Protects _scheduler, _stop_requested and _close_code
         # - Signals threads waiting for them to be available
         self._deque_condition = threading.Condition()
 
@@ -1132,17 +1538,62 @@ class _PhysicalConnectionWriter(threading.Thread):
             if self._stop_requested:
                 raise BadOperationException('Cannot write data anymore')
 
-            self._deque.append(data)
+            self._scheduler.append(data)
+            self._deque_condition.notify()
+        finally:
+            self._deque_condition.release()
+
+    def put_flow_control(self, channel_id, replenished_quota):
+        """Put FlowControl for channel_id.
+
+        Raises:
+            BadOperationException: when the thread has been requested to
+                terminate.
+        """
+        try:
+            self._deque_condition.acquire()
+            if self._stop_requested:
+                raise BadOperationException('Cannot write data anymore')
+
+            self._scheduler.append_flow_control(channel_id, replenished_quota)
             self._deque_condition.notify()
         finally:
             self._deque_condition.release()
 
-    def _write_data(self, outgoing_data):
-        message = (_encode_channel_id(outgoing_data.channel_id) +
-                   outgoing_data.data)
+    def _pop_outgoing_data_batch(self):
+        """Pops pending _OutgoingData instances until their payloads reach
+        _MAX_WRITE_BATCH_SIZE bytes. At least one instance is popped. Must be
+        called with _deque_condition acquired and the deque not empty.
+
+        Control blocks popped in a row are put in one control channel
+        message.
+        """
+
+        batch = []
+        batch_size = 0
+        while self._scheduler and (not batch or
+                               batch_size < _MAX_WRITE_BATCH_SIZE):
+            outgoing_data = self._scheduler.popleft()
+            batch_size += outgoing_data.size
+            if (outgoing_data.channel_id == _CONTROL_CHANNEL_ID and batch and
+                batch[-1].channel_id == _CONTROL_CHANNEL_ID):
+                batch[-1].buffers.extend(outgoing_data.buffers)
+                batch[-1].size += outgoing_data.size
+                continue
+            batch.append(outgoing_data)
+        return batch
+
+    def _write_data(self, batch):
+        """Sends each _OutgoingData in batch as a physical message. The
+        messages are written to the physical connection at once.
+        """
+
+        messages = []
+        for outgoing_data in batch:
+            messages.append([_encode_channel_id(outgoing_data.channel_id)] +
+                            outgoing_data.buffers)
         try:
-            self._mux_handler.physical_stream.send_message(
-                message=message, end=True, binary=True)
+            self._mux_handler.physical_stream.send_binary_messages(messages)
         except Exception, e:
             util.prepend_message_to_exception(
                 'Failed to send message to %r: ' %
@@ -1151,30 +1602,31 @@ class _PhysicalConnectionWriter(threading.Thread):
 
         # TODO(bashi): It would be better to block the thread that sends
         # control data as well.
-        if outgoing_data.channel_id != _CONTROL_CHANNEL_ID:
-            self._mux_handler.notify_write_data_done(outgoing_data.channel_id)
+        for outgoing_data in batch:
+            if outgoing_data.channel_id != _CONTROL_CHANNEL_ID:
+                self._mux_handler.notify_write_data_done(
+                    outgoing_data.channel_id, outgoing_data.size)
 
     def run(self):
         try:
             self._deque_condition.acquire()
             while not self._stop_requested:
-                if len(self._deque) == 0:
+                if len(self._scheduler) == 0:
                     self._deque_condition.wait()
                     continue
 
-                outgoing_data = self._deque.popleft()
+                batch = self._pop_outgoing_data_batch()
 
                 self._deque_condition.release()
-                self._write_data(outgoing_data)
+                self._write_data(batch)
                 self._deque_condition.acquire()
 
             # Flush deque.
             #
             # At this point, self._deque_condition is always acquired.
             try:
-                while len(self._deque) > 0:
-                    outgoing_data = self._deque.popleft()
-                    self._write_data(outgoing_data)
+                while len(self._scheduler) > 0:
+                    self._write_data(self._pop_outgoing_data_batch())
             finally:
                 self._deque_condition.release()
 
@@ -1189,13 +1641,20 @@ class _PhysicalConnectionWriter(threading.Thread):
                     'Failed to close the physical connection: %r' % e)
                 raise
         finally:
+            # Reject new data also when this thread died of an exception.
+            self._deque_condition.acquire()
+            self._stop_requested = True
+            self._deque_condition.release()
             self._mux_handler.notify_writer_done()
 
     def stop(self, close_code=common.STATUS_NORMAL_CLOSURE):
-        """Stop the writer thread."""
+        """Stop the writer thread. The close code of the first call is
+        used.
+        """
         self._deque_condition.acquire()
+        if not self._stop_requested:
+            self._close_code = close_code
         self._stop_requested = True
-        self._close_code = close_code
         self._deque_condition.notify()
         self._deque_condition.release()
 
@@ -1280,6 +1739,9 @@ class _Worker(threading.Thread):
             self._mux_handler.fail_logical_channel(
                 e.channel_id, e.drop_code, e.message)
         finally:
+            # Writes may still be queued. Let them go out before
+            # DropChannel, which the writer thread sends ahead of them.
+            self._request.connection.wait_until_write_done()
             self._mux_handler.notify_worker_done(self._request.channel_id)
 
 
@@ -1367,6 +1829,11 @@ class _LogicalChannelData(object):
         self.worker = worker
         self.drop_code = _DROP_CODE_NORMAL_CLOSURE
         self.drop_message = ''
+        # False once the worker has finished and the channel has been
+        # removed from the channel table.
+        self.active = True
+        # Protects drop_code, drop_message and active.
+        self.lock = threading.Lock()
 
 
 class _HandshakeDeltaBase(object):
@@ -1425,8 +1892,15 @@ class _MuxHandler(object):
         self.dispatcher = dispatcher
         self.physical_connection = request.connection
         self.physical_stream = request.ws_stream
+        self.options = get_mux_options()
         self._logger = util.get_class_logger(self)
+        # Maps channel ids to _LogicalChannelData. A published dict is never
+        # modified. Adding or removing a channel replaces it with a modified
+        # copy with _logical_channels_condition acquired, so that the reader
+        # and the writer threads can look up channels without the lock.
         self._logical_channels = {}
+        # - Protects replacing _logical_channels
+        # - Signals the thread waiting for workers to finish
         self._logical_channels_condition = threading.Condition()
         # Holds client's initial quota
         self._channel_slots = collections.deque()
@@ -1468,19 +1942,20 @@ class _MuxHandler(object):
             logical_connection)
         # Client's send quota for the implicitly opened connection is zero,
         # but we will send FlowControl later so set the initial quota to
-        # _INITIAL_QUOTA_FOR_CLIENT.
-        self._channel_slots.append(_INITIAL_QUOTA_FOR_CLIENT)
+        # min_receive_window.
+        self._channel_slots.append(self.options.min_receive_window)
         send_quota = self.original_request.mux_processor.quota()
         if not self._do_handshake_for_logical_request(
             logical_request, send_quota=send_quota):
             raise MuxUnexpectedException(
                 'Failed handshake on the default channel id')
+        # The implicitly opened connection is counted but never rejected.
+        _channel_counter.acquire(0)
         self._add_logical_channel(logical_request)
 
         # Send FlowControl for the implicitly opened connection.
-        frame_data = _create_flow_control(_DEFAULT_CHANNEL_ID,
-                                          _INITIAL_QUOTA_FOR_CLIENT)
-        logical_request.connection.write_control_data(frame_data)
+        logical_request.connection.write_flow_control(
+            self.options.min_receive_window)
 
     def add_channel_slots(self, slots, send_quota):
         """Adds channel slots.
@@ -1522,23 +1997,20 @@ class _MuxHandler(object):
 
         return True
 
-    def notify_write_data_done(self, channel_id):
+    def notify_write_data_done(self, channel_id, size):
         """Called by the writer thread when a write operation has done.
 
         Args:
             channel_id: objective channel id.
+            size: number of bytes written.
         """
 
-        try:
-            self._logical_channels_condition.acquire()
-            if channel_id in self._logical_channels:
-                channel_data = self._logical_channels[channel_id]
-                channel_data.request.connection.on_write_data_done()
-            else:
-                self._logger.debug('Seems that logical channel for %d has gone'
-                                   % channel_id)
-        finally:
-            self._logical_channels_condition.release()
+        channel_data = self._logical_channels.get(channel_id)
+        if channel_data is None:
+            self._logger.debug('Seems that logical channel for %d has gone'
+                               % channel_id)
+            return
+        channel_data.request.connection.on_write_data_done(size)
 
     def send_control_data(self, data):
         """Sends data via the control channel.
@@ -1548,19 +2020,30 @@ class _MuxHandler(object):
         """
 
         self._writer.put_outgoing_data(_OutgoingData(
-                channel_id=_CONTROL_CHANNEL_ID, data=data))
+                channel_id=_CONTROL_CHANNEL_ID, buffers=[data]))
+
+    def send_flow_control(self, channel_id, replenished_quota):
+        """Sends FlowControl for a logical channel via the control channel.
+
+        Args:
+            channel_id: objective channel id.
+            replenished_quota: send quota to be given to the client.
+        """
+
+        self._writer.put_flow_control(channel_id, replenished_quota)
 
-    def send_data(self, channel_id, data):
+    def send_data(self, channel_id, buffers, weight=1):
         """Sends data via given logical channel. This method is called by
         worker threads.
 
         Args:
             channel_id: objective channel id.
-            data: data to be sent.
+            buffers: list of data whose concatenation is to be sent.
+            weight: send weight of the logical channel.
         """
 
         self._writer.put_outgoing_data(_OutgoingData(
-                channel_id=channel_id, data=data))
+                channel_id=channel_id, buffers=buffers, weight=weight))
 
     def _send_drop_channel(self, channel_id, code=None, message=''):
         frame_data = _create_drop_channel(channel_id, code, message)
@@ -1648,11 +2131,52 @@ class _MuxHandler(object):
                     logical_request.channel_id)
             worker = _Worker(self, logical_request)
             channel_data = _LogicalChannelData(logical_request, worker)
-            self._logical_channels[logical_request.channel_id] = channel_data
-            worker.start()
+            logical_channels = self._logical_channels.copy()
+            logical_channels[logical_request.channel_id] = channel_data
+            self._logical_channels = logical_channels
+            if self.options.worker_pool is None:
+                worker.start()
+            else:
+                self.options.worker_pool.submit(worker.run)
         finally:
             self._logical_channels_condition.release()
 
+    def _reserve_logical_channel(self):
+        """Counts a new logical channel against the per physical connection
+        and the server-wide limits. Returns False when either has been
+        reached. The server-wide limit is at most the number of threads of
+        the worker pool so that the handler of an accepted channel doesn't
+        wait for a thread.
+        """
+
+        max_channels_per_connection = self.options.max_channels_per_connection
+        if max_channels_per_connection > 0:
+            try:
+                self._logical_channels_condition.acquire()
+                if len(self._logical_channels) >= max_channels_per_connection:
+                    return False
+            finally:
+                self._logical_channels_condition.release()
+        max_channels = self.options.max_channels
+        worker_pool = self.options.worker_pool
+        if worker_pool is not None:
+            thread_count = worker_pool.get_thread_count()
+            if max_channels <= 0 or max_channels > thread_count:
+                max_channels = thread_count
+        return _channel_counter.acquire(max_channels)
+
+    def _reject_add_channel_request_over_limit(self, channel_id):
+        # The client has spent a channel slot on the request.
+        try:
+            self._channel_slots.popleft()
+        except IndexError:
+            raise LogicalChannelError(
+                channel_id, _DROP_CODE_NEW_CHANNEL_SLOT_VIOLATION)
+        self._logger.info('Rejecting AddChannelRequest for %d: too many '
+                          'logical channels' % channel_id)
+        self._send_error_add_channel_response(
+            channel_id, status=common.HTTP_STATUS_SERVICE_UNAVAILABLE)
+
     def _process_add_channel_request(self, block):
         try:
             logical_request = self._create_logical_request(block)
@@ -1661,38 +2185,45 @@ class _MuxHandler(object):
             self._send_error_add_channel_response(
                 block.channel_id, status=common.HTTP_STATUS_BAD_REQUEST)
             return
-        if self._do_handshake_for_logical_request(logical_request):
-            if block.encoding == _HANDSHAKE_ENCODING_IDENTITY:
-                # Update handshake base.
-                # TODO(bashi): Make sure this is the right place to update
-                # handshake base.
-                self._handshake_base = _HandshakeDeltaBase(
-                    logical_request.headers_in)
-            self._add_logical_channel(logical_request)
-        else:
+        if not self._reserve_logical_channel():
+            self._reject_add_channel_request_over_limit(block.channel_id)
+            return
+        try:
+            accepted = self._do_handshake_for_logical_request(
+                logical_request)
+            if accepted:
+                if block.encoding == _HANDSHAKE_ENCODING_IDENTITY:
+                    # Update handshake base.
+                    # TODO(bashi): Make sure this is the right place to
+                    # update handshake base.
+                    self._handshake_base = _HandshakeDeltaBase(
+                        logical_request.headers_in)
+                self._add_logical_channel(logical_request)
+        except:
+            _channel_counter.release()
+            raise
+        if not accepted:
+            _channel_counter.release()
             self._send_error_add_channel_response(
                 block.channel_id, status=common.HTTP_STATUS_BAD_REQUEST)
 
     def _process_flow_control(self, block):
-        try:
-            self._logical_channels_condition.acquire()
-            if not block.channel_id in self._logical_channels:
-                return
-            channel_data = self._logical_channels[block.channel_id]
-            channel_data.request.ws_stream.replenish_send_quota(
-                block.send_quota)
-        finally:
-            self._logical_channels_condition.release()
+        channel_data = self._logical_channels.get(block.channel_id)
+        if channel_data is None:
+            return
+        channel_data.request.ws_stream.replenish_send_quota(block.send_quota)
 
     def _process_drop_channel(self, block):
         self._logger.debug(
             'DropChannel received for %d: code=%r, reason=%r' %
             (block.channel_id, block.drop_code, block.drop_message))
+        channel_data = self._logical_channels.get(block.channel_id)
+        if channel_data is None:
+            return
         try:
-            self._logical_channels_condition.acquire()
-            if not block.channel_id in self._logical_channels:
+            channel_data.lock.acquire()
+            if not channel_data.active:
                 return
-            channel_data = self._logical_channels[block.channel_id]
             channel_data.drop_code = _DROP_CODE_ACKNOWLEDGED
 
             # Close the logical channel
@@ -1700,7 +2231,7 @@ class _MuxHandler(object):
                 _LogicalConnection.STATE_TERMINATED)
             channel_data.request.ws_stream.stop_sending()
         finally:
-            self._logical_channels_condition.release()
+            channel_data.lock.release()
 
     def _process_control_blocks(self, parser):
         for control_block in parser.read_control_blocks():
@@ -1726,27 +2257,22 @@ class _MuxHandler(object):
 
     def _process_logical_frame(self, channel_id, parser):
         self._logger.debug('Received a frame. channel id=%d' % channel_id)
-        try:
-            self._logical_channels_condition.acquire()
-            if not channel_id in self._logical_channels:
-                # We must ignore the message for an inactive channel.
-                return
-            channel_data = self._logical_channels[channel_id]
-            fin, rsv1, rsv2, rsv3, opcode, payload = parser.read_inner_frame()
-            consuming_byte = len(payload)
-            if opcode != common.OPCODE_CONTINUATION:
-                consuming_byte += 1
-            if not channel_data.request.ws_stream.consume_receive_quota(
-                consuming_byte):
-                # The client violates quota. Close logical channel.
-                raise LogicalChannelError(
-                    channel_id, _DROP_CODE_SEND_QUOTA_VIOLATION)
-            header = create_header(opcode, len(payload), fin, rsv1, rsv2, rsv3,
-                                   mask=False)
-            frame_data = header + payload
-            channel_data.request.connection.append_frame_data(frame_data)
-        finally:
-            self._logical_channels_condition.release()
+        channel_data = self._logical_channels.get(channel_id)
+        if channel_data is None:
+            # We must ignore the message for an inactive channel.
+            return
+        fin, rsv1, rsv2, rsv3, opcode, payload = parser.read_inner_frame()
+        consuming_byte = len(payload)
+        if opcode != common.OPCODE_CONTINUATION:
+            consuming_byte += 1
+        if not channel_data.request.ws_stream.consume_receive_quota(
+            consuming_byte):
+            # The client violates quota. Close logical channel.
+            raise LogicalChannelError(
+                channel_id, _DROP_CODE_SEND_QUOTA_VIOLATION)
+        channel_data.request.connection.append_frame(
+            Frame(fin=fin, rsv1=rsv1, rsv2=rsv2, rsv3=rsv3, opcode=opcode,
+                  payload=payload))
 
     def dispatch_message(self, message):
         """Dispatches message. The reader thread calls this method.
@@ -1783,12 +2309,23 @@ class _MuxHandler(object):
             if not channel_id in self._logical_channels:
                 raise MuxUnexpectedException(
                     'Channel id %d not found' % channel_id)
-            channel_data = self._logical_channels.pop(channel_id)
+            logical_channels = self._logical_channels.copy()
+            channel_data = logical_channels.pop(channel_id)
+            self._logical_channels = logical_channels
+            _channel_counter.release()
         finally:
             self._worker_done_notify_received = True
             self._logical_channels_condition.notify()
             self._logical_channels_condition.release()
 
+        # Threads which have looked the channel up before its removal may
+        # still set the drop reason until active is cleared.
+        try:
+            channel_data.lock.acquire()
+            channel_data.active = False
+        finally:
+            channel_data.lock.release()
+
         if not channel_data.request.server_terminated:
             self._send_drop_channel(
                 channel_id, code=channel_data.drop_code,
@@ -1802,14 +2339,12 @@ class _MuxHandler(object):
         self._logger.debug(
             'Termiating all logical connections waiting for incoming data '
             '...')
-        self._logical_channels_condition.acquire()
         for channel_data in self._logical_channels.values():
             try:
                 channel_data.request.connection.set_read_state(
                     _LogicalConnection.STATE_TERMINATED)
             except Exception:
                 self._logger.debug(traceback.format_exc())
-        self._logical_channels_condition.release()
 
     def notify_writer_done(self):
         """This method is called by the writer thread when the writer has
@@ -1819,13 +2354,11 @@ class _MuxHandler(object):
         self._logger.debug(
             'Termiating all logical connections waiting for write '
             'completion ...')
-        self._logical_channels_condition.acquire()
         for channel_data in self._logical_channels.values():
             try:
                 channel_data.request.connection.on_writer_done()
             except Exception:
                 self._logger.debug(traceback.format_exc())
-        self._logical_channels_condition.release()
 
     def fail_physical_connection(self, code, message):
         """Fail the physical connection.
@@ -1849,22 +2382,23 @@ class _MuxHandler(object):
         """
 
         self._logger.debug('Failing logical channel %d...' % channel_id)
-        try:
-            self._logical_channels_condition.acquire()
-            if channel_id in self._logical_channels:
-                channel_data = self._logical_channels[channel_id]
-                # Close the logical channel. notify_worker_done() will be
-                # called later and it will send DropChannel.
-                channel_data.drop_code = code
-                channel_data.drop_message = message
-
-                channel_data.request.connection.set_read_state(
-                    _LogicalConnection.STATE_TERMINATED)
-                channel_data.request.ws_stream.stop_sending()
-            else:
-                self._send_drop_channel(channel_id, code, message)
-        finally:
-            self._logical_channels_condition.release()
+        channel_data = self._logical_channels.get(channel_id)
+        if channel_data is not None:
+            try:
+                channel_data.lock.acquire()
+                if channel_data.active:
+                    # Close the logical channel. notify_worker_done() will be
+                    # called later and it will send DropChannel.
+                    channel_data.drop_code = code
+                    channel_data.drop_message = message
+
+                    channel_data.request.connection.set_read_state(
+                        _LogicalConnection.STATE_TERMINATED)
+                    channel_data.request.ws_stream.stop_sending()
+                    return
+            finally:
+                channel_data.lock.release()
+        self._send_drop_channel(channel_id, code, message)
 
 
 def use_mux(request):
@@ -1877,7 +2411,7 @@ def start(request, dispatcher):
     mux_handler.start()
 
     mux_handler.add_channel_slots(_INITIAL_NUMBER_OF_CHANNEL_SLOTS,
-                                  _INITIAL_QUOTA_FOR_CLIENT)
+                                  mux_handler.options.min_receive_window)
 
     mux_handler.wait_until_done()
 
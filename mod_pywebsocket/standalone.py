@@ -82,8 +82,15 @@ USING TLS
 To run the standalone server with TLS support, run it with -t, -k, and -c
 options. When TLS is enabled, the standalone server accepts only TLS connection.
 
-Note that when ssl module is used and the key/cert location is incorrect,
-TLS connection silently fails while pyOpenSSL fails on startup.
+The key and certificate are loaded once on startup into a context shared by
+all connections, which caches sessions and issues session tickets so that
+clients can resume them. Note that when ssl module of Python older than 2.7.9
+is used and the key/cert location is incorrect, TLS connection silently fails
+while pyOpenSSL fails on startup.
+
+The TLS handshake runs on the thread of each connection rather than the thread
+accepting connections, so a slow client doesn't block others. Connections
+which don't complete it within --tls-handshake-timeout seconds are closed.
 
 Example:
 
@@ -146,6 +153,85 @@ THREADING
 This server is derived from SocketServer.ThreadingMixIn. Hence a thread is
 used for each request.
 
+With --handler-threads=N, requests run on a pool of N threads instead. Up to
+--handler-queue-size accepted requests wait for a thread and further requests
+are answered with 503 Service Unavailable and Retry-After, so that a flood of
+connections doesn't make the server start threads until it runs out of
+memory. Note that a WebSocket connection holds its thread until it's closed.
+A connection which doesn't send its request header, waiting more than
+--request-header-timeout seconds for each read, is closed so that idle
+connections can't hold all the threads.
+--thread-stack-size reduces the memory reserved for each thread.
+
+With --server-mode=epoll, connections are read and written by a few threads
+running epoll loops instead (see --selector-threads). Opening handshakes,
+web_socket_receive_message handlers and coroutine web_socket_transfer_data
+handlers run on a pool of worker threads (see --event-loop-worker-threads),
+so idle connections of such handlers don't hold any thread. Other handlers
+still get a thread for each connection. TLS is not supported in this mode.
+Connections which don't send the header of their request within
+--request-header-timeout seconds are closed, and writes by handlers wait
+while more than --event-loop-write-buffer-size bytes are queued for the
+client.
+
+With --processes=N, the server forks N worker processes which serve the same
+port in either server mode, so that frame processing isn't limited to one core
+by the GIL. The workers accept on the listening sockets created before forking
+unless --reuse-port is given, in which case each worker binds its own sockets
+with SO_REUSEPORT and the kernel distributes connections among them. The
+parent process restarts workers which exit unexpectedly and forwards SIGTERM
+and SIGINT to the workers.
+
+With --resource-processes=RESOURCE=N in the epoll server mode, an acceptor
+process accepts all connections, reads their request header and passes the
+socket and the header to one of N worker processes dedicated to the handler of
+RESOURCE, or otherwise to one of the --processes default workers. The worker
+then processes the request, so that busy resources can be isolated from each
+other on separate cores while sharing one port.
+
+
+TUNING SOCKETS
+==============
+
+The listening sockets and the accepted connections can be tuned by
+--tcp-nodelay, --send-buffer-size, --receive-buffer-size, --tcp-keepalive
+(with --tcp-keepalive-idle, --tcp-keepalive-interval and
+--tcp-keepalive-count) and --tcp-defer-accept. A handler can override
+--tcp-nodelay for its connections by calling
+request.connection.set_tcp_nodelay() in web_socket_do_extra_handshake.
+
+
+UNIX-DOMAIN SOCKETS AND SOCKET ACTIVATION
+=========================================
+
+With --unix-socket=PATH, the server listens on a Unix-domain socket at PATH,
+e.g. for a reverse proxy on the same host, and on TCP only if --port is given
+too. A socket file left at PATH is replaced. The server doesn't remove it on
+exit.
+
+When started by systemd socket activation, i.e. LISTEN_PID is the server
+process and LISTEN_FDS is set, the server serves the listening sockets passed
+by systemd, TCP or Unix-domain ones, instead of creating its own. --port and
+--unix-socket are ignored then, and --reuse-port can't be used.
+
+
+GRACEFUL SHUTDOWN AND RESTART
+=============================
+
+With --drain-timeout, SIGTERM makes the server stop accepting connections and
+close its WebSocket connections with status 1001 (going away), at most
+--drain-rate per second so that the clients don't reconnect all at once. The
+server exits when all of them have been closed or --drain-timeout seconds have
+passed. Connections of the HyBi 00 and older protocols are not closed.
+
+SIGUSR2 restarts the server without refusing connections. The server starts a
+new server process with the same command line, which inherits the listening
+sockets through the PYWEBSOCKET_LISTEN_FDS environment variable, and drains
+once the new server is ready. With --processes, send SIGUSR2 to the parent
+process. With --reuse-port, the new server binds its own sockets instead, and
+connections queued on the sockets of the old server when they are closed may
+be reset.
+
 
 SECURITY WARNING
 ================
@@ -161,24 +247,45 @@ import SimpleHTTPServer
 import SocketServer
 import ConfigParser
 import base64
+import collections
+import errno
+import functools
+import heapq
 import httplib
+import itertools
 import logging
 import logging.handlers
 import optparse
 import os
+import pickle
 import re
 import select
+import signal
 import socket
+import stat
+import struct
+import subprocess
 import sys
 import threading
 import time
 import urlparse
+import zlib
+
+try:
+    # Only needed for the --resource-processes option. _main checks that
+    # sendfd is available.
+    import _multiprocessing
+except ImportError:
+    _multiprocessing = None
 
 from mod_pywebsocket import common
 from mod_pywebsocket import dispatch
+from mod_pywebsocket import extensions
 from mod_pywebsocket import handshake
 from mod_pywebsocket import http_header_util
 from mod_pywebsocket import memorizingfile
+from mod_pywebsocket import mux
+from mod_pywebsocket import stream
 from mod_pywebsocket import util
 from mod_pywebsocket.xhr_benchmark_handler import XHRBenchmarkHandler
 
@@ -195,6 +302,62 @@ _MAX_MEMORIZED_LINES = 1024
 _TLS_BY_STANDARD_MODULE = 'ssl'
 _TLS_BY_PYOPENSSL = 'pyopenssl'
 
+_DEFAULT_TLS_HANDSHAKE_TIMEOUT_IN_SEC = 10
+_DEFAULT_REQUEST_HEADER_TIMEOUT_IN_SEC = 10
+# Session ID context of the pyOpenSSL context. OpenSSL resumes a session only
+# in the context it was established in.
+_TLS_SESSION_ID_CONTEXT = 'pywebsocket'
+
+# Constants for the --server-mode flag.
+_SERVER_MODE_THREADING = 'threading'
+_SERVER_MODE_EPOLL = 'epoll'
+
+_DEFAULT_HANDLER_QUEUE_SIZE = 128
+# Value of the Retry-After header of the 503 response to requests rejected
+# when the handler thread pool is full.
+_HANDLER_RETRY_AFTER_IN_SEC = 1
+
+_DEFAULT_SELECTOR_THREADS = 1
+_DEFAULT_EVENT_LOOP_WORKER_THREADS = 16
+# Bytes queued for a connection of the epoll server mode above which writes
+# by handlers wait for the peer to read them.
+_DEFAULT_EVENT_LOOP_WRITE_BUFFER_SIZE = 1024 * 1024
+# Seconds a write waits for the peer to read any of the queued bytes before
+# the connection is closed.
+_EVENT_LOOP_WRITE_STALL_TIMEOUT_IN_SEC = 30
+
+# Interval at which the supervisor of the --processes mode checks whether
+# worker processes have exited.
+_WORKER_POLL_INTERVAL_IN_SEC = 0.1
+# Minimum interval between starts of a worker process in the --processes mode
+# so that a worker crashing on startup doesn't make the supervisor fork in a
+# tight loop.
+_WORKER_RESTART_INTERVAL_IN_SEC = 1
+
+# Closing handshakes sent per second when draining connections.
+_DEFAULT_DRAIN_RATE = 100
+
+# Environment variables through which a server restarted on SIGUSR2 receives
+# the listening sockets of the old server and tells it when it's ready.
+_LISTEN_FDS_ENV = 'PYWEBSOCKET_LISTEN_FDS'
+_READY_FD_ENV = 'PYWEBSOCKET_READY_FD'
+_RESTART_READY_TIMEOUT_IN_SEC = 60
+
+# Environment variables and the first file descriptor of the systemd socket
+# activation protocol. See sd_listen_fds(3).
+_SYSTEMD_LISTEN_PID_ENV = 'LISTEN_PID'
+_SYSTEMD_LISTEN_FDS_ENV = 'LISTEN_FDS'
+_SYSTEMD_LISTEN_FDNAMES_ENV = 'LISTEN_FDNAMES'
+_SYSTEMD_LISTEN_FDS_START = 3
+# socket module of Python 2 doesn't define SO_DOMAIN. 39 is its value on
+# Linux, the only platform of systemd.
+_SO_DOMAIN = getattr(socket, 'SO_DOMAIN', 39)
+
+_RECEIVE_BUFFER_SIZE = 64 * 1024
+_MAX_OPENING_HANDSHAKE_SIZE = 64 * 1024
+# Large enough for the pickled address and header of a handed off connection.
+_MAX_HANDOFF_MESSAGE_SIZE = _MAX_OPENING_HANDSHAKE_SIZE + 1024
+
 
 class _StandaloneConnection(object):
     """Mimic mod_python mp_conn."""
@@ -207,10 +370,18 @@ class _StandaloneConnection(object):
         """
 
         self._request_handler = request_handler
+        # Serializes frames written by the handler and by a draining server.
+        self._write_lock = threading.Lock()
 
     def get_local_addr(self):
-        """Getter to mimic mp_conn.local_addr."""
+        """Getter to mimic mp_conn.local_addr.
 
+        For a connection accepted on a Unix-domain socket, this is a tuple of
+        the path of the socket and None as it has no port.
+        """
+
+        if _is_unix_address(self._request_handler.client_address):
+            return (self._request_handler.connection.getsockname(), None)
         return (self._request_handler.server.server_name,
                 self._request_handler.server.server_port)
     local_addr = property(get_local_addr)
@@ -219,7 +390,9 @@ class _StandaloneConnection(object):
         """Getter to mimic mp_conn.remote_addr.
 
         Setting the property in __init__ won't work because the request
-        handler is not initialized yet there."""
+        handler is not initialized yet there. For a connection accepted on a
+        Unix-domain socket, this is a tuple of the path the peer is bound to,
+        usually empty, and None."""
 
         return self._request_handler.client_address
     remote_addr = property(get_remote_addr)
@@ -227,7 +400,11 @@ class _StandaloneConnection(object):
     def write(self, data):
         """Mimic mp_conn.write()."""
 
-        return self._request_handler.wfile.write(data)
+        self._write_lock.acquire()
+        try:
+            return self._request_handler.wfile.write(data)
+        finally:
+            self._write_lock.release()
 
     def read(self, length):
         """Mimic mp_conn.read()."""
@@ -239,6 +416,27 @@ class _StandaloneConnection(object):
 
         return self._request_handler.rfile.get_memorized_lines()
 
+    def set_tcp_nodelay(self, enabled):
+        """Enables or disables TCP_NODELAY on the connection, overriding
+        the --tcp-nodelay option of the server. Does nothing on Unix-domain
+        sockets.
+        """
+
+        if _is_unix_address(self._request_handler.client_address):
+            return
+        self._request_handler.connection.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, int(enabled))
+
+    def get_tcp_nodelay(self):
+        """Returns whether TCP_NODELAY is enabled on the connection.
+        Returns False on Unix-domain sockets.
+        """
+
+        if _is_unix_address(self._request_handler.client_address):
+            return False
+        return bool(self._request_handler.connection.getsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY))
+
 
 class _StandaloneRequest(object):
     """Mimic mod_python request."""
@@ -415,6 +613,14 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
         self.request_queue_size = options.request_queue_size
         self.__ws_is_shut_down = threading.Event()
         self.__ws_serving = False
+        self._handler_pool = None
+
+        # Requests of open WebSocket connections, and those of them to send
+        # a closing handshake to while draining.
+        self._websocket_requests = set()
+        self._websocket_requests_condition = threading.Condition()
+        self._draining = False
+        self._requests_to_drain = collections.deque()
 
         SocketServer.BaseServer.__init__(
             self, (options.server_host, options.port), WebSocketRequestHandler)
@@ -423,6 +629,10 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
         # it with websocket_ prefix to avoid conflict.
         self.websocket_server_options = options
 
+        self._tls_context = None
+        if options.use_tls:
+            self._tls_context = self._create_tls_context()
+
         self._create_sockets()
         self.server_bind()
         self.server_activate()
@@ -430,6 +640,21 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     def _create_sockets(self):
         self.server_name, self.server_port = self.server_address
         self._sockets = []
+        self._inherited_sockets = False
+        options = self.websocket_server_options
+        if options.listen_fds:
+            self._adopt_sockets(options.listen_fds)
+            # Sockets created again, e.g. by workers of --reuse-port, are
+            # bound anew.
+            options.listen_fds = []
+            return
+        for path in options.unix_sockets:
+            self._logger.info('Create socket on: %r', path)
+            self._sockets.append(
+                (socket.socket(socket.AF_UNIX, socket.SOCK_STREAM),
+                 (socket.AF_UNIX, socket.SOCK_STREAM, '', '', path)))
+        if not options.listen_tcp:
+            return
         if not self.server_name:
             # On platforms that doesn't support IPv6, the first bind fails.
             # On platforms that supports IPv6
@@ -455,32 +680,40 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
             except Exception, e:
                 self._logger.info('Skip by failure: %r', e)
                 continue
-            server_options = self.websocket_server_options
-            if server_options.use_tls:
-                # For the case of _HAS_OPEN_SSL, we do wrapper setup after
-                # accept.
-                if server_options.tls_module == _TLS_BY_STANDARD_MODULE:
-                    if server_options.tls_client_auth:
-                        if server_options.tls_client_cert_optional:
-                            client_cert_ = ssl.CERT_OPTIONAL
-                        else:
-                            client_cert_ = ssl.CERT_REQUIRED
-                    else:
-                        client_cert_ = ssl.CERT_NONE
-                    socket_ = ssl.wrap_socket(socket_,
-                        keyfile=server_options.private_key,
-                        certfile=server_options.certificate,
-                        ssl_version=ssl.PROTOCOL_SSLv23,
-                        ca_certs=server_options.tls_client_ca,
-                        cert_reqs=client_cert_,
-                        do_handshake_on_connect=False)
             self._sockets.append((socket_, addrinfo))
 
+    def _adopt_sockets(self, listen_fds):
+        """Serves the listening sockets inherited from the server which
+        started this process on SIGUSR2, or passed by systemd, instead of
+        binding new ones.
+
+        Args:
+            listen_fds: list of (file descriptor, address family) pairs.
+        """
+
+        for fd, family in listen_fds:
+            socket_ = socket.fromfd(fd, family, socket.SOCK_STREAM)
+            os.close(fd)
+            sockname = socket_.getsockname()
+            self._logger.info('Inherit socket on: %r', sockname)
+            self._sockets.append(
+                (socket_, (family, socket.SOCK_STREAM, '', '', sockname)))
+        self._inherited_sockets = True
+        for socket_, addrinfo in self._sockets:
+            if addrinfo[0] != socket.AF_UNIX:
+                self.server_port = socket_.getsockname()[1]
+                self.server_address = (self.server_name, self.server_port)
+                break
+
     def server_bind(self):
         """Override SocketServer.TCPServer.server_bind to enable multiple
         sockets bind.
         """
 
+        if self._inherited_sockets:
+            # Already bound by the server which passed them.
+            return
+
         failed_sockets = []
 
         for socketinfo in self._sockets:
@@ -488,6 +721,17 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
             self._logger.info('Bind on: %r', addrinfo)
             if self.allow_reuse_address:
                 socket_.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.websocket_server_options.reuse_port:
+                socket_.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self._set_socket_options(socket_, listening=True)
+            if addrinfo[0] == socket.AF_UNIX:
+                try:
+                    self._bind_unix_socket(socket_, addrinfo[4])
+                except Exception, e:
+                    self._logger.info('Skip by failure: %r', e)
+                    socket_.close()
+                    failed_sockets.append(socketinfo)
+                continue
             try:
                 socket_.bind(self.server_address)
             except Exception, e:
@@ -507,6 +751,20 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
         for socketinfo in failed_sockets:
             self._sockets.remove(socketinfo)
 
+    def _bind_unix_socket(self, socket_, path):
+        """Binds socket_ to path, removing the socket file left by a server
+        which exited before. The file isn't removed on close as a server
+        started on SIGUSR2 may still be serving it.
+        """
+
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        socket_.bind(path)
+
     def server_activate(self):
         """Override SocketServer.TCPServer.server_activate to enable multiple
         sockets listen.
@@ -541,6 +799,61 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
             self._logger.info('Close on: %r', addrinfo)
             socket_.close()
 
+    def _set_socket_options(self, socket_, listening=False):
+        """Applies the TCP tuning options to socket_. Only the buffer sizes
+        are applied to Unix-domain sockets.
+
+        Args:
+            socket_: a listening socket or an accepted connection.
+            listening: True if socket_ is a listening socket. The buffer
+                sizes are set before listen() so that the TCP window scale
+                of accepted connections is negotiated for them.
+        """
+
+        options = self.websocket_server_options
+        if options.send_buffer_size > 0:
+            socket_.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                               options.send_buffer_size)
+        if options.receive_buffer_size > 0:
+            socket_.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                               options.receive_buffer_size)
+        if socket_.family == socket.AF_UNIX:
+            # The other options are of TCP.
+            return
+        if options.tcp_nodelay:
+            socket_.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if options.tcp_keepalive:
+            socket_.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if options.tcp_keepalive_idle > 0:
+                socket_.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                                   options.tcp_keepalive_idle)
+            if options.tcp_keepalive_interval > 0:
+                socket_.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                                   options.tcp_keepalive_interval)
+            if options.tcp_keepalive_count > 0:
+                socket_.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT,
+                                   options.tcp_keepalive_count)
+        if listening and options.tcp_defer_accept > 0:
+            socket_.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT,
+                               options.tcp_defer_accept)
+
+    def _set_accepted_socket_options(self, socket_, client_address):
+        """Applies the TCP tuning options to an accepted connection.
+
+        Options are inherited from the listening socket on some platforms
+        only. Returns False and closes socket_ if the connection has already
+        been reset.
+        """
+
+        try:
+            self._set_socket_options(socket_)
+        except socket.error, e:
+            self._logger.debug('Failed to set options of %r: %s',
+                               client_address, e)
+            self.shutdown_request(socket_)
+            return False
+        return True
+
     def fileno(self):
         """Override SocketServer.TCPServer.fileno."""
 
@@ -556,102 +869,405 @@ class WebSocketServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
             util.get_stack_trace())
         # Note: client_address is a tuple.
 
-    def get_request(self):
-        """Override TCPServer.get_request to wrap OpenSSL.SSL.Connection
-        object with _StandaloneSSLConnection to provide makefile method. We
-        cannot substitute OpenSSL.SSL.Connection.makefile since it's readonly
-        attribute.
-        """
+    def _get_tls_client_cert_requirement(self):
+        options = self.websocket_server_options
+        if not options.tls_client_auth:
+            return ssl.CERT_NONE
+        if options.tls_client_cert_optional:
+            return ssl.CERT_OPTIONAL
+        return ssl.CERT_REQUIRED
 
-        accepted_socket, client_address = self.socket.accept()
+    def _create_tls_context(self):
+        """Creates the TLS context shared by all connections so that the key
+        and the certificate are loaded only once and sessions established on
+        one connection can be resumed on another.
+        """
 
-        server_options = self.websocket_server_options
-        if server_options.use_tls:
-            if server_options.tls_module == _TLS_BY_STANDARD_MODULE:
-                try:
-                    accepted_socket.do_handshake()
-                except ssl.SSLError, e:
-                    self._logger.debug('%r', e)
-                    raise
+        options = self.websocket_server_options
+        if options.tls_module == _TLS_BY_STANDARD_MODULE:
+            if not hasattr(ssl, 'SSLContext'):
+                # Python older than 2.7.9. _do_tls_handshake loads the key and
+                # the certificate for each connection.
+                return None
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.load_cert_chain(options.certificate, options.private_key)
+            context.verify_mode = self._get_tls_client_cert_requirement()
+            if options.tls_client_ca:
+                context.load_verify_locations(options.tls_client_ca)
+            # OpenSSL caches sessions on the server side and issues session
+            # tickets by default.
+            return context
+        elif options.tls_module == _TLS_BY_PYOPENSSL:
+            context = OpenSSL.SSL.Context(OpenSSL.SSL.SSLv23_METHOD)
+            context.use_privatekey_file(options.private_key)
+            context.use_certificate_file(options.certificate)
+
+            def default_callback(conn, cert, errnum, errdepth, ok):
+                return ok == 1
+
+            # See the OpenSSL document for SSL_CTX_set_verify.
+            if options.tls_client_auth:
+                verify_mode = OpenSSL.SSL.VERIFY_PEER
+                if not options.tls_client_cert_optional:
+                    verify_mode |= OpenSSL.SSL.VERIFY_FAIL_IF_NO_PEER_CERT
+                context.set_verify(verify_mode, default_callback)
+                context.load_verify_locations(options.tls_client_ca, None)
+            else:
+                context.set_verify(OpenSSL.SSL.VERIFY_NONE, default_callback)
 
-                # Print cipher in use. Handshake is done on accept.
-                self._logger.debug('Cipher: %s', accepted_socket.cipher())
-                self._logger.debug('Client cert: %r',
-                                   accepted_socket.getpeercert())
-            elif server_options.tls_module == _TLS_BY_PYOPENSSL:
-                # We cannot print the cipher in use. pyOpenSSL doesn't provide
-                # any method to fetch that.
-
-                ctx = OpenSSL.SSL.Context(OpenSSL.SSL.SSLv23_METHOD)
-                ctx.use_privatekey_file(server_options.private_key)
-                ctx.use_certificate_file(server_options.certificate)
-
-                def default_callback(conn, cert, errnum, errdepth, ok):
-                    return ok == 1
-
-                # See the OpenSSL document for SSL_CTX_set_verify.
-                if server_options.tls_client_auth:
-                    verify_mode = OpenSSL.SSL.VERIFY_PEER
-                    if not server_options.tls_client_cert_optional:
-                        verify_mode |= OpenSSL.SSL.VERIFY_FAIL_IF_NO_PEER_CERT
-                    ctx.set_verify(verify_mode, default_callback)
-                    ctx.load_verify_locations(server_options.tls_client_ca,
-                                              None)
-                else:
-                    ctx.set_verify(OpenSSL.SSL.VERIFY_NONE, default_callback)
+            context.set_session_cache_mode(OpenSSL.SSL.SESS_CACHE_SERVER)
+            context.set_session_id(_TLS_SESSION_ID_CONTEXT)
+            return context
+        else:
+            raise ValueError('No TLS support module is available')
 
-                accepted_socket = OpenSSL.SSL.Connection(ctx, accepted_socket)
-                accepted_socket.set_accept_state()
+    def _do_tls_handshake(self, accepted_socket):
+        """Runs the TLS handshake on accepted_socket and returns the socket
+        wrapped for TLS. Raises socket.error when the handshake fails or
+        doesn't complete within --tls-handshake-timeout seconds.
+        """
 
+        server_options = self.websocket_server_options
+        timeout = server_options.tls_handshake_timeout
+        if server_options.tls_module == _TLS_BY_STANDARD_MODULE:
+            if self._tls_context is not None:
+                accepted_socket = self._tls_context.wrap_socket(
+                    accepted_socket, server_side=True,
+                    do_handshake_on_connect=False)
+            else:
+                accepted_socket = ssl.wrap_socket(accepted_socket,
+                    keyfile=server_options.private_key,
+                    certfile=server_options.certificate,
+                    server_side=True,
+                    ssl_version=ssl.PROTOCOL_SSLv23,
+                    ca_certs=server_options.tls_client_ca,
+                    cert_reqs=self._get_tls_client_cert_requirement(),
+                    do_handshake_on_connect=False)
+            accepted_socket.settimeout(timeout)
+            try:
+                accepted_socket.do_handshake()
+            except ssl.SSLError, e:
+                self._logger.debug('%r', e)
+                raise
+            accepted_socket.settimeout(None)
+
+            self._logger.debug('Cipher: %s', accepted_socket.cipher())
+            self._logger.debug('Client cert: %r',
+                               accepted_socket.getpeercert())
+        elif server_options.tls_module == _TLS_BY_PYOPENSSL:
+            # We cannot print the cipher in use. pyOpenSSL doesn't provide
+            # any method to fetch that.
+
+            connection = OpenSSL.SSL.Connection(
+                self._tls_context, accepted_socket)
+            connection.set_accept_state()
+
+            # pyOpenSSL doesn't support socket timeouts. Run the handshake on
+            # the non-blocking socket and wait for it by select.
+            accepted_socket.setblocking(0)
+            deadline = time.time() + timeout
+            while True:
                 # Convert SSL related error into socket.error so that
-                # SocketServer ignores them and keeps running.
+                # the caller handles them as network errors.
                 #
                 # TODO(tyoshino): Convert all kinds of errors.
                 try:
-                    accepted_socket.do_handshake()
+                    connection.do_handshake()
+                    break
+                except OpenSSL.SSL.WantReadError, e:
+                    waiting_for = ([accepted_socket], [])
+                except OpenSSL.SSL.WantWriteError, e:
+                    waiting_for = ([], [accepted_socket])
                 except OpenSSL.SSL.Error, e:
                     # Set errno part to 1 (SSL_ERROR_SSL) like the ssl module
                     # does.
                     self._logger.debug('%r', e)
                     raise socket.error(1, '%r' % e)
-                cert = accepted_socket.get_peer_certificate()
-                if cert is not None:
-                    self._logger.debug('Client cert subject: %r',
-                                       cert.get_subject().get_components())
-                accepted_socket = _StandaloneSSLConnection(accepted_socket)
-            else:
-                raise ValueError('No TLS support module is available')
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout('TLS handshake timed out')
+                select.select(waiting_for[0], waiting_for[1], [], remaining)
+            accepted_socket.setblocking(1)
+
+            cert = connection.get_peer_certificate()
+            if cert is not None:
+                self._logger.debug('Client cert subject: %r',
+                                   cert.get_subject().get_components())
+            accepted_socket = _StandaloneSSLConnection(connection)
+        else:
+            raise ValueError('No TLS support module is available')
+
+        return accepted_socket
+
+    def process_request_thread(self, request, client_address):
+        """Override SocketServer.ThreadingMixIn.process_request_thread to run
+        the TLS handshake on the thread of the request instead of the thread
+        accepting connections, and to time out reading the request header so
+        that silent connections don't hold threads. WebSocketRequestHandler
+        clears the timeout once the opening handshake completes.
+        """
+
+        server_options = self.websocket_server_options
+        if server_options.use_tls:
+            try:
+                request = self._do_tls_handshake(request)
+            except socket.error, e:
+                self._logger.debug('TLS handshake with %r failed: %s',
+                                   client_address, e)
+                self.shutdown_request(request)
+                return
+            except Exception, e:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+                return
+        # pyOpenSSL doesn't support socket timeouts.
+        if (server_options.request_header_timeout > 0 and
+            server_options.tls_module != _TLS_BY_PYOPENSSL):
+            request.settimeout(server_options.request_header_timeout)
+
+        SocketServer.ThreadingMixIn.process_request_thread(
+            self, request, client_address)
+
+    def process_request(self, request, client_address):
+        """Override SocketServer.ThreadingMixIn.process_request to run the
+        request on the handler thread pool if --handler-threads is given.
+
+        When the pool already has --handler-queue-size requests waiting for a
+        thread, the request is rejected with a 503 response.
+        """
+
+        if self._handler_pool is None:
+            SocketServer.ThreadingMixIn.process_request(
+                self, request, client_address)
+            return
+
+        job = self._handler_pool.try_submit(
+            self.process_request_thread, request, client_address)
+        if job is not None:
+            return
+
+        self._logger.info('Rejected request from %r: %d requests queued',
+                          client_address,
+                          self._handler_pool.get_queued_count())
+        if self.websocket_server_options.use_tls:
+            # Just close the connection rather than spending a TLS handshake
+            # on it.
+            self.shutdown_request(request)
+            return
+        try:
+            request.sendall('HTTP/1.1 %d %s\r\n'
+                            'Retry-After: %d\r\n'
+                            'Content-Length: 0\r\n'
+                            'Connection: close\r\n'
+                            '\r\n' %
+                            (common.HTTP_STATUS_SERVICE_UNAVAILABLE,
+                             httplib.responses[
+                                 common.HTTP_STATUS_SERVICE_UNAVAILABLE],
+                             _HANDLER_RETRY_AFTER_IN_SEC))
+        except socket.error, e:
+            self._logger.debug('Failed to send 503 response: %s', e)
+        self.shutdown_request(request)
+
+    def get_handler_thread_counts(self):
+        """Returns a tuple of the numbers of requests being run, waiting for a
+        thread and rejected so far by the handler thread pool, or None if
+        each request gets its own thread.
+        """
 
-        return accepted_socket, client_address
+        if self._handler_pool is None:
+            return None
+        return (self._handler_pool.get_active_count(),
+                self._handler_pool.get_queued_count(),
+                self._handler_pool.get_rejected_count())
 
     def serve_forever(self, poll_interval=0.5):
         """Override SocketServer.BaseServer.serve_forever."""
 
+        options = self.websocket_server_options
+        if options.handler_threads > 0 and self._handler_pool is None:
+            # Created here rather than in the constructor so that worker
+            # processes started by --processes get their own threads.
+            self._handler_pool = util.WorkerPool(
+                options.handler_threads, name='HandlerThread',
+                max_queued_jobs=options.handler_queue_size)
+
         self.__ws_serving = True
         self.__ws_is_shut_down.clear()
-        handle_request = self.handle_request
-        if hasattr(self, '_handle_request_noblock'):
-            handle_request = self._handle_request_noblock
-        else:
-            self._logger.warning('Fallback to blocking request handler')
+
+        listening_sockets = {}
+        for socket_, addrinfo in self._sockets:
+            socket_.setblocking(0)
+            listening_sockets[socket_.fileno()] = socket_
+        epoll = None
+        if hasattr(select, 'epoll'):
+            epoll = select.epoll()
+            for fileno in listening_sockets:
+                epoll.register(fileno, select.EPOLLIN)
         try:
             while self.__ws_serving:
-                r, w, e = select.select(
-                    [socket_[0] for socket_ in self._sockets],
-                    [], [], poll_interval)
-                for socket_ in r:
-                    self.socket = socket_
-                    handle_request()
-                self.socket = None
+                try:
+                    if epoll is not None:
+                        ready = [fileno for fileno, unused_event
+                                 in epoll.poll(poll_interval)]
+                    else:
+                        ready, unused_w, unused_e = select.select(
+                            listening_sockets.keys(), [], [], poll_interval)
+                except (IOError, select.error), e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fileno in ready:
+                    self._accept(listening_sockets[fileno])
+            if self._draining:
+                self._drain_connections()
         finally:
+            if epoll is not None:
+                epoll.close()
+            if self._handler_pool is not None:
+                # Handlers still running keep their threads until they
+                # return.
+                self._handler_pool.shutdown(wait=False)
+                self._handler_pool = None
             self.__ws_is_shut_down.set()
 
+    def _accept(self, listening_socket):
+        """Accepts connections on the non-blocking listening_socket until
+        none is left, so that a burst of connections doesn't wait in the
+        backlog for further readiness events, and processes them.
+        """
+
+        while True:
+            try:
+                request, client_address = listening_socket.accept()
+            except socket.error, e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                if not _is_would_block(e):
+                    self._logger.warning('Failed to accept: %s', e)
+                return
+            client_address = _get_client_address(request, client_address)
+            # Accepted sockets inherit O_NONBLOCK on some platforms.
+            request.setblocking(1)
+            if not self._set_accepted_socket_options(request, client_address):
+                continue
+            if not self.verify_request(request, client_address):
+                self.shutdown_request(request)
+                continue
+            try:
+                self.process_request(request, client_address)
+            except Exception, e:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+
     def shutdown(self):
         """Override SocketServer.BaseServer.shutdown."""
 
         self.__ws_serving = False
         self.__ws_is_shut_down.wait()
 
+    def drain(self):
+        """Stops accepting connections like shutdown, but serve_forever
+        closes the listening sockets and sends a closing handshake with
+        status 1001 (going away) to the open WebSocket connections, at most
+        --drain-rate per second, before it returns. It returns when all of
+        them have been closed or --drain-timeout seconds have passed. Blocks
+        until serve_forever returns.
+        """
+
+        self._websocket_requests_condition.acquire()
+        try:
+            self._draining = True
+            self._requests_to_drain.extend(self._websocket_requests)
+        finally:
+            self._websocket_requests_condition.release()
+        self.shutdown()
+
+    def add_websocket_request(self, request):
+        """Tracks the request of a WebSocket connection whose opening
+        handshake has completed so that drain can close it.
+        """
+
+        self._websocket_requests_condition.acquire()
+        try:
+            self._websocket_requests.add(request)
+            if self._draining:
+                self._requests_to_drain.append(request)
+            self._websocket_requests_condition.notify()
+        finally:
+            self._websocket_requests_condition.release()
+
+    def remove_websocket_request(self, request):
+        """Stops tracking the request of a closed WebSocket connection."""
+
+        self._websocket_requests_condition.acquire()
+        try:
+            self._websocket_requests.discard(request)
+            self._websocket_requests_condition.notify()
+        finally:
+            self._websocket_requests_condition.release()
+
+    def get_websocket_connection_count(self):
+        """Returns the number of open WebSocket connections."""
+
+        self._websocket_requests_condition.acquire()
+        try:
+            return len(self._websocket_requests)
+        finally:
+            self._websocket_requests_condition.release()
+
+    def _drain_connections(self):
+        options = self.websocket_server_options
+
+        # Let other processes sharing the sockets, e.g. a server started on
+        # SIGUSR2, accept the connections queued on them.
+        self.server_close()
+
+        deadline = time.time() + options.drain_timeout
+        interval = 0
+        if options.drain_rate > 0:
+            interval = 1.0 / options.drain_rate
+        self._logger.info('Draining %d connections',
+                          self.get_websocket_connection_count())
+
+        self._websocket_requests_condition.acquire()
+        try:
+            while self._websocket_requests:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    # Connections are left open without --drain-timeout.
+                    if options.drain_timeout > 0:
+                        self._logger.warning(
+                            '%d connections are still open after draining '
+                            'for %r seconds', len(self._websocket_requests),
+                            options.drain_timeout)
+                    return
+                if not self._requests_to_drain:
+                    # Wait for closing handshakes to complete.
+                    self._websocket_requests_condition.wait(remaining)
+                    continue
+                request = self._requests_to_drain.popleft()
+                if request not in self._websocket_requests:
+                    continue
+                self._websocket_requests_condition.release()
+                try:
+                    self._close_websocket_request(request)
+                    time.sleep(min(interval, remaining))
+                finally:
+                    self._websocket_requests_condition.acquire()
+        finally:
+            self._websocket_requests_condition.release()
+
+    def _close_websocket_request(self, request):
+        # Streams of the older protocols wait for the response on close,
+        # which would race with the handler. They are closed on exit.
+        if not isinstance(request.ws_stream, stream.Stream):
+            return
+        try:
+            request.ws_stream.close_connection(common.STATUS_GOING_AWAY)
+        except Exception, e:
+            self._logger.debug('Failed to close connection to %r: %s',
+                               request.connection.remote_addr, e)
+
 
 class WebSocketRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
     """CGIHTTPRequestHandler specialized for WebSocket."""
@@ -816,18 +1432,40 @@ class WebSocketRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
                 self.send_error(e.status)
                 return False
 
-            request._dispatcher = self._options.dispatcher
-            self._options.dispatcher.transfer_data(request)
+            # Handlers may wait for messages as long as they like.
+            self.connection.settimeout(None)
+            self._transfer_data(request)
         except handshake.AbortedByUserException, e:
             self._logger.info('Aborted: %s', e)
         return False
 
+    def _transfer_data(self, request):
+        """Runs the WebSocket handler for request whose opening handshake has
+        completed.
+        """
+
+        request._dispatcher = self._options.dispatcher
+        self.server.add_websocket_request(request)
+        try:
+            self._options.dispatcher.transfer_data(request)
+        finally:
+            self.server.remove_websocket_request(request)
+
     def log_request(self, code='-', size='-'):
         """Override BaseHTTPServer.log_request."""
 
         self._logger.info('"%s" %s %s',
                           self.requestline, str(code), str(size))
 
+    def address_string(self):
+        """Override BaseHTTPServer.address_string not to resolve the path
+        of a Unix-domain socket as a host name.
+        """
+
+        if _is_unix_address(self.client_address):
+            return self.client_address[0] or 'unix'
+        return BaseHTTPServer.BaseHTTPRequestHandler.address_string(self)
+
     def log_error(self, *args):
         """Override BaseHTTPServer.log_error."""
 
@@ -861,145 +1499,1490 @@ class WebSocketRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
         return False
 
 
-def _get_logger_from_class(c):
-    return logging.getLogger('%s.%s' % (c.__module__, c.__name__))
+class _NoDataAvailable(Exception):
+    """This exception will be raised when a stream of a connection served by
+    EpollWebSocketServer tries to read beyond the received complete frames.
+    """
 
+    pass
 
-def _configure_logging(options):
-    logging.addLevelName(common.LOGLEVEL_FINE, 'FINE')
 
-    logger = logging.getLogger()
-    logger.setLevel(logging.getLevelName(options.log_level.upper()))
-    if options.log_file:
-        handler = logging.handlers.RotatingFileHandler(
-                options.log_file, 'a', options.log_max, options.log_count)
-    else:
-        handler = logging.StreamHandler()
-    formatter = logging.Formatter(
-            '[%(asctime)s] [%(levelname)s] %(name)s: %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+def _scan_frames(data):
+    """Finds the complete WebSocket frames at the head of data.
 
-    deflate_log_level_name = logging.getLevelName(
-        options.deflate_log_level.upper())
-    _get_logger_from_class(util._Deflater).setLevel(
-        deflate_log_level_name)
-    _get_logger_from_class(util._Inflater).setLevel(
-        deflate_log_level_name)
+    Returns:
+        a tuple of the end of the complete frames and the length data needs
+        to complete the next frame. When the header of the next frame is
+        incomplete, the latter is the length needed to complete the header.
+    """
 
+    position = 0
+    while True:
+        header_length = 2
+        if len(data) < position + header_length:
+            return position, position + header_length
+        second_byte = ord(data[position + 1])
+        payload_length = second_byte & 0x7f
+        if payload_length == 126:
+            header_length += 2
+        elif payload_length == 127:
+            header_length += 8
+        if second_byte & 0x80:
+            header_length += 4
+        if len(data) < position + header_length:
+            return position, position + header_length
+        if payload_length == 126:
+            payload_length = struct.unpack_from('!H', data, position + 2)[0]
+        elif payload_length == 127:
+            payload_length = struct.unpack_from('!Q', data, position + 2)[0]
+        frame_end = position + header_length + payload_length
+        if len(data) < frame_end:
+            return position, frame_end
+        position = frame_end
+
+
+def _is_would_block(e):
+    return e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def _get_client_address(socket_, client_address):
+    """Returns client_address returned by accept() on socket_ as a (host,
+    port) tuple, which BaseHTTPServer and handlers expect. The address of a
+    Unix-domain socket, a path, is paired with None as the port.
+    """
 
-def _build_option_parser():
-    parser = optparse.OptionParser()
+    if socket_.family == socket.AF_UNIX:
+        return (client_address, None)
+    return client_address
 
-    parser.add_option('--config', dest='config_file', type='string',
-                      default=None,
-                      help=('Path to configuration file. See the file comment '
-                            'at the top of this file for the configuration '
-                            'file format'))
-    parser.add_option('-H', '--server-host', '--server_host',
-                      dest='server_host',
-                      default='',
-                      help='server hostname to listen to')
-    parser.add_option('-V', '--validation-host', '--validation_host',
-                      dest='validation_host',
-                      default=None,
-                      help='server hostname to validate in absolute path.')
-    parser.add_option('-p', '--port', dest='port', type='int',
-                      default=common.DEFAULT_WEB_SOCKET_PORT,
-                      help='port to listen to')
-    parser.add_option('-P', '--validation-port', '--validation_port',
-                      dest='validation_port', type='int',
-                      default=None,
-                      help='server port to validate in absolute path.')
-    parser.add_option('-w', '--websock-handlers', '--websock_handlers',
-                      dest='websock_handlers',
-                      default='.',
-                      help=('The root directory of WebSocket handler files. '
-                            'If the path is relative, --document-root is used '
-                            'as the base.'))
-    parser.add_option('-m', '--websock-handlers-map-file',
-                      '--websock_handlers_map_file',
-                      dest='websock_handlers_map_file',
-                      default=None,
-                      help=('WebSocket handlers map file. '
-                            'Each line consists of alias_resource_path and '
-                            'existing_resource_path, separated by spaces.'))
-    parser.add_option('-s', '--scan-dir', '--scan_dir', dest='scan_dir',
-                      default=None,
-                      help=('Must be a directory under --websock-handlers. '
-                            'Only handlers under this directory are scanned '
-                            'and registered to the server. '
-                            'Useful for saving scan time when the handler '
-                            'root directory contains lots of files that are '
-                            'not handler file or are handler files but you '
-                            'don\'t want them to be registered. '))
-    parser.add_option('--allow-handlers-outside-root-dir',
-                      '--allow_handlers_outside_root_dir',
-                      dest='allow_handlers_outside_root_dir',
-                      action='store_true',
-                      default=False,
-                      help=('Scans WebSocket handlers even if their canonical '
-                            'path is not under --websock-handlers.'))
-    parser.add_option('-d', '--document-root', '--document_root',
-                      dest='document_root', default='.',
-                      help='Document root directory.')
-    parser.add_option('-x', '--cgi-paths', '--cgi_paths', dest='cgi_paths',
-                      default=None,
-                      help=('CGI paths relative to document_root.'
-                            'Comma-separated. (e.g -x /cgi,/htbin) '
-                            'Files under document_root/cgi_path are handled '
-                            'as CGI programs. Must be executable.'))
-    parser.add_option('-t', '--tls', dest='use_tls', action='store_true',
-                      default=False, help='use TLS (wss://)')
-    parser.add_option('--tls-module', '--tls_module', dest='tls_module',
-                      type='choice',
-                      choices = [_TLS_BY_STANDARD_MODULE, _TLS_BY_PYOPENSSL],
-                      help='Use ssl module if "%s" is specified. '
-                      'Use pyOpenSSL module if "%s" is specified' %
-                      (_TLS_BY_STANDARD_MODULE, _TLS_BY_PYOPENSSL))
-    parser.add_option('-k', '--private-key', '--private_key',
-                      dest='private_key',
-                      default='', help='TLS private key file.')
-    parser.add_option('-c', '--certificate', dest='certificate',
-                      default='', help='TLS certificate file.')
-    parser.add_option('--tls-client-auth', dest='tls_client_auth',
-                      action='store_true', default=False,
-                      help='Requests TLS client auth on every connection.')
-    parser.add_option('--tls-client-cert-optional',
-                      dest='tls_client_cert_optional',
-                      action='store_true', default=False,
-                      help=('Makes client certificate optional even though '
-                            'TLS client auth is enabled.'))
-    parser.add_option('--tls-client-ca', dest='tls_client_ca', default='',
-                      help=('Specifies a pem file which contains a set of '
-                            'concatenated CA certificates which are used to '
-                            'validate certificates passed from clients'))
-    parser.add_option('--basic-auth', dest='use_basic_auth',
-                      action='store_true', default=False,
-                      help='Requires Basic authentication.')
-    parser.add_option('--basic-auth-credential',
-                      dest='basic_auth_credential', default='test:test',
-                      help='Specifies the credential of basic authentication '
-                      'by username:password pair (e.g. test:test).')
-    parser.add_option('-l', '--log-file', '--log_file', dest='log_file',
-                      default='', help='Log file.')
-    # Custom log level:
-    # - FINE: Prints status of each frame processing step
-    parser.add_option('--log-level', '--log_level', type='choice',
-                      dest='log_level', default='warn',
-                      choices=['fine',
-                               'debug', 'info', 'warning', 'warn', 'error',
-                               'critical'],
-                      help='Log level.')
-    parser.add_option('--deflate-log-level', '--deflate_log_level',
-                      type='choice',
-                      dest='deflate_log_level', default='warn',
-                      choices=['debug', 'info', 'warning', 'warn', 'error',
-                               'critical'],
-                      help='Log level for _Deflater and _Inflater.')
-    parser.add_option('--thread-monitor-interval-in-sec',
-                      '--thread_monitor_interval_in_sec',
-                      dest='thread_monitor_interval_in_sec',
+
+def _is_unix_address(address):
+    """Tests whether address returned by _get_client_address is of a
+    Unix-domain socket.
+    """
+
+    return address[1] is None
+
+
+class _PrefixedFile(object):
+    """Wraps a file and returns the given bytes before reading from the
+    wrapped file.
+    """
+
+    def __init__(self, prefix, file_):
+        self._prefix = prefix
+        self._file = file_
+
+    def __getattribute__(self, name):
+        if name in ('_prefix', '_file', 'readline', 'read'):
+            return object.__getattribute__(self, name)
+        return self._file.__getattribute__(name)
+
+    def readline(self, size=-1):
+        if not self._prefix:
+            return self._file.readline(size)
+        end = self._prefix.find('\n') + 1
+        if end == 0:
+            line = self._prefix + self._file.readline()
+            self._prefix = ''
+        else:
+            line = self._prefix[:end]
+            self._prefix = self._prefix[end:]
+        if size >= 0 and size < len(line):
+            self._prefix = line[size:] + self._prefix
+            line = line[:size]
+        return line
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self._prefix + self._file.read()
+            self._prefix = ''
+            return data
+        data = self._prefix[:size]
+        self._prefix = self._prefix[size:]
+        if len(data) < size:
+            data += self._file.read(size - len(data))
+        return data
+
+
+class _OpeningHandshakeConnection(object):
+    """Waits on a _Selector until the header of an opening handshake request
+    has been received, then passes the connection to the server.
+
+    The received bytes are peeked at so that bytes following the header are
+    left in the socket. Add this to the selector with EPOLLET to be notified
+    only when more bytes arrive, and with a deadline to close connections
+    which don't send the header in time.
+    """
+
+    def __init__(self, server, selector, socket_, client_address):
+        self._logger = util.get_class_logger(self)
+
+        self._server = server
+        self._selector = selector
+        self._socket = socket_
+        self._client_address = client_address
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def handle_read(self):
+        try:
+            received = self._socket.recv(_MAX_OPENING_HANDSHAKE_SIZE,
+                                         socket.MSG_PEEK)
+        except socket.error, e:
+            if _is_would_block(e):
+                return
+            received = ''
+        if not received:
+            self.close()
+            return
+
+        end = received.find('\r\n\r\n')
+        if end < 0:
+            if len(received) >= _MAX_OPENING_HANDSHAKE_SIZE:
+                self._selector.remove(self)
+                self._server.shutdown_request(self._socket)
+            return
+
+        self._selector.remove(self)
+        self._socket.setblocking(1)
+        header = self._socket.recv(end + 4)
+        self._server.process_opening_handshake(
+            self._socket, self._client_address, header)
+
+    def handle_write(self):
+        pass
+
+    def handle_timeout(self):
+        self._logger.debug('Opening handshake request from %r timed out',
+                           self._client_address)
+        self.close()
+
+    def close(self):
+        self._selector.remove(self)
+        self._socket.close()
+
+
+class _EventLoopConnection(object):
+    """Mimic mod_python mp_conn for a WebSocket connection whose frames are
+    read and written by a _Selector.
+
+    read() returns only bytes of the complete frames received so far and
+    raises _NoDataAvailable at the end of them. Messages parsed by the stream
+    of the request are passed to receive_message_handler one by one on the
+    worker pool. write() sends as much as the socket accepts and queues the
+    rest to be sent by the selector. Once more than write_buffer_size bytes
+    are queued, write() called by a handler waits until the peer reads them.
+    close_handler, if not None, is called with the request when the socket
+    is closed. terminate_handler, if not None, is called without arguments
+    on the worker pool after the handler calls queued before it when the
+    socket is closed before the closing handshake of the client is received.
+    """
+
+    def __init__(self, selector, worker_pool, socket_, request,
+                 receive_message_handler, close_handler=None,
+                 write_buffer_size=_DEFAULT_EVENT_LOOP_WRITE_BUFFER_SIZE,
+                 terminate_handler=None):
+        self._logger = util.get_class_logger(self)
+
+        self._selector = selector
+        self._worker_pool = worker_pool
+        self._socket = socket_
+        self._request = request
+        self._receive_message_handler = receive_message_handler
+        self._close_handler = close_handler
+        self._terminate_handler = terminate_handler
+
+        self.local_addr = request.connection.local_addr
+        self.remote_addr = request.connection.remote_addr
+
+        # Received bytes not parsed yet.
+        self._chunks = []
+        self._chunks_length = 0
+        # The number of bytes needed before parsing again.
+        self._wanted_length = 0
+        # Bytes being parsed by the stream and the range of the complete
+        # frames in them.
+        self._data = ''
+        self._position = 0
+        self._limit = 0
+
+        self._write_lock = threading.Lock()
+        # Notified when queued bytes are sent or the connection is closed.
+        self._write_condition = threading.Condition(self._write_lock)
+        self._write_buffer = collections.deque()
+        self._write_buffer_length = 0
+        self._write_buffer_size = write_buffer_size
+        self._registered = False
+        self._closed = False
+        self._close_when_flushed = False
+
+        # Handler calls to run on the worker pool in order.
+        self._jobs_lock = threading.Lock()
+        self._jobs = collections.deque()
+        self._running_jobs = False
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def register(self):
+        """Adds this connection to the selector."""
+
+        self._write_lock.acquire()
+        try:
+            eventmask = select.EPOLLIN
+            if self._write_buffer:
+                eventmask |= select.EPOLLOUT
+            self._selector.add(self, eventmask)
+            self._registered = True
+        finally:
+            self._write_lock.release()
+
+    def read(self, length):
+        """Mimic mp_conn.read()."""
+
+        if (threading.currentThread() is not self._selector or
+            self._position + length > self._limit):
+            raise _NoDataAvailable()
+        data = self._data[self._position:self._position + length]
+        self._position += length
+        return data
+
+    def write(self, data):
+        """Mimic mp_conn.write()."""
+
+        self._write_lock.acquire()
+        try:
+            if self._closed:
+                raise socket.error(errno.EPIPE, 'Connection closed')
+            if not self._write_buffer:
+                try:
+                    sent = self._socket.send(data)
+                except socket.error, e:
+                    if not _is_would_block(e):
+                        raise
+                    sent = 0
+                if sent == len(data):
+                    return
+                data = data[sent:]
+                if self._registered:
+                    self._selector.modify(
+                        self, select.EPOLLIN | select.EPOLLOUT)
+            self._write_buffer.append(data)
+            self._write_buffer_length += len(data)
+            # The selector thread sends the queued bytes, so it must not wait
+            # for them.
+            if threading.currentThread() is not self._selector:
+                self._wait_for_write_buffer()
+        finally:
+            self._write_lock.release()
+
+    def _wait_for_write_buffer(self):
+        """Waits until at most write_buffer_size bytes are queued. Closes
+        the connection and raises socket.error if the peer doesn't read any
+        of them for _EVENT_LOOP_WRITE_STALL_TIMEOUT_IN_SEC seconds. Must be
+        called with _write_lock acquired.
+        """
+
+        while (not self._closed and
+               self._write_buffer_length > self._write_buffer_size):
+            length = self._write_buffer_length
+            self._write_condition.wait(_EVENT_LOOP_WRITE_STALL_TIMEOUT_IN_SEC)
+            if self._write_buffer_length == length and not self._closed:
+                self._logger.debug('Peer (%r) stopped reading',
+                                   (self.remote_addr,))
+                self._close()
+        if self._closed:
+            raise socket.error(errno.EPIPE, 'Connection closed')
+
+    def handle_read(self):
+        try:
+            data = self._socket.recv(_RECEIVE_BUFFER_SIZE)
+        except socket.error, e:
+            if _is_would_block(e):
+                return
+            data = ''
+        if not data:
+            self._logger.debug('Peer (%r) closed connection',
+                               (self.remote_addr,))
+            self.close()
+            return
+        if self._request.client_terminated:
+            return
+        self._chunks.append(data)
+        self._chunks_length += len(data)
+        self._parse()
+
+    def handle_write(self):
+        self._write_lock.acquire()
+        try:
+            while self._write_buffer:
+                data = self._write_buffer[0]
+                try:
+                    sent = self._socket.send(data)
+                except socket.error, e:
+                    if _is_would_block(e):
+                        return
+                    self._logger.debug('Failed to send to %r: %s',
+                                       (self.remote_addr,), e)
+                    self._close()
+                    return
+                self._write_buffer_length -= sent
+                self._write_condition.notifyAll()
+                if sent < len(data):
+                    self._write_buffer[0] = data[sent:]
+                    return
+                self._write_buffer.popleft()
+            if self._close_when_flushed:
+                self._close()
+            elif not self._closed:
+                self._selector.modify(self, select.EPOLLIN)
+        finally:
+            self._write_lock.release()
+
+    def set_tcp_nodelay(self, enabled):
+        """Mimic _StandaloneConnection.set_tcp_nodelay()."""
+
+        if self._socket.family == socket.AF_UNIX:
+            return
+        self._socket.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, int(enabled))
+
+    def get_tcp_nodelay(self):
+        """Mimic _StandaloneConnection.get_tcp_nodelay()."""
+
+        if self._socket.family == socket.AF_UNIX:
+            return False
+        return bool(self._socket.getsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY))
+
+    def close(self):
+        self._write_lock.acquire()
+        try:
+            self._close()
+        finally:
+            self._write_lock.release()
+
+    def _close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._write_condition.notifyAll()
+        self._selector.remove(self)
+        self._socket.close()
+        extensions.close_compression_stats(self._request)
+        if self._close_handler is not None:
+            self._close_handler(self._request)
+        if (self._terminate_handler is not None and
+            not self._request.client_terminated):
+            self.run_handler(self._terminate_handler)
+
+    def _close_after_flush(self):
+        self._write_lock.acquire()
+        try:
+            if self._write_buffer:
+                self._close_when_flushed = True
+            else:
+                self._close()
+        finally:
+            self._write_lock.release()
+
+    def _parse(self):
+        if self._chunks_length < self._wanted_length:
+            return
+
+        self._data = ''.join(self._chunks)
+        self._limit, self._wanted_length = _scan_frames(self._data)
+        self._position = 0
+        self._receive_messages()
+
+        self._wanted_length -= self._position
+        self._data = self._data[self._position:]
+        self._chunks = [self._data]
+        self._chunks_length = len(self._data)
+        self._data = ''
+        self._limit = 0
+        self._position = 0
+
+    def _receive_messages(self):
+        """Receives messages from the complete frames and queues them for the
+        handler.
+        """
+
+        request = self._request
+        while not request.client_terminated:
+            try:
+                message = request.ws_stream.receive_message()
+            except _NoDataAvailable:
+                return
+            except stream.InvalidFrameException, e:
+                self._logger.debug('%s', e)
+                self._fail(common.STATUS_PROTOCOL_ERROR)
+                return
+            except stream.UnsupportedFrameException, e:
+                self._logger.debug('%s', e)
+                self._fail(common.STATUS_UNSUPPORTED_DATA)
+                return
+            except stream.InvalidUTF8Exception, e:
+                self._logger.debug('%s', e)
+                self._fail(common.STATUS_INVALID_FRAME_PAYLOAD_DATA)
+                return
+            except stream.MessageTooBigException, e:
+                self._logger.debug('%s', e)
+                self._fail(common.STATUS_MESSAGE_TOO_BIG)
+                return
+            except Exception, e:
+                self._logger.debug('%s', e)
+                self.close()
+                return
+
+            if request.server_terminated and message is not None:
+                # Messages following our closing handshake are discarded.
+                continue
+            self._queue_message(message)
+
+        # Both endpoints have sent a closing handshake.
+        self._close_after_flush()
+
+    def _fail(self, code):
+        try:
+            self._request.ws_stream.close_connection(code,
+                                                     wait_response=False)
+        except Exception, e:
+            self._logger.debug('%s', e)
+        self._close_after_flush()
+
+    def _queue_message(self, message):
+        self.run_handler(self._receive_message_handler, self._request,
+                         message)
+
+    def run_handler(self, function, *args):
+        """Runs function(*args) on the worker pool after the functions passed
+        to this method before it complete.
+        """
+
+        self._jobs_lock.acquire()
+        try:
+            self._jobs.append((function, args))
+            if self._running_jobs:
+                return
+            self._running_jobs = True
+        finally:
+            self._jobs_lock.release()
+        self._worker_pool.submit(self._run_jobs)
+
+    def _run_jobs(self):
+        while True:
+            self._jobs_lock.acquire()
+            try:
+                if not self._jobs:
+                    self._running_jobs = False
+                    return
+                function, args = self._jobs.popleft()
+            finally:
+                self._jobs_lock.release()
+
+            try:
+                function(*args)
+            except _NoDataAvailable:
+                # close_connection called by the handler cannot wait for the
+                # closing handshake of the client here. _receive_messages
+                # processes it.
+                pass
+            except handshake.AbortedByUserException, e:
+                self._logger.debug('Aborted: %s', e)
+                self.close()
+            except stream.BadOperationException, e:
+                self._logger.debug('%s', e)
+                self._fail(common.STATUS_INTERNAL_ENDPOINT_ERROR)
+            except stream.ConnectionTerminatedException, e:
+                self._logger.debug('%s', e)
+                self.close()
+            except socket.error, e:
+                self._logger.debug('%s', e)
+            except Exception, e:
+                self._logger.error(
+                    'Handler raised exception for %s: %s',
+                    self._request.ws_resource, util.get_stack_trace())
+                self.close()
+
+
+class _CoroutineRunner(object):
+    """Runs a coroutine web_socket_transfer_data handler on the worker pool of
+    EpollWebSocketServer.
+
+    StreamOperations yielded by the coroutine are run without blocking.
+    While it waits for receive_message or close_connection, the coroutine
+    holds no thread until the selector receives a message or a closing
+    handshake. If the connection is closed without a closing handshake
+    instead, ConnectionTerminatedException is thrown into the coroutine.
+    """
+
+    def __init__(self, request, coroutine):
+        self._request = request
+        self._coroutine = coroutine
+        # The name of the operation the coroutine is waiting for, or None
+        # when it is running or has finished.
+        self._waiting_for = None
+        # Whether the closing handshake of the client has been passed to
+        # receive_message. request.client_terminated is set by the selector
+        # before that, while earlier messages may still be queued.
+        self._client_terminated = False
+
+    def start(self):
+        self._resume(None, None)
+
+    def receive_message(self, unused_request, message):
+        """Resumes the coroutine with the received message."""
+
+        if message is None:
+            self._client_terminated = True
+        if self._waiting_for == stream.StreamOperation.RECEIVE_MESSAGE:
+            self._resume(message, None)
+        elif (self._waiting_for == stream.StreamOperation.CLOSE_CONNECTION
+              and message is None):
+            self._resume(None, None)
+
+    def terminate(self):
+        """Resumes the coroutine waiting for an operation with
+        ConnectionTerminatedException since the connection has been closed
+        abruptly. Closes the coroutine if it still waits for another
+        operation.
+        """
+
+        if self._waiting_for is None:
+            return
+        exception = stream.ConnectionTerminatedException(
+            'Connection closed while waiting for %s' % self._waiting_for)
+        self._resume(None, (type(exception), exception, None))
+        if self._waiting_for is not None:
+            self._waiting_for = None
+            self._coroutine.close()
+
+    def _resume(self, result, exc_info):
+        self._waiting_for = None
+        request = self._request
+        while True:
+            try:
+                if exc_info is None:
+                    operation = self._coroutine.send(result)
+                else:
+                    operation = self._coroutine.throw(*exc_info)
+            except StopIteration:
+                if not request.server_terminated:
+                    request.ws_stream.close_connection(wait_response=False)
+                return
+            result = None
+            exc_info = None
+            try:
+                if not isinstance(operation, stream.StreamOperation):
+                    raise TypeError('Coroutine handler yielded %r, not a '
+                                    'StreamOperation' % (operation,))
+                if operation.name == stream.StreamOperation.RECEIVE_MESSAGE:
+                    if not self._client_terminated:
+                        self._waiting_for = operation.name
+                        return
+                    # Raises BadOperationException.
+                    operation.run()
+                elif (operation.name ==
+                      stream.StreamOperation.CLOSE_CONNECTION):
+                    kwargs = dict(operation.kwargs)
+                    kwargs['wait_response'] = False
+                    request.ws_stream.close_connection(
+                        *operation.args, **kwargs)
+                    if not self._client_terminated:
+                        self._waiting_for = operation.name
+                        return
+                else:
+                    result = operation.run()
+            except Exception:
+                exc_info = sys.exc_info()
+
+
+class _Selector(threading.Thread):
+    """Runs an epoll loop which reads and writes the connections added to
+    it.
+    """
+
+    def __init__(self, name, poll_interval):
+        threading.Thread.__init__(self, name=name)
+        self.setDaemon(True)
+
+        self._logger = util.get_class_logger(self)
+
+        self._poll_interval = poll_interval
+        self._epoll = select.epoll()
+        self._connections = {}
+        self._running = True
+        # Heap of (deadline, file descriptor, connection).
+        self._deadlines = []
+        self._deadlines_lock = threading.Lock()
+
+    def add(self, connection, eventmask=select.EPOLLIN, deadline=None):
+        """Adds connection. If deadline is not None, the handle_timeout
+        method of connection is called once time.time() has passed it
+        unless connection has been removed by then.
+        """
+
+        fileno = connection.fileno()
+        self._connections[fileno] = connection
+        self._epoll.register(fileno, eventmask)
+        if deadline is not None:
+            self._deadlines_lock.acquire()
+            try:
+                heapq.heappush(self._deadlines, (deadline, fileno, connection))
+            finally:
+                self._deadlines_lock.release()
+
+    def modify(self, connection, eventmask):
+        self._epoll.modify(connection.fileno(), eventmask)
+
+    def remove(self, connection):
+        fileno = connection.fileno()
+        if self._connections.pop(fileno, None) is not None:
+            self._epoll.unregister(fileno)
+
+    def get_connection_count(self):
+        return len(self._connections)
+
+    def _pop_expired_connections(self):
+        """Returns the connections whose deadline has passed and the
+        seconds until the next deadline, or None if there is none.
+        """
+
+        expired = []
+        now = time.time()
+        self._deadlines_lock.acquire()
+        try:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                unused_deadline, fileno, connection = heapq.heappop(
+                    self._deadlines)
+                if self._connections.get(fileno) is connection:
+                    expired.append(connection)
+            if self._deadlines:
+                return expired, self._deadlines[0][0] - now
+            return expired, None
+        finally:
+            self._deadlines_lock.release()
+
+    def run(self):
+        try:
+            while self._running:
+                expired, timeout = self._pop_expired_connections()
+                for connection in expired:
+                    connection.handle_timeout()
+                if timeout is None or timeout > self._poll_interval:
+                    timeout = self._poll_interval
+                try:
+                    events = self._epoll.poll(timeout)
+                except IOError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                for fileno, event in events:
+                    connection = self._connections.get(fileno)
+                    if connection is None:
+                        continue
+                    try:
+                        if event & select.EPOLLOUT:
+                            connection.handle_write()
+                        if event & (select.EPOLLIN | select.EPOLLHUP |
+                                    select.EPOLLERR):
+                            connection.handle_read()
+                    except Exception, e:
+                        self._logger.error(
+                            'Exception in processing connection: %s',
+                            util.get_stack_trace())
+                        connection.close()
+        finally:
+            for connection in self._connections.values():
+                connection.close()
+            self._epoll.close()
+
+    def stop(self):
+        self._running = False
+        self.join()
+
+
+class _EventLoopRequestHandler(WebSocketRequestHandler):
+    """WebSocketRequestHandler for a request whose header has been received
+    by EpollWebSocketServer.
+
+    When the handler for the resource defines web_socket_receive_message or
+    a coroutine web_socket_transfer_data and the connection speaks RFC 6455
+    without multiplexing, the connection is handed back to the server after
+    the opening handshake. Otherwise, the blocking web_socket_transfer_data
+    handler runs in its own thread just like in WebSocketServer.
+    """
+
+    def __init__(self, request, client_address, server, header):
+        self._header = header
+        self.handed_over = False
+        self._transferring_in_thread = False
+
+        WebSocketRequestHandler.__init__(
+            self, request, client_address, server)
+
+    def setup(self):
+        CGIHTTPServer.CGIHTTPRequestHandler.setup(self)
+
+        self.rfile = memorizingfile.MemorizingFile(
+            _PrefixedFile(self._header, self.rfile),
+            max_memorized_lines=_MAX_MEMORIZED_LINES)
+
+    def finish(self):
+        if not self._transferring_in_thread:
+            WebSocketRequestHandler.finish(self)
+
+    def _transfer_data(self, request):
+        # Don't let BaseHTTPRequestHandler.handle read the next request.
+        self.close_connection = 1
+        self.handed_over = True
+
+        handler_suite = self._options.dispatcher.get_handler_suite(
+            request.ws_resource)
+        if (isinstance(request.ws_stream, stream.Stream) and
+            not mux.use_mux(request)):
+            if handler_suite.receive_message is not None:
+                request._dispatcher = self._options.dispatcher
+                self.server.add_websocket_connection(
+                    self.request, request, handler_suite.receive_message)
+                return
+            if handler_suite.transfer_data_coroutine is not None:
+                request._dispatcher = self._options.dispatcher
+                runner = _CoroutineRunner(
+                    request, handler_suite.transfer_data_coroutine(request))
+                self.server.add_websocket_connection(
+                    self.request, request, runner.receive_message,
+                    runner.start, runner.terminate)
+                return
+
+        self._transferring_in_thread = True
+        thread = threading.Thread(target=self._run_transfer_data,
+                                  args=(request,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run_transfer_data(self, request):
+        try:
+            WebSocketRequestHandler._transfer_data(self, request)
+        except handshake.AbortedByUserException, e:
+            self._logger.info('Aborted: %s', e)
+        except Exception, e:
+            self.server.handle_error(self.request, self.client_address)
+        WebSocketRequestHandler.finish(self)
+        self.server.shutdown_request(self.request)
+
+
+class EpollWebSocketServer(WebSocketServer):
+    """WebSocketServer which serves connections on a few threads running
+    epoll loops instead of a thread per connection.
+
+    Selector threads read opening handshake requests until the end of their
+    header and then the worker pool runs WebSocketRequestHandler on them.
+    After the opening handshake, selector threads read and write the frames
+    of connections whose handler defines web_socket_receive_message or a
+    coroutine web_socket_transfer_data, and the worker pool runs the handler
+    for each complete message.
+    """
+
+    def __init__(self, options):
+        WebSocketServer.__init__(self, options)
+
+        self._worker_pool = None
+        self._selectors = []
+        self._next_selector = 0
+
+    def _get_selector(self):
+        selector = self._selectors[self._next_selector]
+        self._next_selector = (
+            (self._next_selector + 1) % len(self._selectors))
+        return selector
+
+    def process_opening_handshake(self, socket_, client_address, header):
+        """Runs the request handler on the header of an opening handshake
+        request received by a _Selector.
+        """
+
+        self._worker_pool.submit(self._process_opening_handshake,
+                                 socket_, client_address, header)
+
+    def _process_opening_handshake(self, socket_, client_address, header):
+        handler = None
+        try:
+            handler = _EventLoopRequestHandler(
+                socket_, client_address, self, header)
+        except Exception, e:
+            self.handle_error(socket_, client_address)
+        if handler is None or not handler.handed_over:
+            self.shutdown_request(socket_)
+
+    def add_websocket_connection(self, socket_, request,
+                                 receive_message_handler,
+                                 start_handler=None,
+                                 terminate_handler=None):
+        """Lets a _Selector read and write the frames of the WebSocket
+        connection.
+
+        Args:
+            receive_message_handler: called with request and each received
+                message on the worker pool.
+            start_handler: if not None, called without arguments on the
+                worker pool before receive_message_handler is called.
+            terminate_handler: if not None, called without arguments on the
+                worker pool when the connection is closed before the closing
+                handshake of the client is received.
+        """
+
+        socket_.setblocking(0)
+        selector = self._get_selector()
+        connection = _EventLoopConnection(
+            selector, self._worker_pool, socket_, request,
+            receive_message_handler, self.remove_websocket_request,
+            self.websocket_server_options.event_loop_write_buffer_size,
+            terminate_handler)
+        request.connection = connection
+        self.add_websocket_request(request)
+        if start_handler is not None:
+            connection.run_handler(start_handler)
+        connection.register()
+
+    def _accept(self, listening_socket):
+        """Override WebSocketServer._accept to read the opening handshake
+        request of accepted connections on a _Selector.
+        """
+
+        while True:
+            try:
+                socket_, client_address = listening_socket.accept()
+            except socket.error, e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                if not _is_would_block(e):
+                    self._logger.warning('Failed to accept: %s', e)
+                return
+            client_address = _get_client_address(socket_, client_address)
+            if not self._set_accepted_socket_options(socket_, client_address):
+                continue
+            socket_.setblocking(0)
+            selector = self._get_selector()
+            connection = _OpeningHandshakeConnection(
+                self, selector, socket_, client_address)
+            deadline = None
+            timeout = self.websocket_server_options.request_header_timeout
+            if timeout > 0:
+                deadline = time.time() + timeout
+            selector.add(connection, select.EPOLLIN | select.EPOLLET,
+                         deadline)
+
+    def serve_forever(self, poll_interval=0.5):
+        """Override WebSocketServer.serve_forever."""
+
+        options = self.websocket_server_options
+
+        self._worker_pool = util.WorkerPool(
+            options.event_loop_worker_threads, name='EventLoopWorker')
+        for i in xrange(options.selector_threads):
+            selector = _Selector('Selector-%d' % i, poll_interval)
+            selector.start()
+            self._selectors.append(selector)
+        try:
+            WebSocketServer.serve_forever(self, poll_interval)
+        finally:
+            for selector in self._selectors:
+                selector.stop()
+            self._selectors = []
+            self._worker_pool.shutdown()
+
+
+class _HandoffChannel(object):
+    """Pair of connected Unix domain datagram sockets over which an acceptor
+    process hands off connections to a worker process.
+
+    A connection is sent as a datagram containing the pickled address family,
+    client address and already received header, followed by a datagram
+    carrying the file descriptor. The supervisor keeps both ends open so that
+    either process can be restarted without reconnecting.
+    """
+
+    def __init__(self):
+        self._sending_socket, self._receiving_socket = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._send_lock = threading.Lock()
+
+    def send(self, socket_, client_address, header):
+        message = pickle.dumps((socket_.family, client_address, header),
+                               pickle.HIGHEST_PROTOCOL)
+        self._send_lock.acquire()
+        try:
+            self._sending_socket.send(message)
+            _multiprocessing.sendfd(self._sending_socket.fileno(),
+                                    socket_.fileno())
+        finally:
+            self._send_lock.release()
+
+    def receive(self):
+        """Receives a connection handed off by send.
+
+        Returns:
+            a tuple of the socket, the client address and the header, or
+            None if a datagram carrying a file descriptor was received first.
+            That happens when the previous worker process died after
+            receiving the first datagram of a connection. The kernel closes
+            the file descriptor then.
+        """
+
+        message = self._receiving_socket.recv(_MAX_HANDOFF_MESSAGE_SIZE)
+        if len(message) == 1:
+            return None
+        family, client_address, header = pickle.loads(message)
+        fd = _multiprocessing.recvfd(self._receiving_socket.fileno())
+        try:
+            socket_ = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        finally:
+            os.close(fd)
+        return socket_, client_address, header
+
+    def fileno(self):
+        return self._receiving_socket.fileno()
+
+    def setblocking(self, unused_flag):
+        # receive always blocks since the second datagram of a connection may
+        # not have arrived yet when the first one can be read.
+        pass
+
+    def close_sending_socket(self):
+        """Closes the end used by send in a worker process."""
+
+        self._sending_socket.close()
+
+    def close(self):
+        self._sending_socket.close()
+        self._receiving_socket.close()
+
+
+class _AcceptorServer(EpollWebSocketServer):
+    """EpollWebSocketServer which reads the header of each request and hands
+    off the connection to a worker process chosen by the resource.
+
+    Connections to the resources of handler suites given to add_channels are
+    handed off to the workers dedicated to them, and other connections to
+    the default workers.
+    """
+
+    def __init__(self, options):
+        EpollWebSocketServer.__init__(self, options)
+
+        # Maps a handler suite to an iterator cycling over the channels to
+        # the workers dedicated to it. None maps to the default workers.
+        self._channels = {}
+
+    def add_channels(self, resource, channels):
+        """Hands off the connections to resource to workers.
+
+        Args:
+            resource: a resource path with a handler, or None for the
+                connections not handed off to any other workers.
+            channels: _HandoffChannel objects to the workers.
+        """
+
+        handler_suite = None
+        if resource is not None:
+            handler_suite = (
+                self.websocket_server_options.dispatcher.get_handler_suite(
+                    resource))
+            if handler_suite is None:
+                raise ValueError('No handler for: %r' % resource)
+        self._channels[handler_suite] = itertools.cycle(channels)
+
+    def _get_channel(self, header):
+        handler_suite = None
+        request_line = header.split('\r\n', 1)[0].split()
+        if len(request_line) == 3:
+            try:
+                handler_suite = (
+                    self.websocket_server_options.dispatcher.
+                    get_handler_suite(request_line[1]))
+            except dispatch.DispatchException, e:
+                # Let the worker respond with the error.
+                pass
+        channels = self._channels.get(handler_suite)
+        if channels is None:
+            channels = self._channels[None]
+        return channels.next()
+
+    def process_opening_handshake(self, socket_, client_address, header):
+        """Override EpollWebSocketServer.process_opening_handshake to hand
+        off the connection instead of processing the handshake.
+        """
+
+        # Sending blocks when a worker falls behind, so don't send on the
+        # selector thread.
+        self._worker_pool.submit(self._hand_off,
+                                 socket_, client_address, header)
+
+    def _hand_off(self, socket_, client_address, header):
+        try:
+            self._get_channel(header).send(socket_, client_address, header)
+        except Exception, e:
+            self.handle_error(socket_, client_address)
+        # Don't shut down the socket, which the worker now shares.
+        socket_.close()
+
+
+class _HandoffWorkerServer(EpollWebSocketServer):
+    """EpollWebSocketServer which serves connections handed off by an
+    _AcceptorServer over a _HandoffChannel instead of listening sockets.
+    """
+
+    def __init__(self, options, channel):
+        self._channel = channel
+
+        EpollWebSocketServer.__init__(self, options)
+
+    def _create_sockets(self):
+        """Override WebSocketServer._create_sockets to wait on the channel
+        instead of listening sockets.
+        """
+
+        self.server_name, self.server_port = self.server_address
+        self._sockets = [(self._channel, 'handoff channel')]
+
+    def server_bind(self):
+        """Override WebSocketServer.server_bind to do nothing."""
+
+        pass
+
+    def server_activate(self):
+        """Override WebSocketServer.server_activate to do nothing."""
+
+        pass
+
+    def _accept(self, channel):
+        """Override EpollWebSocketServer._accept to receive a connection
+        from the channel.
+        """
+
+        try:
+            connection = channel.receive()
+        except (OSError, socket.error), e:
+            self._logger.warning('Failed to receive a connection: %s', e)
+            return
+        if connection is not None:
+            socket_, client_address, header = connection
+            self.process_opening_handshake(socket_, client_address, header)
+
+
+def _get_logger_from_class(c):
+    return logging.getLogger('%s.%s' % (c.__module__, c.__name__))
+
+
+def _configure_logging(options):
+    logging.addLevelName(common.LOGLEVEL_FINE, 'FINE')
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.getLevelName(options.log_level.upper()))
+    if options.log_file:
+        handler = logging.handlers.RotatingFileHandler(
+                options.log_file, 'a', options.log_max, options.log_count)
+    else:
+        handler = logging.StreamHandler()
+    formatter = logging.Formatter(
+            '[%(asctime)s] [%(levelname)s] %(name)s: %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    deflate_log_level_name = logging.getLevelName(
+        options.deflate_log_level.upper())
+    _get_logger_from_class(util._Deflater).setLevel(
+        deflate_log_level_name)
+    _get_logger_from_class(util._Inflater).setLevel(
+        deflate_log_level_name)
+
+
+def _configure_deflate(options):
+    deflate_options = extensions.DeflateOptions()
+    if options.deflate_worker_threads > 0:
+        deflate_options.worker_pool = util.WorkerPool(
+            options.deflate_worker_threads, name='DeflateWorker')
+    deflate_options.offload_threshold = options.deflate_offload_threshold
+    deflate_options.fragment_size = options.deflate_fragment_size
+    deflate_options.max_inflated_size = options.deflate_max_inflated_size
+    deflate_options.level = options.deflate_level
+    deflate_options.mem_level = options.deflate_mem_level
+    extensions.set_deflate_options(deflate_options)
+
+
+def _configure_mux(options):
+    mux_options = mux.MuxOptions()
+    mux_options.fragment_quantum = options.mux_fragment_quantum
+    mux_options.write_window = options.mux_write_window
+    if options.mux_worker_threads > 0:
+        mux_options.worker_pool = util.WorkerPool(
+            options.mux_worker_threads, name='MuxWorker')
+    mux_options.max_channels_per_connection = (
+        options.mux_max_channels_per_connection)
+    mux_options.max_channels = options.mux_max_channels
+    mux_options.min_receive_window = options.mux_min_receive_window
+    mux_options.max_receive_window = options.mux_max_receive_window
+    mux.set_mux_options(mux_options)
+
+
+def _store_port(unused_option, unused_opt_str, value, parser):
+    """Stores the value of the --port option and records that it was
+    given.
+    """
+
+    parser.values.port = value
+    parser.values.port_specified = True
+
+
+def _build_option_parser():
+    parser = optparse.OptionParser()
+
+    parser.add_option('--config', dest='config_file', type='string',
+                      default=None,
+                      help=('Path to configuration file. See the file comment '
+                            'at the top of this file for the configuration '
+                            'file format'))
+    parser.add_option('-H', '--server-host', '--server_host',
+                      dest='server_host',
+                      default='',
+                      help='server hostname to listen to')
+    parser.add_option('-V', '--validation-host', '--validation_host',
+                      dest='validation_host',
+                      default=None,
+                      help='server hostname to validate in absolute path.')
+    parser.add_option('-p', '--port', dest='port', type='int',
+                      default=common.DEFAULT_WEB_SOCKET_PORT,
+                      action='callback', callback=_store_port,
+                      help=('port to listen to. With --unix-socket, the '
+                            'server listens on TCP only if this is given.'))
+    parser.set_defaults(port_specified=False)
+    parser.add_option('--unix-socket', '--unix_socket', dest='unix_sockets',
+                      action='append', default=[], metavar='PATH',
+                      help=('Listen on a Unix-domain socket at PATH. May be '
+                            'given multiple times. The server listens on '
+                            'TCP too only if --port is given.'))
+    parser.add_option('-P', '--validation-port', '--validation_port',
+                      dest='validation_port', type='int',
+                      default=None,
+                      help='server port to validate in absolute path.')
+    parser.add_option('-w', '--websock-handlers', '--websock_handlers',
+                      dest='websock_handlers',
+                      default='.',
+                      help=('The root directory of WebSocket handler files. '
+                            'If the path is relative, --document-root is used '
+                            'as the base.'))
+    parser.add_option('-m', '--websock-handlers-map-file',
+                      '--websock_handlers_map_file',
+                      dest='websock_handlers_map_file',
+                      default=None,
+                      help=('WebSocket handlers map file. '
+                            'Each line consists of alias_resource_path and '
+                            'existing_resource_path, separated by spaces.'))
+    parser.add_option('-s', '--scan-dir', '--scan_dir', dest='scan_dir',
+                      default=None,
+                      help=('Must be a directory under --websock-handlers. '
+                            'Only handlers under this directory are scanned '
+                            'and registered to the server. '
+                            'Useful for saving scan time when the handler '
+                            'root directory contains lots of files that are '
+                            'not handler file or are handler files but you '
+                            'don\'t want them to be registered. '))
+    parser.add_option('--allow-handlers-outside-root-dir',
+                      '--allow_handlers_outside_root_dir',
+                      dest='allow_handlers_outside_root_dir',
+                      action='store_true',
+                      default=False,
+                      help=('Scans WebSocket handlers even if their canonical '
+                            'path is not under --websock-handlers.'))
+    parser.add_option('-d', '--document-root', '--document_root',
+                      dest='document_root', default='.',
+                      help='Document root directory.')
+    parser.add_option('-x', '--cgi-paths', '--cgi_paths', dest='cgi_paths',
+                      default=None,
+                      help=('CGI paths relative to document_root.'
+                            'Comma-separated. (e.g -x /cgi,/htbin) '
+                            'Files under document_root/cgi_path are handled '
+                            'as CGI programs. Must be executable.'))
+    parser.add_option('-t', '--tls', dest='use_tls', action='store_true',
+                      default=False, help='use TLS (wss://)')
+    parser.add_option('--tls-handshake-timeout', '--tls_handshake_timeout',
+                      dest='tls_handshake_timeout', type='float',
+                      default=_DEFAULT_TLS_HANDSHAKE_TIMEOUT_IN_SEC,
+                      help=('Seconds to wait for a client to complete the '
+                            'TLS handshake.'))
+    parser.add_option('--request-header-timeout', '--request_header_timeout',
+                      dest='request_header_timeout', type='float',
+                      default=_DEFAULT_REQUEST_HEADER_TIMEOUT_IN_SEC,
+                      help=('Seconds to wait for data of the request header '
+                            'and the opening handshake before closing the '
+                            'connection. If 0, wait forever.'))
+    parser.add_option('--tls-module', '--tls_module', dest='tls_module',
+                      type='choice',
+                      choices = [_TLS_BY_STANDARD_MODULE, _TLS_BY_PYOPENSSL],
+                      help='Use ssl module if "%s" is specified. '
+                      'Use pyOpenSSL module if "%s" is specified' %
+                      (_TLS_BY_STANDARD_MODULE, _TLS_BY_PYOPENSSL))
+    parser.add_option('-k', '--private-key', '--private_key',
+                      dest='private_key',
+                      default='', help='TLS private key file.')
+    parser.add_option('-c', '--certificate', dest='certificate',
+                      default='', help='TLS certificate file.')
+    parser.add_option('--tls-client-auth', dest='tls_client_auth',
+                      action='store_true', default=False,
+                      help='Requests TLS client auth on every connection.')
+    parser.add_option('--tls-client-cert-optional',
+                      dest='tls_client_cert_optional',
+                      action='store_true', default=False,
+                      help=('Makes client certificate optional even though '
+                            'TLS client auth is enabled.'))
+    parser.add_option('--tls-client-ca', dest='tls_client_ca', default='',
+                      help=('Specifies a pem file which contains a set of '
+                            'concatenated CA certificates which are used to '
+                            'validate certificates passed from clients'))
+    parser.add_option('--basic-auth', dest='use_basic_auth',
+                      action='store_true', default=False,
+                      help='Requires Basic authentication.')
+    parser.add_option('--basic-auth-credential',
+                      dest='basic_auth_credential', default='test:test',
+                      help='Specifies the credential of basic authentication '
+                      'by username:password pair (e.g. test:test).')
+    parser.add_option('-l', '--log-file', '--log_file', dest='log_file',
+                      default='', help='Log file.')
+    # Custom log level:
+    # - FINE: Prints status of each frame processing step
+    parser.add_option('--log-level', '--log_level', type='choice',
+                      dest='log_level', default='warn',
+                      choices=['fine',
+                               'debug', 'info', 'warning', 'warn', 'error',
+                               'critical'],
+                      help='Log level.')
+    parser.add_option('--deflate-log-level', '--deflate_log_level',
+                      type='choice',
+                      dest='deflate_log_level', default='warn',
+                      choices=['debug', 'info', 'warning', 'warn', 'error',
+                               'critical'],
+                      help='Log level for _Deflater and _Inflater.')
+    parser.add_option('--deflate-worker-threads', '--deflate_worker_threads',
+                      dest='deflate_worker_threads', type='int', default=0,
+                      help=('If positive integer is specified, compression '
+                            'and decompression of large messages for '
+                            'deflate-frame and permessage-deflate run on a '
+                            'pool of the specified number of threads. '
+                            'Otherwise, they run on the handler thread.'))
+    parser.add_option('--deflate-offload-threshold',
+                      '--deflate_offload_threshold',
+                      dest='deflate_offload_threshold', type='int',
+                      default=extensions._DEFAULT_DEFLATE_OFFLOAD_THRESHOLD,
+                      help=('Messages (frames for deflate-frame) of this '
+                            'size in bytes or larger are processed on the '
+                            'deflate worker threads.'))
+    parser.add_option('--deflate-level', '--deflate_level',
+                      dest='deflate_level', type='int',
+                      default=zlib.Z_DEFAULT_COMPRESSION,
+                      help=('Compression level (0-9) used by '
+                            'permessage-deflate. -1 for the zlib default.'))
+    parser.add_option('--deflate-mem-level', '--deflate_mem_level',
+                      dest='deflate_mem_level', type='int',
+                      default=zlib.DEF_MEM_LEVEL,
+                      help=('memLevel (1-9) of zlib used by '
+                            'permessage-deflate. Larger values use more '
+                            'memory per connection for faster and better '
+                            'compression.'))
+    parser.add_option('--deflate-max-inflated-size',
+                      '--deflate_max_inflated_size',
+                      dest='deflate_max_inflated_size', type='int',
+                      default=extensions._DEFAULT_DEFLATE_MAX_INFLATED_SIZE,
+                      help=('Maximum size in bytes of an incoming message '
+                            '(frame for deflate-frame) after decompression. '
+                            'The connection is closed with status code 1009 '
+                            'when it is exceeded. Negative for no limit.'))
+    parser.add_option('--deflate-fragment-size', '--deflate_fragment_size',
+                      dest='deflate_fragment_size', type='int', default=0,
+                      help=('If positive integer is specified, '
+                            'permessage-deflate splits outgoing messages '
+                            'longer than the specified number of bytes into '
+                            'fragments and compresses the next fragment on '
+                            'the deflate worker threads while sending the '
+                            'current one.'))
+    parser.add_option('--mux-fragment-quantum', '--mux_fragment_quantum',
+                      dest='mux_fragment_quantum', type='int',
+                      default=mux._DEFAULT_FRAGMENT_QUANTUM,
+                      help=('Size in bytes at which messages on multiplexed '
+                            'logical channels are fragmented, multiplied by '
+                            'the send weight of the channel, so that the '
+                            'logical channels sharing a physical connection '
+                            'take turns sending.'))
+    parser.add_option('--mux-write-window', '--mux_write_window',
+                      dest='mux_write_window', type='int',
+                      default=mux._DEFAULT_WRITE_WINDOW,
+                      help=('Number of bytes a multiplexed logical channel '
+                            'can queue for writing to the physical '
+                            'connection before its writes block. 0 makes '
+                            'each write wait for the previous one to '
+                            'complete.'))
+    parser.add_option('--mux-worker-threads', '--mux_worker_threads',
+                      dest='mux_worker_threads', type='int', default=0,
+                      help=('If positive integer is specified, multiplexed '
+                            'logical channels run on a pool of the specified '
+                            'number of threads, and AddChannel requests '
+                            'while all of them are in use are rejected with '
+                            '503. Otherwise, each logical channel gets its '
+                            'own thread.'))
+    parser.add_option('--mux-max-channels-per-connection',
+                      '--mux_max_channels_per_connection',
+                      dest='mux_max_channels_per_connection', type='int',
+                      default=0,
+                      help=('Maximum number of logical channels, including '
+                            'the default channel, open on one physical '
+                            'connection. AddChannel requests over the limit '
+                            'are rejected with 503. 0 means no limit.'))
+    parser.add_option('--mux-max-channels', '--mux_max_channels',
+                      dest='mux_max_channels', type='int', default=0,
+                      help=('Maximum number of logical channels open on the '
+                            'whole server. AddChannel requests over the '
+                            'limit are rejected with 503. 0 means no '
+                            'limit.'))
+    parser.add_option('--mux-min-receive-window',
+                      '--mux_min_receive_window',
+                      dest='mux_min_receive_window', type='int',
+                      default=mux._INITIAL_QUOTA_FOR_CLIENT,
+                      help=('Initial send quota in bytes given to the client '
+                            'for each multiplexed logical channel.'))
+    parser.add_option('--mux-max-receive-window',
+                      '--mux_max_receive_window',
+                      dest='mux_max_receive_window', type='int',
+                      default=mux._DEFAULT_MAX_RECEIVE_WINDOW,
+                      help=('Number of bytes up to which the send quota of '
+                            'a multiplexed logical channel grows when the '
+                            'client keeps running out of it. Set it to the '
+                            'value of --mux-min-receive-window to disable '
+                            'the growth.'))
+    parser.add_option('--server-mode', '--server_mode', dest='server_mode',
+                      type='choice', default=_SERVER_MODE_THREADING,
+                      choices=[_SERVER_MODE_THREADING, _SERVER_MODE_EPOLL],
+                      help=('threading runs each connection on its own '
+                            'thread. epoll reads and writes connections on '
+                            'a few selector threads and runs '
+                            'web_socket_receive_message handlers and '
+                            'coroutine web_socket_transfer_data handlers on '
+                            'a pool of worker threads. Other handlers still '
+                            'get their own thread.'))
+    parser.add_option('--handler-threads', '--handler_threads',
+                      dest='handler_threads', type='int', default=0,
+                      help=('Number of threads running requests in the '
+                            'threading server mode. If 0, each request gets '
+                            'its own thread.'))
+    parser.add_option('--handler-queue-size', '--handler_queue_size',
+                      dest='handler_queue_size', type='int',
+                      default=_DEFAULT_HANDLER_QUEUE_SIZE,
+                      help=('Maximum number of accepted requests waiting for '
+                            'one of --handler-threads threads. Further '
+                            'requests are rejected with a 503 response.'))
+    parser.add_option('--thread-stack-size', '--thread_stack_size',
+                      dest='thread_stack_size', type='int', default=0,
+                      help=('Stack size in KiB of the threads started by the '
+                            'server. If 0, the platform default is used.'))
+    parser.add_option('--selector-threads', '--selector_threads',
+                      dest='selector_threads', type='int',
+                      default=_DEFAULT_SELECTOR_THREADS,
+                      help=('Number of threads running epoll loops in the '
+                            'epoll server mode.'))
+    parser.add_option('--event-loop-worker-threads',
+                      '--event_loop_worker_threads',
+                      dest='event_loop_worker_threads', type='int',
+                      default=_DEFAULT_EVENT_LOOP_WORKER_THREADS,
+                      help=('Number of threads running opening handshakes '
+                            'and callback and coroutine handlers in the '
+                            'epoll server mode.'))
+    parser.add_option('--event-loop-write-buffer-size',
+                      '--event_loop_write_buffer_size',
+                      dest='event_loop_write_buffer_size', type='int',
+                      default=_DEFAULT_EVENT_LOOP_WRITE_BUFFER_SIZE,
+                      help=('Bytes queued for a connection in the epoll '
+                            'server mode above which writes by handlers wait '
+                            'for the client to read them.'))
+    parser.add_option('--processes', dest='processes', type='int', default=1,
+                      help=('Number of worker processes to fork. If larger '
+                            'than 1, this process supervises the workers, '
+                            'restarts them when they exit unexpectedly and '
+                            'forwards SIGTERM to them.'))
+    parser.add_option('--reuse-port', '--reuse_port', dest='reuse_port',
+                      action='store_true', default=False,
+                      help=('Bind the listening sockets with SO_REUSEPORT. '
+                            'With --processes, each worker binds its own '
+                            'sockets and the kernel distributes connections '
+                            'among them instead of the workers accepting on '
+                            'shared sockets.'))
+    parser.add_option('--resource-processes', '--resource_processes',
+                      dest='resource_processes', action='append',
+                      default=[], metavar='RESOURCE=N',
+                      help=('Run N worker processes dedicated to the '
+                            'handler of RESOURCE. May be given multiple '
+                            'times. Requires the epoll server mode. A '
+                            'process accepts connections, reads their '
+                            'request header and hands them off to the '
+                            'dedicated workers or to the --processes '
+                            'default workers serving all other requests.'))
+    parser.add_option('--tcp-nodelay', '--tcp_nodelay', dest='tcp_nodelay',
+                      action='store_true', default=False,
+                      help=('Disable Nagle\'s algorithm on connections so '
+                            'that small messages are sent without delay. '
+                            'Handlers may override it per connection by '
+                            'request.connection.set_tcp_nodelay().'))
+    parser.add_option('--send-buffer-size', '--send_buffer_size',
+                      dest='send_buffer_size', type='int', default=0,
+                      help=('SO_SNDBUF of connections in bytes. If 0, the '
+                            'platform default is used.'))
+    parser.add_option('--receive-buffer-size', '--receive_buffer_size',
+                      dest='receive_buffer_size', type='int', default=0,
+                      help=('SO_RCVBUF of connections in bytes. If 0, the '
+                            'platform default is used.'))
+    parser.add_option('--tcp-keepalive', '--tcp_keepalive',
+                      dest='tcp_keepalive', action='store_true',
+                      default=False,
+                      help=('Enable TCP keepalive probes to detect and close '
+                            'connections to peers that went away.'))
+    parser.add_option('--tcp-keepalive-idle', '--tcp_keepalive_idle',
+                      dest='tcp_keepalive_idle', type='int', default=0,
+                      help=('Seconds a connection is idle before the first '
+                            'keepalive probe. If 0, the platform default is '
+                            'used.'))
+    parser.add_option('--tcp-keepalive-interval',
+                      '--tcp_keepalive_interval',
+                      dest='tcp_keepalive_interval', type='int', default=0,
+                      help=('Seconds between keepalive probes. If 0, the '
+                            'platform default is used.'))
+    parser.add_option('--tcp-keepalive-count', '--tcp_keepalive_count',
+                      dest='tcp_keepalive_count', type='int', default=0,
+                      help=('Number of unanswered keepalive probes before '
+                            'the connection is dropped. If 0, the platform '
+                            'default is used.'))
+    parser.add_option('--tcp-defer-accept', '--tcp_defer_accept',
+                      dest='tcp_defer_accept', type='int', default=0,
+                      help=('If positive integer is specified, connections '
+                            'are accepted only once they have sent data, '
+                            'waiting up to about the specified seconds '
+                            '(TCP_DEFER_ACCEPT).'))
+    parser.add_option('--drain-timeout', '--drain_timeout',
+                      dest='drain_timeout', type='float', default=0,
+                      help=('On SIGTERM, or on SIGUSR2 once the new server '
+                            'is ready, stop accepting connections, close '
+                            'the WebSocket connections with status 1001 '
+                            '(going away) and exit when all of them have '
+                            'been closed or the specified seconds have '
+                            'passed. If 0, exit without closing them.'))
+    parser.add_option('--drain-rate', '--drain_rate', dest='drain_rate',
+                      type='float', default=_DEFAULT_DRAIN_RATE,
+                      help=('Number of connections closed per second while '
+                            'draining, so that clients don\'t reconnect all '
+                            'at once. If 0, all are closed at once.'))
+    parser.add_option('--thread-monitor-interval-in-sec',
+                      '--thread_monitor_interval_in_sec',
+                      dest='thread_monitor_interval_in_sec',
                       type='int', default=-1,
                       help=('If positive integer is specified, run a thread '
                             'monitor to show the status of server threads '
@@ -1027,12 +3010,13 @@ def _build_option_parser():
 class ThreadMonitor(threading.Thread):
     daemon = True
 
-    def __init__(self, interval_in_sec):
+    def __init__(self, interval_in_sec, server=None):
         threading.Thread.__init__(self, name='ThreadMonitor')
 
         self._logger = util.get_class_logger(self)
 
         self._interval_in_sec = interval_in_sec
+        self._server = server
 
     def run(self):
         while True:
@@ -1043,9 +3027,490 @@ class ThreadMonitor(threading.Thread):
                 "%d active threads: %s",
                 threading.active_count(),
                 ', '.join(thread_name_list))
+            if self._server is not None:
+                counts = self._server.get_handler_thread_counts()
+                if counts is not None:
+                    self._logger.info(
+                        'Handler threads: %d active, %d queued, %d rejected',
+                        *counts)
             time.sleep(self._interval_in_sec)
 
 
+class _WorkerProcessSupervisor(object):
+    """Runs servers in worker processes forked from this process, restarts
+    workers which exit unexpectedly and forwards SIGTERM and SIGINT to them.
+    """
+
+    def __init__(self, restart=None):
+        """Construct an instance.
+
+        Args:
+            restart: if not None, a function called on SIGUSR2 to start a new
+                server which takes over the listening sockets. When it
+                returns True, the workers are stopped as on SIGTERM.
+        """
+
+        self._logger = util.get_class_logger(self)
+
+        self._restart = restart
+
+        # Functions called in each worker process to get the server to serve.
+        self._server_factories = []
+        # Maps the pid of each worker process to the time it was started and
+        # the index of its server factory.
+        self._workers = {}
+        self._stopping = False
+        # The server of this process when it is a worker.
+        self._server = None
+        # Only the supervisor holds the write end of this pipe. Workers shut
+        # down when they read EOF from it, i.e. when the supervisor exits even
+        # if it was killed by SIGKILL.
+        self._supervisor_alive_fd = None
+        self._supervisor_alive_write_fd = None
+
+    def add_worker(self, server_factory):
+        """Adds a worker process to run.
+
+        Args:
+            server_factory: a function called in the worker process to get
+                the server to serve. The worker exits if it returns None.
+        """
+
+        self._server_factories.append(server_factory)
+
+    def _start_worker(self, index):
+        pid = os.fork()
+        if pid != 0:
+            self._workers[pid] = (time.time(), index)
+            self._logger.info('Started worker process %d', pid)
+            if self._stopping:
+                os.kill(pid, signal.SIGTERM)
+            return
+
+        exit_code = 1
+        try:
+            os.close(self._supervisor_alive_write_fd)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, self._handle_worker_stop_signal)
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+            self._server = self._server_factories[index]()
+            if self._server is None:
+                return
+
+            watcher = threading.Thread(target=self._watch_supervisor,
+                                       name='SupervisorWatcher')
+            watcher.daemon = True
+            watcher.start()
+
+            _serve(self._server.websocket_server_options, self._server)
+            exit_code = 0
+        except Exception, e:
+            logging.critical('mod_pywebsocket: %s' % e)
+            logging.critical('mod_pywebsocket: %s' % util.get_stack_trace())
+        finally:
+            logging.shutdown()
+            # Never return to the caller of run() in the worker.
+            os._exit(exit_code)
+
+    def _handle_worker_stop_signal(self, unused_signum, unused_frame):
+        if self._server is None:
+            os._exit(1)
+        # This runs on the thread running serve_forever which drain waits
+        # for.
+        threading.Thread(target=self._server.drain).start()
+
+    def _watch_supervisor(self):
+        while True:
+            try:
+                os.read(self._supervisor_alive_fd, 1)
+                break
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+        self._logger.info('Supervisor process exited')
+        self._server.shutdown()
+
+    def _handle_stop_signal(self, signum, unused_frame):
+        self._logger.info('Stopping %d worker processes on signal %d',
+                          len(self._workers), signum)
+        self._stopping = True
+        for pid in self._workers.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError, e:
+                self._logger.info('Failed to signal worker process %d: %s',
+                                  pid, e)
+
+    def _handle_restart_signal(self, unused_signum, unused_frame):
+        thread = threading.Thread(target=self._restart_and_stop)
+        thread.daemon = True
+        thread.start()
+
+    def _restart_and_stop(self):
+        if self._restart():
+            self._handle_stop_signal(signal.SIGUSR2, None)
+
+    def _wait_worker(self):
+        """Waits until a worker process exits and returns its pid and exit
+        status. Unlike os.wait, this doesn't reap other child processes, e.g.
+        a new server started on SIGUSR2 whose process is still in use.
+        """
+
+        while True:
+            for pid in self._workers.keys():
+                try:
+                    waited_pid, status = os.waitpid(pid, os.WNOHANG)
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if waited_pid == pid:
+                    return pid, status
+            time.sleep(_WORKER_POLL_INTERVAL_IN_SEC)
+
+    def run(self, started=None):
+        """Starts the worker processes and supervises them until all of them
+        exit after SIGTERM, SIGINT, or SIGUSR2 if restart is given.
+
+        Args:
+            started: if not None, called once all the worker processes have
+                been started.
+        """
+
+        self._supervisor_alive_fd, self._supervisor_alive_write_fd = (
+            os.pipe())
+
+        signal.signal(signal.SIGTERM, self._handle_stop_signal)
+        signal.signal(signal.SIGINT, self._handle_stop_signal)
+        if self._restart is not None:
+            signal.signal(signal.SIGUSR2, self._handle_restart_signal)
+
+        try:
+            for index in xrange(len(self._server_factories)):
+                self._start_worker(index)
+            if started is not None:
+                started()
+
+            while self._workers:
+                pid, status = self._wait_worker()
+                worker = self._workers.pop(pid)
+                if self._stopping:
+                    self._logger.info('Worker process %d exited', pid)
+                    continue
+
+                self._logger.warning(
+                    'Worker process %d exited unexpectedly with status %d',
+                    pid, status)
+                start_time, index = worker
+                elapsed = time.time() - start_time
+                if elapsed < _WORKER_RESTART_INTERVAL_IN_SEC:
+                    time.sleep(_WORKER_RESTART_INTERVAL_IN_SEC - elapsed)
+                if not self._stopping:
+                    self._start_worker(index)
+        finally:
+            os.close(self._supervisor_alive_fd)
+            os.close(self._supervisor_alive_write_fd)
+
+
+def _reopen_sockets(server):
+    """Creates, binds and listens on new sockets for server in a worker
+    process started with --reuse-port.
+    """
+
+    server._create_sockets()
+    server.server_bind()
+    server.server_activate()
+    if not server._sockets:
+        return None
+    _notify_ready(server.websocket_server_options)
+    return server
+
+
+def _run_worker_processes(options, server):
+    """Serves server in options.processes worker processes."""
+
+    if options.reuse_port:
+        # Let the workers bind their own sockets. Our sockets would get their
+        # share of connections without anyone accepting them.
+        server.server_close()
+        server_factory = functools.partial(_reopen_sockets, server)
+        # The new server binds its own sockets too.
+        listening_sockets = []
+    else:
+        _notify_ready(options)
+        server_factory = lambda: server
+        listening_sockets = _get_listening_sockets(server)
+    supervisor = _WorkerProcessSupervisor(
+        functools.partial(_start_new_server, options, listening_sockets))
+    for unused_i in xrange(options.processes):
+        supervisor.add_worker(server_factory)
+    try:
+        # With --reuse-port, the workers tell the server which started this
+        # process that they're ready once they have bound their sockets.
+        supervisor.run(
+            started=functools.partial(_notify_ready, options, False))
+    finally:
+        server.server_close()
+
+
+def _run_acceptor_and_workers(options, acceptor):
+    """Serves acceptor in a process which hands off connections to the worker
+    processes of options.resource_processes and options.processes default
+    worker processes.
+    """
+
+    # Let the workers report the actual port for port number 0.
+    options.port = acceptor.server_port
+
+    supervisor = _WorkerProcessSupervisor(
+        functools.partial(_start_new_server, options,
+                          _get_listening_sockets(acceptor)))
+    supervisor.add_worker(lambda: acceptor)
+    all_channels = []
+    for resource, processes in (
+        options.resource_processes + [(None, options.processes)]):
+        channels = []
+        for unused_i in xrange(processes):
+            channel = _HandoffChannel()
+            supervisor.add_worker(
+                functools.partial(_start_handoff_worker, options, acceptor,
+                                  all_channels, channel))
+            channels.append(channel)
+        acceptor.add_channels(resource, channels)
+        all_channels += channels
+    try:
+        supervisor.run()
+    finally:
+        acceptor.server_close()
+        for channel in all_channels:
+            channel.close()
+
+
+def _start_handoff_worker(options, acceptor, all_channels, channel):
+    """Creates a _HandoffWorkerServer serving channel. Called in a new worker
+    process after fork so that the worker doesn't hold the listening sockets
+    of acceptor and the channels to the other workers.
+    """
+
+    acceptor.server_close()
+    for other_channel in all_channels:
+        if other_channel is not channel:
+            other_channel.close()
+    channel.close_sending_socket()
+    return _HandoffWorkerServer(options, channel)
+
+
+def _get_listening_sockets(server):
+    return [socket_ for socket_, unused_addrinfo in server._sockets]
+
+
+def _close_fds_except(fds):
+    """Closes the file descriptors other than the standard ones and fds.
+    Called in a new server process before exec so that it doesn't hold
+    connections, pipes and other sockets of this process.
+    """
+
+    start = 3
+    for fd in sorted(fds):
+        os.closerange(start, fd)
+        start = fd + 1
+    os.closerange(start, subprocess.MAXFD)
+
+
+def _start_new_server(options, listening_sockets):
+    """Starts a new server process with the command line of this process
+    which inherits listening_sockets and serves them along with this server.
+
+    The new server is ready when all holders of the write end of a pipe,
+    i.e. the new server process or its workers, have closed it and at least
+    one of them has written to it.
+
+    Returns:
+        True if the new server is ready to accept connections.
+    """
+
+    listen_fds = [(socket_.fileno(), socket_.family)
+                  for socket_ in listening_sockets]
+    ready_fd, ready_write_fd = os.pipe()
+    env = dict(os.environ)
+    env[_LISTEN_FDS_ENV] = ','.join(
+        '%d:%d' % listen_fd for listen_fd in listen_fds)
+    env[_READY_FD_ENV] = str(ready_write_fd)
+    try:
+        try:
+            process = subprocess.Popen(
+                options.command_line, cwd=options.command_line_cwd, env=env,
+                preexec_fn=functools.partial(
+                    _close_fds_except,
+                    [fd for fd, unused_family in listen_fds] +
+                    [ready_write_fd]))
+        finally:
+            os.close(ready_write_fd)
+        logging.info('Started new server process %d', process.pid)
+
+        deadline = time.time() + _RESTART_READY_TIMEOUT_IN_SEC
+        notified = False
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logging.error('New server process %d did not get ready in '
+                              '%d seconds', process.pid,
+                              _RESTART_READY_TIMEOUT_IN_SEC)
+                process.kill()
+                return False
+            try:
+                r, w, e = select.select([ready_fd], [], [], remaining)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not r:
+                continue
+            if not os.read(ready_fd, 1):
+                break
+            notified = True
+        if not notified:
+            logging.error('New server process %d exited before getting '
+                          'ready', process.pid)
+            return False
+        return True
+    except OSError, e:
+        logging.error('Failed to start new server: %s', e)
+        return False
+    finally:
+        os.close(ready_fd)
+
+
+def _restart(options, server):
+    """Starts a new server which takes over the listening sockets of server
+    and drains server once it's ready.
+    """
+
+    if _start_new_server(options, _get_listening_sockets(server)):
+        server.drain()
+
+
+def _notify_ready(options, ready=True):
+    """Tells the server which started this process on SIGUSR2, if any,
+    that this process is ready to accept connections.
+
+    Args:
+        ready: if False, lets other processes holding the pipe tell it
+            instead.
+    """
+
+    if options.ready_fd is None:
+        return
+    try:
+        if ready:
+            os.write(options.ready_fd, 'R')
+        os.close(options.ready_fd)
+    except OSError, e:
+        logging.warning('Failed to notify the old server: %s', e)
+    options.ready_fd = None
+
+
+def _get_inherited_fds():
+    """Removes the variables passed by _start_new_server from the
+    environment and returns the listening sockets and the readiness pipe in
+    them.
+
+    Returns:
+        a tuple of a list of (file descriptor, address family) pairs and the
+        file descriptor to notify the old server through, or None.
+    """
+
+    listen_fds = []
+    for value in os.environ.pop(_LISTEN_FDS_ENV, '').split(','):
+        if value:
+            fd, family = value.split(':')
+            listen_fds.append((int(fd), int(family)))
+    ready_fd = os.environ.pop(_READY_FD_ENV, None)
+    if ready_fd is not None:
+        ready_fd = int(ready_fd)
+    return listen_fds, ready_fd
+
+
+def _get_systemd_fds():
+    """Removes the variables of the systemd socket activation protocol from
+    the environment so that child processes don't take them, and returns the
+    listening sockets passed in them if they are for this process.
+
+    Returns:
+        a list of (file descriptor, address family) pairs.
+    """
+
+    listen_pid = os.environ.pop(_SYSTEMD_LISTEN_PID_ENV, None)
+    listen_fds = os.environ.pop(_SYSTEMD_LISTEN_FDS_ENV, None)
+    os.environ.pop(_SYSTEMD_LISTEN_FDNAMES_ENV, None)
+    if listen_pid is None or listen_fds is None:
+        return []
+    if int(listen_pid) != os.getpid():
+        return []
+
+    fds = []
+    for fd in xrange(_SYSTEMD_LISTEN_FDS_START,
+                     _SYSTEMD_LISTEN_FDS_START + int(listen_fds)):
+        # fromfd duplicates fd. The family given doesn't matter for
+        # getsockopt.
+        socket_ = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            family = socket_.getsockopt(socket.SOL_SOCKET, _SO_DOMAIN)
+            socktype = socket_.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+        finally:
+            socket_.close()
+        if socktype != socket.SOCK_STREAM:
+            raise ValueError('File descriptor %d is not a stream socket' % fd)
+        fds.append((fd, family))
+    return fds
+
+
+def _create_server(options):
+    if options.resource_processes:
+        return _AcceptorServer(options)
+    if options.server_mode == _SERVER_MODE_EPOLL:
+        return EpollWebSocketServer(options)
+    return WebSocketServer(options)
+
+
+def _handle_signals(options, server):
+    """Drains server on SIGTERM and restarts it on SIGUSR2 when it's served
+    by this process.
+    """
+
+    def handle_stop_signal(unused_signum, unused_frame):
+        # This runs on the thread running serve_forever which drain waits
+        # for.
+        threading.Thread(target=server.drain).start()
+
+    def handle_restart_signal(unused_signum, unused_frame):
+        thread = threading.Thread(target=_restart, args=(options, server))
+        thread.daemon = True
+        thread.start()
+
+    signal.signal(signal.SIGTERM, handle_stop_signal)
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, handle_restart_signal)
+
+
+def _serve(options, server):
+    """Starts the threads used by the extensions and serves until server is
+    shut down. Worker processes call this after fork since threads of the
+    parent process don't exist in the child.
+    """
+
+    _configure_deflate(options)
+    _configure_mux(options)
+
+    if options.thread_monitor_interval_in_sec > 0:
+        # Run a thread monitor to show the status of server threads for
+        # debugging.
+        ThreadMonitor(options.thread_monitor_interval_in_sec, server).start()
+
+    server.serve_forever()
+
+
 def _parse_args_and_config(args):
     parser = _build_option_parser()
 
@@ -1090,12 +3555,66 @@ def _main(args=None):
     of os.popen3.
     """
 
+    if args is None:
+        args = sys.argv[1:]
+    # Used to start a new server on SIGUSR2 the same way as this process,
+    # e.g. by a wrapper script. Paths in it may be relative to the current
+    # directory.
+    command_line = [sys.executable] + sys.argv
+    command_line_cwd = os.getcwd()
+
     options, args = _parse_args_and_config(args=args)
+    options.command_line = command_line
+    options.command_line_cwd = command_line_cwd
 
     os.chdir(options.document_root)
 
     _configure_logging(options)
 
+    if (options.deflate_level != zlib.Z_DEFAULT_COMPRESSION and
+        not (0 <= options.deflate_level <= 9)):
+        logging.critical('Invalid --deflate-level option: %r',
+                         options.deflate_level)
+        sys.exit(1)
+    if not (1 <= options.deflate_mem_level <= 9):
+        logging.critical('Invalid --deflate-mem-level option: %r',
+                         options.deflate_mem_level)
+        sys.exit(1)
+
+    if options.mux_fragment_quantum <= 0:
+        logging.critical('Invalid --mux-fragment-quantum option: %r',
+                         options.mux_fragment_quantum)
+        sys.exit(1)
+    if options.mux_write_window < 0:
+        logging.critical('Invalid --mux-write-window option: %r',
+                         options.mux_write_window)
+        sys.exit(1)
+    if options.mux_worker_threads < 0:
+        logging.critical('Invalid --mux-worker-threads option: %r',
+                         options.mux_worker_threads)
+        sys.exit(1)
+    if options.mux_max_channels_per_connection < 0:
+        logging.critical('Invalid --mux-max-channels-per-connection option: '
+                         '%r', options.mux_max_channels_per_connection)
+        sys.exit(1)
+    if options.mux_max_channels < 0:
+        logging.critical('Invalid --mux-max-channels option: %r',
+                         options.mux_max_channels)
+        sys.exit(1)
+    if (options.mux_worker_threads > 0 and
+        options.mux_max_channels > options.mux_worker_threads):
+        logging.critical('--mux-max-channels option must not exceed '
+                         '--mux-worker-threads option.')
+        sys.exit(1)
+    if options.mux_min_receive_window < 0:
+        logging.critical('Invalid --mux-min-receive-window option: %r',
+                         options.mux_min_receive_window)
+        sys.exit(1)
+    if options.mux_max_receive_window < options.mux_min_receive_window:
+        logging.critical('Invalid --mux-max-receive-window option: %r',
+                         options.mux_max_receive_window)
+        sys.exit(1)
+
     if options.allow_draft75:
         logging.warning('--allow_draft75 option is obsolete.')
 
@@ -1153,6 +3672,11 @@ def _main(args=None):
                     'To use TLS, specify private_key and certificate.')
             sys.exit(1)
 
+        if options.tls_handshake_timeout <= 0:
+            logging.critical('Invalid --tls-handshake-timeout option: %r',
+                             options.tls_handshake_timeout)
+            sys.exit(1)
+
         if (options.tls_client_cert_optional and
             not options.tls_client_auth):
             logging.critical('Client authentication must be enabled to '
@@ -1172,6 +3696,154 @@ def _main(args=None):
             logging.critical('TLS must be enabled for client authentication.')
             sys.exit(1)
 
+    if options.server_mode == _SERVER_MODE_EPOLL:
+        if not hasattr(select, 'epoll'):
+            logging.critical('epoll is not available on this platform.')
+            sys.exit(1)
+        if options.use_tls:
+            logging.critical('TLS is not supported in the epoll server '
+                             'mode.')
+            sys.exit(1)
+    if options.selector_threads <= 0:
+        logging.critical('Invalid --selector-threads option: %r',
+                         options.selector_threads)
+        sys.exit(1)
+    if options.event_loop_worker_threads <= 0:
+        logging.critical('Invalid --event-loop-worker-threads option: %r',
+                         options.event_loop_worker_threads)
+        sys.exit(1)
+    if options.event_loop_write_buffer_size <= 0:
+        logging.critical('Invalid --event-loop-write-buffer-size option: %r',
+                         options.event_loop_write_buffer_size)
+        sys.exit(1)
+
+    if options.request_header_timeout < 0:
+        logging.critical('Invalid --request-header-timeout option: %r',
+                         options.request_header_timeout)
+        sys.exit(1)
+    if options.handler_threads < 0:
+        logging.critical('Invalid --handler-threads option: %r',
+                         options.handler_threads)
+        sys.exit(1)
+    if options.handler_threads > 0:
+        if options.server_mode != _SERVER_MODE_THREADING:
+            logging.critical('--handler-threads option requires the '
+                             'threading server mode.')
+            sys.exit(1)
+        if options.handler_queue_size <= 0:
+            logging.critical('Invalid --handler-queue-size option: %r',
+                             options.handler_queue_size)
+            sys.exit(1)
+    if options.thread_stack_size < 0:
+        logging.critical('Invalid --thread-stack-size option: %r',
+                         options.thread_stack_size)
+        sys.exit(1)
+    if options.thread_stack_size > 0:
+        try:
+            threading.stack_size(options.thread_stack_size * 1024)
+        except (ValueError, threading.ThreadError), e:
+            logging.critical('Invalid --thread-stack-size option: %r (%s)',
+                             options.thread_stack_size, e)
+            sys.exit(1)
+
+    if options.processes <= 0:
+        logging.critical('Invalid --processes option: %r', options.processes)
+        sys.exit(1)
+    if options.processes > 1 and not hasattr(os, 'fork'):
+        logging.critical('--processes option requires os.fork.')
+        sys.exit(1)
+    if options.reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+        logging.critical('SO_REUSEPORT is not available on this platform.')
+        sys.exit(1)
+
+    if options.unix_sockets and not hasattr(socket, 'AF_UNIX'):
+        logging.critical('Unix-domain sockets are not available on this '
+                         'platform.')
+        sys.exit(1)
+    if options.unix_sockets and options.reuse_port:
+        logging.critical('--unix-socket option can\'t be used with '
+                         '--reuse-port as each process would remove the '
+                         'socket file of the others.')
+        sys.exit(1)
+    options.listen_tcp = options.port_specified or not options.unix_sockets
+
+    if options.drain_timeout < 0:
+        logging.critical('Invalid --drain-timeout option: %r',
+                         options.drain_timeout)
+        sys.exit(1)
+    if options.drain_rate < 0:
+        logging.critical('Invalid --drain-rate option: %r',
+                         options.drain_rate)
+        sys.exit(1)
+    try:
+        options.listen_fds, options.ready_fd = _get_inherited_fds()
+    except ValueError, e:
+        logging.critical('Invalid %s or %s environment variable: %s',
+                         _LISTEN_FDS_ENV, _READY_FD_ENV, e)
+        sys.exit(1)
+    try:
+        systemd_fds = _get_systemd_fds()
+    except (ValueError, socket.error), e:
+        logging.critical('Invalid sockets passed by systemd: %s', e)
+        sys.exit(1)
+    if not options.listen_fds:
+        options.listen_fds = systemd_fds
+    if systemd_fds and options.reuse_port:
+        # Workers of --reuse-port would bind their own sockets instead.
+        logging.critical('--reuse-port option can\'t be used with sockets '
+                         'passed by systemd.')
+        sys.exit(1)
+
+    if options.send_buffer_size < 0:
+        logging.critical('Invalid --send-buffer-size option: %r',
+                         options.send_buffer_size)
+        sys.exit(1)
+    if options.receive_buffer_size < 0:
+        logging.critical('Invalid --receive-buffer-size option: %r',
+                         options.receive_buffer_size)
+        sys.exit(1)
+    for name, value, constant in [
+        ('--tcp-keepalive-idle', options.tcp_keepalive_idle, 'TCP_KEEPIDLE'),
+        ('--tcp-keepalive-interval', options.tcp_keepalive_interval,
+         'TCP_KEEPINTVL'),
+        ('--tcp-keepalive-count', options.tcp_keepalive_count, 'TCP_KEEPCNT'),
+        ('--tcp-defer-accept', options.tcp_defer_accept, 'TCP_DEFER_ACCEPT')]:
+        if value < 0:
+            logging.critical('Invalid %s option: %r', name, value)
+            sys.exit(1)
+        if value > 0 and not hasattr(socket, constant):
+            logging.critical('%s is not available on this platform.',
+                             constant)
+            sys.exit(1)
+    if (not options.tcp_keepalive and
+        (options.tcp_keepalive_idle or options.tcp_keepalive_interval or
+         options.tcp_keepalive_count)):
+        logging.critical('TCP keepalive must be enabled by --tcp-keepalive '
+                         'to specify its idle time, interval or count.')
+        sys.exit(1)
+
+    resource_processes = []
+    for value in options.resource_processes:
+        resource, sep, processes = value.rpartition('=')
+        try:
+            processes = int(processes)
+        except ValueError:
+            processes = 0
+        if not resource or processes <= 0:
+            logging.critical('Invalid --resource-processes option: %r', value)
+            sys.exit(1)
+        resource_processes.append((resource, processes))
+    options.resource_processes = resource_processes
+    if options.resource_processes:
+        if options.server_mode != _SERVER_MODE_EPOLL:
+            logging.critical('--resource-processes option requires the '
+                             'epoll server mode.')
+            sys.exit(1)
+        if not hasattr(_multiprocessing, 'sendfd'):
+            logging.critical('--resource-processes option requires passing '
+                             'file descriptors over Unix domain sockets.')
+            sys.exit(1)
+
     if not options.scan_dir:
         options.scan_dir = options.websock_handlers
 
@@ -1180,13 +3852,21 @@ def _main(args=None):
             options.basic_auth_credential)
 
     try:
-        if options.thread_monitor_interval_in_sec > 0:
-            # Run a thread monitor to show the status of server threads for
-            # debugging.
-            ThreadMonitor(options.thread_monitor_interval_in_sec).start()
-
-        server = WebSocketServer(options)
-        server.serve_forever()
+        server = _create_server(options)
+        if options.resource_processes:
+            for resource, unused_processes in options.resource_processes:
+                if options.dispatcher.get_handler_suite(resource) is None:
+                    logging.critical('No handler for --resource-processes '
+                                     'option: %r', resource)
+                    sys.exit(1)
+            _notify_ready(options)
+            _run_acceptor_and_workers(options, server)
+        elif options.processes > 1:
+            _run_worker_processes(options, server)
+        else:
+            _notify_ready(options)
+            _handle_signals(options, server)
+            _serve(options, server)
     except Exception, e:
         logging.critical('mod_pywebsocket: %s' % e)
         logging.critical('mod_pywebsocket: %s' % util.get_stack_trace())
@@ -47,11 +47,15 @@ except ImportError:
     md5_hash = md5.md5
     sha1_hash = sha.sha
 
+import Queue
 import StringIO
 import logging
 import os
 import re
 import socket
+import sys
+import threading
+import time
 import traceback
 import zlib
 
@@ -215,6 +219,171 @@ class RepeatedXorMasker(object):
         mask = _mask_using_array
 
 
+class _WorkerPoolJob(object):
+    """Holds a function submitted to a WorkerPool and its outcome."""
+
+    def __init__(self, function, args):
+        self._function = function
+        self._args = args
+        self._result = None
+        self._exc_info = None
+        self._done = threading.Event()
+
+    def execute(self):
+        try:
+            self._result = self._function(*self._args)
+        except:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+    def result(self):
+        """Blocks until the job completes and returns the return value of
+        the function. If the function raised an exception, re-raises it on
+        the calling thread.
+        """
+
+        self._done.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class WorkerPool(object):
+    """A fixed number of daemon threads that run submitted functions.
+
+    The pool itself doesn't order jobs across callers. Callers that need
+    sequential processing (e.g. a deflater carrying context takeover state)
+    must wait for the result of a job before submitting the next one.
+    """
+
+    def __init__(self, num_threads, name='WorkerPool', max_queued_jobs=0):
+        """Construct an instance.
+
+        Args:
+            num_threads: number of threads to start. Must be positive.
+            name: prefix of the names of the threads.
+            max_queued_jobs: maximum number of jobs waiting for a thread.
+                When reached, submit blocks and try_submit rejects jobs. If
+                0, the number is unlimited.
+        """
+
+        if num_threads <= 0:
+            raise ValueError('num_threads must be positive')
+        if max_queued_jobs < 0:
+            raise ValueError('max_queued_jobs must not be negative')
+
+        self._logger = get_class_logger(self)
+
+        self._queue = Queue.Queue(max_queued_jobs)
+        self._count_lock = threading.Lock()
+        self._active_count = 0
+        self._rejected_count = 0
+        self._threads = []
+        for i in xrange(num_threads):
+            thread = threading.Thread(
+                target=self._run, name='%s-%d' % (name, i))
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _update_active_count(self, delta):
+        self._count_lock.acquire()
+        try:
+            self._active_count += delta
+        finally:
+            self._count_lock.release()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            self._update_active_count(1)
+            try:
+                job.execute()
+            finally:
+                self._update_active_count(-1)
+
+    def submit(self, function, *args):
+        """Queues function(*args) and returns a job object whose result
+        method returns the outcome.
+        """
+
+        job = _WorkerPoolJob(function, args)
+        self._queue.put(job)
+        return job
+
+    def try_submit(self, function, *args):
+        """Same as submit but returns None instead of waiting when
+        max_queued_jobs jobs are already waiting for a thread.
+        """
+
+        job = _WorkerPoolJob(function, args)
+        try:
+            self._queue.put_nowait(job)
+        except Queue.Full:
+            self._count_lock.acquire()
+            try:
+                self._rejected_count += 1
+            finally:
+                self._count_lock.release()
+            return None
+        return job
+
+    def get_thread_count(self):
+        """Returns the number of threads of the pool."""
+
+        return len(self._threads)
+
+    def get_active_count(self):
+        """Returns the number of jobs being run."""
+
+        return self._active_count
+
+    def get_queued_count(self):
+        """Returns the number of jobs waiting for a thread."""
+
+        return self._queue.qsize()
+
+    def get_rejected_count(self):
+        """Returns the number of jobs rejected by try_submit so far."""
+
+        return self._rejected_count
+
+    def run(self, function, *args):
+        """Runs function(*args) on the pool and blocks until it completes.
+
+        When called from one of the threads of this pool, function is run
+        directly so that a job running on the pool can use the pool again
+        without waiting for itself.
+        """
+
+        if threading.currentThread() in self._threads:
+            return function(*args)
+        return self.submit(function, *args).result()
+
+    def shutdown(self, wait=True):
+        """Makes the threads exit after finishing queued jobs.
+
+        Args:
+            wait: if True, waits for the threads to exit.
+        """
+
+        # Let the sentinels in even when max_queued_jobs jobs are waiting.
+        self._queue.mutex.acquire()
+        try:
+            self._queue.maxsize = 0
+        finally:
+            self._queue.mutex.release()
+        for unused_thread in self._threads:
+            self._queue.put(None)
+        if not wait:
+            return
+        for thread in self._threads:
+            if thread is not threading.currentThread():
+                thread.join()
+
+
 # By making wbits option negative, we can suppress CMF/FLG (2 octet) and
 # ADLER32 (4 octet) fields of zlib so that we can use zlib module just as
 # deflate library. DICTID won't be added as far as we don't set dictionary.
@@ -222,8 +391,8 @@ class RepeatedXorMasker(object):
 # For decompression, we can just use 32K to cover any windows size. For
 # compression, we use 32K so receivers must use 32K.
 #
-# Compression level is Z_DEFAULT_COMPRESSION. We don't have to match level
-# to decode.
+# Compression level is Z_DEFAULT_COMPRESSION by default. We don't have to
+# match level to decode.
 #
 # See zconf.h, deflate.cc, inflate.cc of zlib library, and zlibmodule.c of
 # Python. See also RFC1950 (ZLIB 3.3).
@@ -231,11 +400,12 @@ class RepeatedXorMasker(object):
 
 class _Deflater(object):
 
-    def __init__(self, window_bits):
+    def __init__(self, window_bits, level=zlib.Z_DEFAULT_COMPRESSION,
+                 mem_level=zlib.DEF_MEM_LEVEL):
         self._logger = get_class_logger(self)
 
         self._compress = zlib.compressobj(
-            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -window_bits)
+            level, zlib.DEFLATED, -window_bits, mem_level)
 
     def compress(self, bytes):
         compressed_bytes = self._compress.compress(bytes)
@@ -272,18 +442,23 @@ class _Inflater(object):
         if not (size == -1 or size > 0):
             raise Exception('size must be -1 or positive')
 
-        data = ''
+        # Collect decompressed chunks into a list and join them at the end to
+        # avoid quadratic cost of repeated string concatenation.
+        chunks = []
+        remaining = size
 
         while True:
             if size == -1:
-                data += self._decompress.decompress(self._unconsumed)
+                chunks.append(self._decompress.decompress(self._unconsumed))
                 # See Python bug http://bugs.python.org/issue12050 to
                 # understand why the same code cannot be used for updating
                 # self._unconsumed for here and else block.
                 self._unconsumed = ''
             else:
-                data += self._decompress.decompress(
-                    self._unconsumed, size - len(data))
+                chunk = self._decompress.decompress(
+                    self._unconsumed, remaining)
+                chunks.append(chunk)
+                remaining -= len(chunk)
                 self._unconsumed = self._decompress.unconsumed_tail
             if self._decompress.unused_data:
                 # Encountered a last block (i.e. a block with BFINAL = 1) and
@@ -295,7 +470,7 @@ class _Inflater(object):
                 # empty.
                 self._unconsumed = self._decompress.unused_data
                 self.reset()
-                if size >= 0 and len(data) == size:
+                if size >= 0 and remaining == 0:
                     # data is filled. Don't call decompress again.
                     break
                 else:
@@ -309,6 +484,7 @@ class _Inflater(object):
                 # don't have to "continue" here.
                 break
 
+        data = ''.join(chunks)
         if data:
             self._logger.debug('Decompressed %r', data)
         return data
@@ -330,16 +506,63 @@ class _RFC1979Deflater(object):
     flushes using the algorithm described in the RFC1979 section 2.1.
     """
 
-    def __init__(self, window_bits, no_context_takeover):
+    def __init__(self, window_bits, no_context_takeover,
+                 worker_pool=None, offload_threshold=0,
+                 level=zlib.Z_DEFAULT_COMPRESSION,
+                 mem_level=zlib.DEF_MEM_LEVEL):
+        """Construct an instance.
+
+        Args:
+            window_bits: LZ77 window size in bits. None for the default.
+            no_context_takeover: True to reset the LZ77 window at the end of
+                each message.
+            worker_pool: WorkerPool instance to run compression of input of
+                offload_threshold octets or more on. None to always run it on
+                the calling thread.
+            offload_threshold: see worker_pool.
+            level: compression level (0-9 or zlib.Z_DEFAULT_COMPRESSION).
+            mem_level: memLevel of zlib (1-9). Larger values use more memory
+                for faster and better compression.
+        """
+
         self._deflater = None
         if window_bits is None:
             window_bits = zlib.MAX_WBITS
         self._window_bits = window_bits
         self._no_context_takeover = no_context_takeover
+        self._worker_pool = worker_pool
+        self._offload_threshold = offload_threshold
+        self._level = level
+        self._mem_level = mem_level
+        self._filter_time = 0.0
 
     def filter(self, bytes, end=True, bfinal=False):
+        if (self._worker_pool is not None and
+            len(bytes) >= self._offload_threshold):
+            # zlib releases the GIL while compressing. The caller blocks until
+            # the job completes so that the deflater is never used by two
+            # threads at once.
+            return self._worker_pool.run(
+                self._timed_filter, bytes, end, bfinal)
+        return self._timed_filter(bytes, end, bfinal)
+
+    def get_filter_time(self):
+        """Returns the seconds the last filter call spent in compression,
+        excluding the time it waited for a thread of the worker pool.
+        """
+
+        return self._filter_time
+
+    def _timed_filter(self, bytes, end, bfinal):
+        start_time = time.time()
+        result = self._filter(bytes, end, bfinal)
+        self._filter_time = time.time() - start_time
+        return result
+
+    def _filter(self, bytes, end, bfinal):
         if self._deflater is None:
-            self._deflater = _Deflater(self._window_bits)
+            self._deflater = _Deflater(
+                self._window_bits, self._level, self._mem_level)
 
         if bfinal:
             result = self._deflater.compress_and_finish(bytes)
@@ -367,14 +590,61 @@ class _RFC1979Inflater(object):
     the algorithm described in the RFC1979 section 2.1.
     """
 
-    def __init__(self, window_bits=zlib.MAX_WBITS):
+    def __init__(self, window_bits=zlib.MAX_WBITS,
+                 worker_pool=None, offload_threshold=0):
+        """Construct an instance.
+
+        Args:
+            window_bits: LZ77 window size in bits.
+            worker_pool: WorkerPool instance to run decompression of input of
+                offload_threshold octets or more on. None to always run it on
+                the calling thread.
+            offload_threshold: see worker_pool.
+        """
+
         self._inflater = _Inflater(window_bits)
+        self._worker_pool = worker_pool
+        self._offload_threshold = offload_threshold
+        self._filter_time = 0.0
+
+    def filter(self, bytes, max_size=-1):
+        """Decompresses bytes.
+
+        Args:
+            bytes: compressed bytes.
+            max_size: if non-negative, decompression stops once more than
+                max_size octets are produced, and at most max_size + 1 octets
+                are returned so that the caller can tell that the output
+                exceeds max_size without inflating the rest. The inflater
+                must not be used any more in that case.
+        """
+
+        if (self._worker_pool is not None and
+            len(bytes) >= self._offload_threshold):
+            return self._worker_pool.run(self._timed_filter, bytes, max_size)
+        return self._timed_filter(bytes, max_size)
+
+    def get_filter_time(self):
+        """Returns the seconds the last filter call spent in
+        decompression, excluding the time it waited for a thread of the
+        worker pool.
+        """
+
+        return self._filter_time
+
+    def _timed_filter(self, bytes, max_size):
+        start_time = time.time()
+        result = self._filter(bytes, max_size)
+        self._filter_time = time.time() - start_time
+        return result
 
-    def filter(self, bytes):
+    def _filter(self, bytes, max_size):
         # Restore stripped LEN and NLEN field of a non-compressed block added
         # for Z_SYNC_FLUSH.
         self._inflater.append(bytes + '\x00\x00\xff\xff')
-        return self._inflater.decompress(-1)
+        if max_size < 0:
+            return self._inflater.decompress(-1)
+        return self._inflater.decompress(max_size + 1)
 
 
 class DeflateSocket(object):
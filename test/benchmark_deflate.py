@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""Benchmark for sending large messages with permessage-deflate.
+
+Compares throughput of send_message for a large compressible message with and
+without splitting it into fragments, and with and without compressing the next
+fragment on a worker pool while the current one is being written.
+
+The connection is simulated by a mock whose write method sleeps for the time
+the given bandwidth takes to transmit the data, so that the overlap of
+compression and network I/O shows up in the result.
+
+Run this under pywebsocket's src directory, e.g.
+    python test/benchmark_deflate.py --message-size 100
+"""
+
+
+import optparse
+import random
+import time
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from mod_pywebsocket import common
+from mod_pywebsocket import extensions
+from mod_pywebsocket import util
+from mod_pywebsocket.stream import Stream
+from mod_pywebsocket.stream import StreamOptions
+from test import mock
+
+
+class _ThrottledConn(mock.MockConn):
+    """MockConn whose write takes as long as sending the data at the given
+    bandwidth. Written data is counted and discarded.
+    """
+
+    def __init__(self, bytes_per_second):
+        mock.MockConn.__init__(self, '')
+        self._bytes_per_second = bytes_per_second
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        if self._bytes_per_second > 0:
+            time.sleep(float(len(data)) / self._bytes_per_second)
+
+
+def _create_message(size):
+    """Creates a compressible message of size bytes."""
+
+    random.seed(0)
+    words = ['%08x' % random.randint(0, 0xfff) for i in xrange(256)]
+    chunks = []
+    length = 0
+    while length < size:
+        chunk = ' '.join(random.sample(words, 32))
+        chunks.append(chunk)
+        length += len(chunk)
+    return ''.join(chunks)[:size]
+
+
+def _send(message, deflate_options, bytes_per_second):
+    request = mock.MockRequest(connection=_ThrottledConn(bytes_per_second))
+    request.ws_version = common.VERSION_HYBI_LATEST
+
+    original_deflate_options = extensions.get_deflate_options()
+    extensions.set_deflate_options(deflate_options)
+    try:
+        processor = extensions.PerMessageDeflateExtensionProcessor(
+            common.ExtensionParameter(common.PERMESSAGE_DEFLATE_EXTENSION))
+        processor.get_extension_response()
+    finally:
+        extensions.set_deflate_options(original_deflate_options)
+
+    stream_options = StreamOptions()
+    processor.setup_stream_options(stream_options)
+    stream = Stream(request, stream_options)
+
+    start = time.time()
+    stream.send_message(message, binary=True)
+    elapsed = time.time() - start
+
+    return elapsed, request.connection.bytes_written
+
+
+def _report(name, message_size, elapsed, bytes_written):
+    print '%-24s %8.3f s %10.2f MB/s (wire %d bytes)' % (
+        name, elapsed, message_size / elapsed / 1024 / 1024, bytes_written)
+
+
+def _main():
+    parser = optparse.OptionParser()
+    parser.add_option('--message-size', '--message_size',
+                      dest='message_size', type='int', default=100,
+                      help='Size of the message to send in MiB')
+    parser.add_option('--fragment-size', '--fragment_size',
+                      dest='fragment_size', type='int', default=1024,
+                      help='Size of fragments in KiB')
+    parser.add_option('--bandwidth', dest='bandwidth', type='int',
+                      default=10,
+                      help=('Simulated bandwidth of the connection in MiB/s. '
+                            '0 for unlimited.'))
+    parser.add_option('--worker-threads', '--worker_threads',
+                      dest='worker_threads', type='int', default=1,
+                      help='Number of threads of the deflate worker pool')
+    options, unused_args = parser.parse_args()
+
+    message_size = options.message_size * 1024 * 1024
+    message = _create_message(message_size)
+    bytes_per_second = options.bandwidth * 1024 * 1024
+
+    deflate_options = extensions.DeflateOptions()
+    elapsed, bytes_written = _send(message, deflate_options, bytes_per_second)
+    _report('whole message', message_size, elapsed, bytes_written)
+
+    deflate_options = extensions.DeflateOptions()
+    deflate_options.fragment_size = options.fragment_size * 1024
+    elapsed, bytes_written = _send(message, deflate_options, bytes_per_second)
+    _report('fragmented', message_size, elapsed, bytes_written)
+
+    worker_pool = util.WorkerPool(options.worker_threads)
+    try:
+        deflate_options = extensions.DeflateOptions()
+        deflate_options.fragment_size = options.fragment_size * 1024
+        deflate_options.worker_pool = worker_pool
+        elapsed, bytes_written = _send(
+            message, deflate_options, bytes_per_second)
+        _report('fragmented, pipelined', message_size, elapsed, bytes_written)
+    finally:
+        worker_pool.shutdown()
+
+
+if __name__ == '__main__':
+    _main()
+
+
+# vi:sts=4 sw=4 et
@@ -0,0 +1,616 @@
+#!/usr/bin/env python
+#
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""Benchmarks for the multiplexing extension implementation.
+
+Run this under pywebsocket's src directory, e.g.
+    python test/benchmark_mux.py
+"""
+
+
+import heapq
+import optparse
+import threading
+import time
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from mod_pywebsocket import common
+from mod_pywebsocket import mux
+from mod_pywebsocket import util
+from mod_pywebsocket._stream_hybi import Stream
+from mod_pywebsocket._stream_hybi import StreamOptions
+
+import mock
+
+
+def _benchmark_control_block_parse(num_messages):
+    """Measures parsing control channel messages each of which carries many
+    control blocks.
+    """
+
+    blocks = []
+    for channel_id in (2, 200, 20000, 2000000):
+        for quota in (100, 1000, 100000):
+            blocks.append(mux._create_flow_control(channel_id, quota))
+        blocks.append(mux._create_drop_channel(
+            channel_id, common.STATUS_NORMAL_CLOSURE, 'bye'))
+    blocks.append(mux._create_new_channel_slot(64, 8192))
+    message = mux._encode_channel_id(mux._CONTROL_CHANNEL_ID) + ''.join(blocks)
+
+    start = time.time()
+    for unused_i in xrange(num_messages):
+        parser = mux._MuxFramePayloadParser(message)
+        parser.read_channel_id()
+        for unused_block in parser.read_control_blocks():
+            pass
+    elapsed = time.time() - start
+
+    num_blocks = num_messages * len(blocks)
+    print '  %6d messages x %2d blocks %8.3f s %10.0f blocks/s' % (
+        num_messages, len(blocks), elapsed, num_blocks / elapsed)
+
+
+def _benchmark_inner_frame_parse(payload_size, num_messages):
+    """Measures parsing the channel id and the inner frame header of small
+    encapsulated frames.
+    """
+
+    messages = [mux._encode_channel_id(channel_id) +
+                chr(0x80 | common.OPCODE_BINARY) + 'x' * payload_size
+                for channel_id in (2, 200, 20000, 2000000)]
+
+    start = time.time()
+    for unused_i in xrange(num_messages / len(messages)):
+        for message in messages:
+            parser = mux._MuxFramePayloadParser(message)
+            parser.read_channel_id()
+            parser.read_inner_frame()
+    elapsed = time.time() - start
+
+    print '  %6d bytes x %7d %8.3f s %10.0f frames/s' % (
+        payload_size, num_messages, elapsed, num_messages / elapsed)
+
+
+class _ReceiveBenchmarkMuxHandler(mux._MuxHandler):
+    """_MuxHandler which drops outgoing control data so that the inbound
+    path can be measured without the writer thread.
+    """
+
+    def send_control_data(self, data):
+        pass
+
+    def send_flow_control(self, channel_id, replenished_quota):
+        pass
+
+
+def _benchmark_logical_stream_receive(message_size, num_messages, frame_size):
+    """Measures the inbound path from dispatching encapsulated frames on the
+    mux handler to receiving messages on a logical stream, i.e. what the
+    echo scenarios of mux_client_for_testing.py exercise on the server.
+    """
+
+    channel_id = 2
+    handler = _ReceiveBenchmarkMuxHandler(
+        mock.MockRequest(connection=mock.MockConn('')), None)
+    connection = mux._LogicalConnection(handler, channel_id)
+    request = mux._LogicalRequest(channel_id, 'GET', '/echo', 'HTTP/1.1', {},
+                                  connection)
+    request.ws_version = common.VERSION_HYBI_LATEST
+    request.ws_stream = mux._LogicalStream(
+        request, StreamOptions(), send_quota=0,
+        receive_quota=message_size * num_messages * 2)
+    handler._logical_channels[channel_id] = mux._LogicalChannelData(
+        request, None)
+
+    message = 'x' * message_size
+    encoded_channel_id = mux._encode_channel_id(channel_id)
+    frames = []
+    for position in xrange(0, message_size, frame_size):
+        if position == 0:
+            opcode = common.OPCODE_BINARY
+        else:
+            opcode = common.OPCODE_CONTINUATION
+        fin = position + frame_size >= message_size
+        frames.append(encoded_channel_id + chr((fin << 7) | opcode) +
+                      message[position:position + frame_size])
+
+    start = time.time()
+    for unused_i in xrange(num_messages):
+        for frame in frames:
+            handler.dispatch_message(frame)
+        request.ws_stream.receive_message()
+    elapsed = time.time() - start
+
+    print '  %8d bytes x %6d %8.3f s %10.2f MB/s %10.0f msg/s' % (
+        message_size, num_messages, elapsed,
+        message_size * num_messages / elapsed / 1024 / 1024,
+        num_messages / elapsed)
+
+
+class _ThrottledConnection(object):
+    """Physical connection whose writes take as long as they would take on a
+    link of the given bandwidth (bytes per second).
+    """
+
+    remote_addr = None
+
+    def __init__(self, bandwidth):
+        self._bandwidth = bandwidth
+
+    def write(self, data):
+        time.sleep(len(data) / float(self._bandwidth))
+
+
+def _create_benchmark_logical_request(handler, channel_id):
+    connection = mux._LogicalConnection(handler, channel_id)
+    request = mux._LogicalRequest(channel_id, 'GET', '/', 'HTTP/1.1', {},
+                                  connection)
+    request.ws_version = common.VERSION_HYBI_LATEST
+    request.ws_stream = mux._LogicalStream(
+        request, StreamOptions(), send_quota=1 << 40, receive_quota=1 << 40)
+    handler._logical_channels[channel_id] = mux._LogicalChannelData(
+        request, None)
+    return request
+
+
+def _start_benchmark_mux_handler(physical_connection, mux_options,
+                                 channel_ids, dispatcher=None):
+    """Starts a _MuxHandler whose writer thread writes to physical_connection
+    and creates logical requests for channel_ids on it. Only the writer
+    thread is started.
+    """
+
+    saved_mux_options = mux.get_mux_options()
+    mux.set_mux_options(mux_options)
+    try:
+        physical_request = mock.MockRequest(connection=physical_connection)
+        physical_request.ws_stream = Stream(physical_request, StreamOptions())
+        handler = mux._MuxHandler(physical_request, dispatcher)
+        handler._writer = mux._PhysicalConnectionWriter(handler)
+        handler._writer.start()
+
+        requests = [_create_benchmark_logical_request(handler, channel_id)
+                    for channel_id in channel_ids]
+    finally:
+        mux.set_mux_options(saved_mux_options)
+    return handler, requests
+
+
+def _percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, len(sorted_values) * percent / 100)
+    return sorted_values[index]
+
+
+def _benchmark_mixed_channels(fragment_quantum, bandwidth, bulk_size,
+                              interactive_size):
+    """Sends a bulk message on one logical channel while another logical
+    channel keeps sending small messages at intervals, over a physical
+    connection throttled to bandwidth, and measures how long each small
+    message takes to be written.
+    """
+
+    mux_options = mux.MuxOptions()
+    mux_options.fragment_quantum = fragment_quantum
+    handler, (bulk_request, interactive_request) = (
+        _start_benchmark_mux_handler(
+            _ThrottledConnection(bandwidth), mux_options, [2, 3]))
+
+    bulk_result = {}
+
+    def _send_bulk():
+        start = time.time()
+        bulk_request.ws_stream.send_message('x' * bulk_size, binary=True)
+        bulk_request.connection.wait_until_write_done()
+        bulk_result['elapsed'] = time.time() - start
+
+    bulk_thread = threading.Thread(target=_send_bulk)
+    bulk_thread.start()
+    time.sleep(0.05)
+
+    latencies = []
+    message = 'y' * interactive_size
+    while bulk_thread.isAlive():
+        start = time.time()
+        interactive_request.ws_stream.send_message(message, binary=True)
+        interactive_request.connection.wait_until_write_done()
+        latencies.append(time.time() - start)
+        time.sleep(0.01)
+    bulk_thread.join()
+    handler._writer.stop()
+    handler._writer.join()
+
+    latencies.sort()
+    print '  quantum %10d: bulk %7.2f MB/s, %4d interactive messages ' \
+        'p50 %7.1f ms p99 %7.1f ms max %7.1f ms' % (
+            fragment_quantum,
+            bulk_size / bulk_result['elapsed'] / 1024 / 1024,
+            len(latencies),
+            _percentile(latencies, 50) * 1000,
+            _percentile(latencies, 99) * 1000,
+            latencies[-1] * 1000)
+
+
+class _NullConnection(object):
+    """Physical connection which discards written data."""
+
+    remote_addr = None
+
+    def write(self, data):
+        pass
+
+
+def _benchmark_channel_send(write_window, message_size, num_messages):
+    """Measures how fast a single logical channel can send messages through
+    the writer thread.
+    """
+
+    mux_options = mux.MuxOptions()
+    mux_options.write_window = write_window
+    handler, (request,) = _start_benchmark_mux_handler(
+        _NullConnection(), mux_options, [2])
+
+    message = 'x' * message_size
+    start = time.time()
+    for unused_i in xrange(num_messages):
+        request.ws_stream.send_message(message, binary=True)
+    request.connection.wait_until_write_done()
+    elapsed = time.time() - start
+    handler._writer.stop()
+    handler._writer.join()
+
+    print '  window %8d: %6d bytes x %6d %10.2f MB/s %10.0f msg/s' % (
+        write_window, message_size, num_messages,
+        message_size * num_messages / elapsed / 1024 / 1024,
+        num_messages / elapsed)
+
+
+def _benchmark_receive_window(max_window, rtt, bandwidth, duration):
+    """Simulates a client sending data on a logical channel as fast as its
+    quota allows over a link with the given round-trip time and bandwidth,
+    to a handler which reads data as soon as it arrives, and measures the
+    throughput. Time is simulated.
+    """
+
+    now = [0.0]
+    window = mux._ReceiveWindow(mux._INITIAL_QUOTA_FOR_CLIENT, max_window,
+                                timer=lambda: now[0])
+    frame_size = 16 * 1024
+    client_quota = mux._INITIAL_QUOTA_FOR_CLIENT
+    link_free_at = 0.0
+    received = 0
+    # Heap of (time, kind, amount). 'frame' events arrive at the server and
+    # 'quota' events (FlowControl) arrive at the client.
+    events = []
+    while now[0] < duration:
+        while client_quota > 0:
+            size = min(frame_size, client_quota)
+            client_quota -= size
+            link_free_at = max(link_free_at, now[0]) + float(size) / bandwidth
+            heapq.heappush(events, (link_free_at + rtt / 2, 'frame', size))
+        now[0], kind, amount = heapq.heappop(events)
+        if kind == 'frame':
+            window.consume(amount)
+            received += amount
+            heapq.heappush(events, (now[0] + rtt / 2, 'quota',
+                                    window.replenish(amount)))
+        else:
+            client_quota += amount
+
+    print '  max window %8d: %8.2f MB/s, window %8d, rtt %6.1f ms' % (
+        max_window, received / now[0] / 1024 / 1024, window.get_window(),
+        window.get_rtt() * 1000)
+
+
+class _CountingCondition(object):
+    """threading.Condition which counts acquisitions, and acquisitions which
+    had to wait for another thread to release it.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.acquisitions = 0
+        self.contentions = 0
+
+    def acquire(self):
+        if not self._condition.acquire(False):
+            self._condition.acquire()
+            self.contentions += 1
+        self.acquisitions += 1
+
+    def release(self):
+        self._condition.release()
+
+    def wait(self, timeout=None):
+        self._condition.wait(timeout)
+
+    def notify(self):
+        self._condition.notify()
+
+
+def _benchmark_channel_table(num_channels, num_messages):
+    """Echoes num_messages small messages on each of num_channels logical
+    channels. The main thread dispatches frames like the reader thread
+    does, a thread per channel echoes them back, and the writer thread
+    writes them, so that all of them look up the logical channel table.
+    """
+
+    channel_ids = range(2, num_channels + 2)
+    handler, requests = _start_benchmark_mux_handler(
+        _NullConnection(), mux.MuxOptions(), channel_ids)
+    condition = _CountingCondition()
+    handler._logical_channels_condition = condition
+
+    def _echo(request):
+        for unused_i in xrange(num_messages):
+            message = request.ws_stream.receive_message()
+            request.ws_stream.send_message(message, binary=True)
+        request.connection.wait_until_write_done()
+
+    workers = [threading.Thread(target=_echo, args=(request,))
+               for request in requests]
+    for worker in workers:
+        worker.start()
+
+    frames = [mux._encode_channel_id(channel_id) +
+              chr(0x80 | common.OPCODE_BINARY) + 'x' * 16
+              for channel_id in channel_ids]
+    start = time.time()
+    for unused_i in xrange(num_messages):
+        for frame in frames:
+            handler.dispatch_message(frame)
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    handler._writer.stop()
+    handler._writer.join()
+
+    print '  %4d channels x %6d messages %8.3f s %10.0f msg/s, ' \
+        'table lock taken %7d times, contended %5d times' % (
+            num_channels, num_messages, elapsed,
+            num_channels * num_messages / elapsed, condition.acquisitions,
+            condition.contentions)
+
+
+class _ControlMessageCountingStream(object):
+    """Physical stream which counts messages and bytes sent."""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def send_binary_messages(self, messages):
+        self.messages += len(messages)
+        for message in messages:
+            for buffer in message:
+                self.bytes += len(buffer)
+
+    def close_connection(self, code, wait_response=True):
+        pass
+
+
+def _benchmark_flow_control(merge, num_channels, num_reads):
+    """Sends FlowControl for num_reads reads on each of num_channels logical
+    channels and counts the control messages written. Unless merge is True,
+    each FlowControl is queued as separate control data, which the writer
+    thread only puts together with the control blocks next to it.
+    """
+
+    stream = _ControlMessageCountingStream()
+    handler, unused_requests = _start_benchmark_mux_handler(
+        _NullConnection(), mux.MuxOptions(), [])
+    handler.physical_stream = stream
+
+    start = time.time()
+    for unused_i in xrange(num_reads):
+        for channel_id in xrange(2, num_channels + 2):
+            if merge:
+                handler.send_flow_control(channel_id, 1024)
+            else:
+                handler.send_control_data(
+                    mux._create_flow_control(channel_id, 1024))
+    handler._writer.stop()
+    handler._writer.join()
+    elapsed = time.time() - start
+
+    print '  merge %-5s: %6d FlowControls in %6d messages, %8d bytes, ' \
+        '%8.0f FlowControls/s' % (
+            merge, num_channels * num_reads, stream.messages,
+            stream.bytes, num_channels * num_reads / elapsed)
+
+
+class _IdleDispatcher(object):
+    """Dispatcher whose handlers accept any logical channel and keep it open
+    until released.
+    """
+
+    def __init__(self):
+        self.released = threading.Event()
+
+    def do_extra_handshake(self, request):
+        pass
+
+    def transfer_data(self, request):
+        self.released.wait()
+        # Skip DropChannel, which could race with the writer thread stopped
+        # by wait_until_done().
+        request.server_terminated = True
+
+
+def _get_memory_usage():
+    """Returns VmRSS and VmSize of this process in KiB."""
+
+    usage = {}
+    for line in open('/proc/self/status'):
+        key, value = line.split(':', 1)
+        if key in ('VmRSS', 'VmSize'):
+            usage[key] = int(value.split()[0])
+    return usage['VmRSS'], usage['VmSize']
+
+
+def _benchmark_channel_storm(num_channels, worker_threads,
+                             max_channels_per_connection):
+    """Sends num_channels AddChannelRequests on one physical connection, all
+    of whose handlers stay open, and measures the number of threads and the
+    memory usage of the process.
+    """
+
+    threads_before = threading.activeCount()
+    rss_before, size_before = _get_memory_usage()
+
+    mux_options = mux.MuxOptions()
+    if worker_threads > 0:
+        mux_options.worker_pool = util.WorkerPool(worker_threads)
+    mux_options.max_channels_per_connection = max_channels_per_connection
+    dispatcher = _IdleDispatcher()
+    handler, unused_requests = _start_benchmark_mux_handler(
+        _NullConnection(), mux_options, [], dispatcher)
+    handler.add_channel_slots(num_channels, 0)
+
+    start = time.time()
+    for channel_id in xrange(2, num_channels + 2):
+        block = mux._ControlBlock(mux._MUX_OPCODE_ADD_CHANNEL_REQUEST)
+        block.channel_id = channel_id
+        block.encoding = mux._HANDSHAKE_ENCODING_IDENTITY
+        block.encoded_handshake = (
+            'GET /storm HTTP/1.1\r\n'
+            'Host: server.example.com\r\n'
+            'Connection: Upgrade\r\n'
+            'Origin: http://example.com\r\n')
+        handler._process_add_channel_request(block)
+    elapsed = time.time() - start
+    accepted = mux.get_logical_channel_count()
+    threads = threading.activeCount() - threads_before
+    rss, size = _get_memory_usage()
+
+    dispatcher.released.set()
+    handler.wait_until_done()
+    if mux_options.worker_pool is not None:
+        mux_options.worker_pool.shutdown()
+
+    label = 'thread per channel'
+    if worker_threads > 0:
+        label = 'pool of %d' % worker_threads
+    if max_channels_per_connection > 0:
+        label += ', limit %d' % max_channels_per_connection
+    print '  %-24s: %5d accepted %5d threads, RSS +%7d KiB, ' \
+        'VmSize +%8d KiB, %8.0f requests/s' % (
+            label, accepted, threads, rss - rss_before, size - size_before,
+            num_channels / elapsed)
+
+
+def _main():
+    parser = optparse.OptionParser()
+    parser.add_option('--frame-size', '--frame_size', dest='frame_size',
+                      type='int', default=4096,
+                      help='Size of frames dispatched to logical streams')
+    parser.add_option('--fragment-quantum', '--fragment_quantum',
+                      dest='fragment_quantum', type='int',
+                      default=mux._DEFAULT_FRAGMENT_QUANTUM,
+                      help='Fragment quantum of the mixed channel benchmark')
+    parser.add_option('--write-window', '--write_window',
+                      dest='write_window', type='int',
+                      default=mux._DEFAULT_WRITE_WINDOW,
+                      help='Write window of the channel send benchmark')
+    parser.add_option('--bandwidth', dest='bandwidth', type='int',
+                      default=10 * 1024 * 1024,
+                      help=('Bandwidth in bytes per second of the physical '
+                            'connection of the mixed channel benchmark'))
+    parser.add_option('--rtt', dest='rtt', type='int', default=50,
+                      help=('Round-trip time in milliseconds of the receive '
+                            'window benchmark'))
+    parser.add_option('--storm-channels', '--storm_channels',
+                      dest='storm_channels', type='int', default=1000,
+                      help='Number of AddChannelRequests of the storm')
+    parser.add_option('--worker-threads', '--worker_threads',
+                      dest='worker_threads', type='int', default=16,
+                      help='Size of the worker pool of the storm benchmark')
+    options, unused_args = parser.parse_args()
+
+    print 'Control block parse'
+    _benchmark_control_block_parse(20000)
+
+    print 'Inner frame parse'
+    for payload_size in (0, 16, 1024):
+        _benchmark_inner_frame_parse(payload_size, 400000)
+
+    print 'Logical stream receive (frame %d bytes)' % options.frame_size
+    for message_size, num_messages in ((16, 20000), (1024, 20000),
+                                       (64 * 1024, 500),
+                                       (1024 * 1024, 20)):
+        _benchmark_logical_stream_receive(
+            message_size, num_messages, options.frame_size)
+
+    print 'Logical channel send'
+    # A write window of 0 makes each write wait for the previous one.
+    for write_window in (0, options.write_window):
+        for message_size, num_messages in ((16, 20000), (1024, 20000),
+                                           (64 * 1024, 1000)):
+            _benchmark_channel_send(write_window, message_size, num_messages)
+
+    print ('Mixed bulk (8 MiB) and interactive (64 bytes) channels '
+           '(%d bytes/s)' % options.bandwidth)
+    # A quantum larger than the bulk message disables fragmentation and
+    # interleaving.
+    for fragment_quantum in (1 << 30, options.fragment_quantum):
+        _benchmark_mixed_channels(fragment_quantum, options.bandwidth,
+                                  8 * 1024 * 1024, 64)
+
+    print ('Receive window (%d bytes/s, rtt %d ms)' %
+           (options.bandwidth * 10, options.rtt))
+    for max_window in (mux._INITIAL_QUOTA_FOR_CLIENT,
+                       mux._DEFAULT_MAX_RECEIVE_WINDOW, 16 * 1024 * 1024):
+        _benchmark_receive_window(max_window, options.rtt / 1000.0,
+                                  options.bandwidth * 10, 10)
+
+    print 'FlowControl for 100 channels x 100 reads'
+    for merge in (False, True):
+        _benchmark_flow_control(merge, 100, 100)
+
+    print 'Echo on many channels'
+    for num_channels, num_messages in ((1, 20000), (16, 2000), (256, 200)):
+        _benchmark_channel_table(num_channels, num_messages)
+
+    print 'Channel storm (%d AddChannelRequests)' % options.storm_channels
+    for worker_threads, max_channels_per_connection in (
+        (0, 0), (options.worker_threads, 0),
+        (options.worker_threads, options.worker_threads)):
+        _benchmark_channel_storm(options.storm_channels, worker_threads,
+                                 max_channels_per_connection)
+
+
+if __name__ == '__main__':
+    _main()
+
+
+# vi:sts=4 sw=4 et
@@ -0,0 +1,215 @@
+# Copyright 2014, Google Inc.
+#
+# Copyright 2012, Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of Google Inc. nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+
+
+"""Benchmark for holding many idle WebSocket connections on standalone.py.
+
+Launches standalone.py as a separate process, opens WebSocket connections to
+it which stay idle, and reports the number of threads and the memory usage of
+the server process together with the rate at which the connections were
+established. Then checks that the server still echoes a message on one of
+them.
+
+Run this under pywebsocket's src directory, e.g.
+    python test/benchmark_standalone.py --connections 2000 \
+        --server-args='--server-mode=epoll'
+
+To benchmark wss connections, give --tls and the TLS options of the server,
+e.g.
+    python test/benchmark_standalone.py --connections 500 --tls \
+        --stalled-connections 10 --resource /echo \
+        --server-args='-t -c cert.pem -k key.pem'
+
+--stalled-connections opens connections which never send anything before the
+benchmark, like slow or malicious clients.
+"""
+
+
+import base64
+import optparse
+import os
+import shlex
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import time
+
+import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
+
+from mod_pywebsocket import common
+from mod_pywebsocket.stream import create_text_frame
+
+
+_SERVER_WARMUP_IN_SEC = 1
+_CONNECT_TIMEOUT_IN_SEC = 30
+
+
+def _run_server(port, server_args):
+    top_dir = os.path.join(os.path.split(__file__)[0], '..')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.pathsep.join(sys.path)
+    args = [sys.executable,
+            os.path.join(top_dir, 'mod_pywebsocket', 'standalone.py'),
+            '-H', 'localhost',
+            '-p', str(port),
+            '-d', os.path.join(top_dir, 'example'),
+            '--log-level', 'critical'] + server_args
+    return subprocess.Popen(args, close_fds=True, env=env)
+
+
+def _get_process_status(pid):
+    """Returns the number of threads and VmRSS in KiB of the process and its
+    child processes, e.g. the workers started by --processes.
+    """
+
+    threads = 0
+    rss = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        status = {}
+        try:
+            for line in open('/proc/%s/status' % entry):
+                key, value = line.split(':', 1)
+                if key in ('PPid', 'Threads', 'VmRSS'):
+                    status[key] = int(value.split()[0])
+        except IOError:
+            # The process has exited.
+            continue
+        if int(entry) == pid or status.get('PPid') == pid:
+            threads += status['Threads']
+            rss += status['VmRSS']
+    return threads, rss
+
+
+def _connect(port, resource, use_tls):
+    socket_ = socket.create_connection(('localhost', port),
+                                       _CONNECT_TIMEOUT_IN_SEC)
+    if use_tls:
+        socket_ = ssl.wrap_socket(socket_)
+    key = base64.b64encode(os.urandom(16))
+    socket_.sendall(
+        'GET %s HTTP/1.1\r\n'
+        'Host: localhost:%d\r\n'
+        'Upgrade: websocket\r\n'
+        'Connection: Upgrade\r\n'
+        'Sec-WebSocket-Key: %s\r\n'
+        'Sec-WebSocket-Version: %d\r\n'
+        'Origin: http://localhost\r\n'
+        '\r\n' % (resource, port, key, common.VERSION_HYBI_LATEST))
+    response = ''
+    while '\r\n\r\n' not in response:
+        data = socket_.recv(1024)
+        if not data:
+            raise Exception('Connection closed during opening handshake')
+        response += data
+    if not response.startswith('HTTP/1.1 101'):
+        raise Exception('Unexpected response: %r' % response)
+    socket_.settimeout(None)
+    return socket_
+
+
+def _echo(socket_, message):
+    start = time.time()
+    socket_.sendall(create_text_frame(message, mask=True))
+    expected = create_text_frame(message)
+    received = ''
+    while len(received) < len(expected):
+        data = socket_.recv(len(expected) - len(received))
+        if not data:
+            raise Exception('Connection closed before echo')
+        received += data
+    if received != expected:
+        raise Exception('Unexpected echo: %r' % received)
+    return time.time() - start
+
+
+def _main():
+    parser = optparse.OptionParser()
+    parser.add_option('--connections', dest='connections', type='int',
+                      default=1000, help='Number of idle connections')
+    parser.add_option('--resource', dest='resource', type='string',
+                      default='/echo_callback',
+                      help='Resource to connect to')
+    parser.add_option('--tls', dest='use_tls', action='store_true',
+                      default=False, help='Connect with TLS')
+    parser.add_option('--stalled-connections', '--stalled_connections',
+                      dest='stalled_connections', type='int', default=0,
+                      help=('Number of connections which never send '
+                            'anything to open before the benchmark'))
+    parser.add_option('--server-args', '--server_args', dest='server_args',
+                      type='string', default='',
+                      help='Additional arguments for standalone.py')
+    options, unused_args = parser.parse_args()
+
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    server = _run_server(port, shlex.split(options.server_args))
+    sockets = []
+    try:
+        time.sleep(_SERVER_WARMUP_IN_SEC)
+        for i in xrange(options.stalled_connections):
+            sockets.append(socket.create_connection(('localhost', port)))
+        base_threads, base_rss = _get_process_status(server.pid)
+
+        start = time.time()
+        for i in xrange(options.connections):
+            sockets.append(
+                _connect(port, options.resource, options.use_tls))
+        elapsed = time.time() - start
+        # Let threads started for the connections settle.
+        time.sleep(_SERVER_WARMUP_IN_SEC)
+        threads, rss = _get_process_status(server.pid)
+
+        echo_time = _echo(sockets[-1], 'Hello')
+
+        print '%d connections in %.2f s (%.0f connections/s)' % (
+            options.connections, elapsed, options.connections / elapsed)
+        print 'threads: %d (%d before connecting)' % (threads, base_threads)
+        print 'VmRSS: %.1f MiB (+%.1f MiB)' % (
+            rss / 1024.0, (rss - base_rss) / 1024.0)
+        print 'echo: %.2f ms' % (echo_time * 1000)
+    finally:
+        for socket_ in sockets:
+            socket_.close()
+        os.kill(server.pid, signal.SIGKILL)
+        server.wait()
+
+
+if __name__ == '__main__':
+    _main()
+
+
+# vi:sts=4 sw=4 et
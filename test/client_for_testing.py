@@ -970,6 +970,9 @@ class ClientOptions(object):
         self.origin = ''
         self.resource = ''
         self.server_port = -1
+        # Path of a Unix-domain socket to connect to instead of server_host
+        # and server_port.
+        self.unix_socket = None
         self.socket_timeout = 1000
         self.use_tls = False
         self.extensions = []
@@ -988,18 +991,24 @@ class ClientOptions(object):
 
 
 def connect_socket_with_retry(host, port, timeout, use_tls,
-                              retry=10, sleep_sec=0.1):
+                              retry=10, sleep_sec=0.1, unix_socket=None):
     retry_count = 0
     while retry_count < retry:
         try:
-            s = socket.socket()
-            s.settimeout(timeout)
-            s.connect((host, port))
+            if unix_socket is None:
+                s = socket.socket()
+                s.settimeout(timeout)
+                s.connect((host, port))
+            else:
+                s = socket.socket(socket.AF_UNIX)
+                s.settimeout(timeout)
+                s.connect(unix_socket)
             if use_tls:
                 return _TLSSocket(s)
             return s
         except socket.error, e:
-            if e.errno != errno.ECONNREFUSED:
+            # The server may not have created the socket file yet.
+            if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
                 raise
             else:
                 retry_count = retry_count + 1
@@ -1025,7 +1034,8 @@ class Client(object):
                 self._options.server_host,
                 self._options.server_port,
                 self._options.socket_timeout,
-                self._options.use_tls)
+                self._options.use_tls,
+                unix_socket=self._options.unix_socket)
 
         self._handshake.handshake(self._socket)
 
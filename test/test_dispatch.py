@@ -38,8 +38,10 @@ import unittest
 
 import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
 
+from mod_pywebsocket import common
 from mod_pywebsocket import dispatch
 from mod_pywebsocket import handshake
+from mod_pywebsocket import stream
 from test import mock
 
 
@@ -122,6 +124,53 @@ class DispatcherTest(unittest.TestCase):
                 'def web_socket_do_extra_handshake(request):pass\n'
                 'def web_socket_transfer_data(request):pass\n'))
 
+    def test_source_handler_file_with_receive_message(self):
+        handler_suite = dispatch._source_handler_file(
+            'def web_socket_do_extra_handshake(request):pass\n'
+            'def web_socket_receive_message(request, message):\n'
+            '    request.received.append(message)\n')
+        self.failUnless(handler_suite.receive_message)
+
+        class FakeStream(object):
+            def __init__(self, messages):
+                self._messages = messages
+
+            def receive_message(self):
+                return self._messages.pop(0)
+
+        # Without web_socket_transfer_data, a transfer_data handler which
+        # calls web_socket_receive_message until a closing handshake is
+        # provided.
+        request = mock.MockRequest()
+        request.ws_stream = FakeStream(['Hello', u'World', None, 'unread'])
+        request.received = []
+        handler_suite.transfer_data(request)
+        self.assertEqual(['Hello', u'World', None], request.received)
+
+    def test_source_handler_file_with_coroutine(self):
+        handler_suite = dispatch._source_handler_file(
+            'def web_socket_do_extra_handshake(request):pass\n'
+            'def web_socket_transfer_data(request):\n'
+            '    message = yield request.ws_stream.receive_message_async()\n'
+            '    yield request.ws_stream.send_message_async(message.upper())\n'
+            '    try:\n'
+            '        yield request.ws_stream.receive_message_async()\n'
+            '    except Exception, e:\n'
+            '        request.error = e\n')
+        self.failUnless(handler_suite.transfer_data_coroutine)
+
+        # transfer_data runs the yielded operations synchronously and raises
+        # their exceptions in the coroutine.
+        request = mock.MockRequest(connection=mock.MockConn(
+            stream.create_text_frame('hello', mask=True)))
+        request.ws_version = common.VERSION_HYBI_LATEST
+        request.ws_stream = stream.Stream(request, stream.StreamOptions())
+        handler_suite.transfer_data(request)
+        self.assertEqual(stream.create_text_frame('HELLO'),
+                         request.connection.written_data())
+        self.failUnless(isinstance(request.error,
+                                   stream.ConnectionTerminatedException))
+
     def test_source_warnings(self):
         dispatcher = dispatch.Dispatcher(_TEST_HANDLERS_DIR, None)
         warnings = dispatcher.source_warnings()
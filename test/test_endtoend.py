@@ -37,14 +37,18 @@ the port on which the Apache server is running.
 """
 
 
+import errno
 import logging
 import os
+import shutil
 import signal
 import socket
 import subprocess
 import sys
+import tempfile
 import time
 import unittest
+import zlib
 
 import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
 
@@ -107,6 +111,23 @@ def _echo_check_procedure_with_goodbye(client):
     client.assert_connection_closed()
 
 
+def _tcp_nodelay_check_procedure(client):
+    client.connect()
+
+    # The handler enables TCP_NODELAY in web_socket_do_extra_handshake.
+    client.send_message('get')
+    client.assert_receive('on')
+    client.send_message('off')
+    client.assert_receive('off')
+    client.send_message('on')
+    client.assert_receive('on')
+
+    client.send_close()
+    client.assert_receive_close()
+
+    client.assert_connection_closed()
+
+
 def _echo_check_procedure_with_code_and_reason(client, code, reason):
     client.connect()
 
@@ -173,6 +194,7 @@ class EndToEndTestBase(unittest.TestCase):
         self.standalone_command = os.path.join(
             self.top_dir, 'mod_pywebsocket', 'standalone.py')
         self.document_root = os.path.join(self.top_dir, 'example')
+        self.server_args = []
         s = socket.socket()
         s.bind(('localhost', 0))
         (_, self.test_port) = s.getsockname()
@@ -193,17 +215,19 @@ class EndToEndTestBase(unittest.TestCase):
 
     # TODO(tyoshino): Use tearDown to kill the server.
 
-    def _run_python_command(self, commandline, stdout=None, stderr=None):
-        return subprocess.Popen([sys.executable] + commandline, close_fds=True,
+    def _run_python_command(self, commandline, stdout=None, stderr=None,
+                            close_fds=True, preexec_fn=None):
+        return subprocess.Popen([sys.executable] + commandline,
+                                close_fds=close_fds, preexec_fn=preexec_fn,
                                 stdout=stdout, stderr=stderr)
 
-    def _run_server(self):
+    def _run_server(self, close_fds=True, preexec_fn=None):
         args = [self.standalone_command,
                 '-H', 'localhost',
                 '-V', 'localhost',
                 '-p', str(self.test_port),
                 '-P', str(self.test_port),
-                '-d', self.document_root]
+                '-d', self.document_root] + self.server_args
 
         # Inherit the level set to the root logger by test runner.
         root_logger = logging.getLogger()
@@ -213,7 +237,9 @@ class EndToEndTestBase(unittest.TestCase):
             args.append(logging.getLevelName(log_level).lower())
 
         return self._run_python_command(args,
-                                        stderr=self.server_stderr)
+                                        stderr=self.server_stderr,
+                                        close_fds=close_fds,
+                                        preexec_fn=preexec_fn)
 
     def _kill_process(self, pid):
         if sys.platform in ('win32', 'cygwin'):
@@ -326,9 +352,355 @@ class EndToEndHyBiTest(EndToEndTestBase):
         finally:
             self._kill_process(server.pid)
 
+    def _run_epoll_test(self, test_function):
+        self.server_args = ['--server-mode', 'epoll']
+        self._run_test(test_function)
+
     def test_echo(self):
         self._run_test(_echo_check_procedure)
 
+    def test_echo_callback(self):
+        self._options.resource = '/echo_callback'
+        self._run_test(_echo_check_procedure_with_goodbye)
+
+    def test_echo_epoll(self):
+        self._options.resource = '/echo_callback'
+        self._run_epoll_test(_echo_check_procedure)
+
+    def test_echo_binary_epoll(self):
+        self._options.resource = '/echo_callback'
+        self._run_epoll_test(_echo_check_procedure_with_binary)
+
+    def test_echo_server_close_epoll(self):
+        self._options.resource = '/echo_callback'
+        self._run_epoll_test(_echo_check_procedure_with_goodbye)
+
+    def test_echo_coroutine(self):
+        self._options.resource = '/echo_coroutine'
+        self._run_test(_echo_check_procedure_with_goodbye)
+
+    def test_echo_coroutine_epoll(self):
+        self._options.resource = '/echo_coroutine'
+        self._run_epoll_test(_echo_check_procedure)
+
+    def test_echo_binary_coroutine_epoll(self):
+        self._options.resource = '/echo_coroutine'
+        self._run_epoll_test(_echo_check_procedure_with_binary)
+
+    def test_echo_server_close_coroutine_epoll(self):
+        self._options.resource = '/echo_coroutine'
+        self._run_epoll_test(_echo_check_procedure_with_goodbye)
+
+    def test_echo_transfer_data_epoll(self):
+        # Handlers without web_socket_receive_message run in their own thread.
+        self._run_epoll_test(_echo_check_procedure_with_goodbye)
+
+    def test_handler_threads_reject(self):
+        self.server_args = ['--handler-threads', '1',
+                            '--handler-queue-size', '1']
+
+        def test_function(client):
+            # The connection of client holds the only handler thread.
+            client.connect()
+            client.send_message('test')
+            client.assert_receive('test')
+
+            queued_socket = socket.create_connection(
+                ('localhost', self.test_port))
+            rejected_socket = None
+            try:
+                time.sleep(0.2)
+                rejected_socket = socket.create_connection(
+                    ('localhost', self.test_port))
+                response = ''
+                while True:
+                    received = rejected_socket.recv(1024)
+                    if not received:
+                        break
+                    response += received
+                self.assertTrue(
+                    response.startswith('HTTP/1.1 503 Service Unavailable'))
+                self.assertTrue('\r\nRetry-After: 1\r\n' in response)
+            finally:
+                queued_socket.close()
+                if rejected_socket is not None:
+                    rejected_socket.close()
+
+            client.send_close()
+            client.assert_receive_close()
+
+        self._run_test(test_function)
+
+    def test_handler_threads_request_header_timeout(self):
+        self.server_args = ['--handler-threads', '1',
+                            '--request-header-timeout', '0.5']
+
+        def test_function(client):
+            # A connection which sends nothing holds the only handler thread
+            # until it times out.
+            idle_socket = socket.create_connection(
+                ('localhost', self.test_port))
+            try:
+                time.sleep(0.2)
+                _echo_check_procedure(client)
+                self.assertEqual('', idle_socket.recv(1024))
+            finally:
+                idle_socket.close()
+
+        self._run_test(test_function)
+
+    def _run_drain_test(self):
+        self.server_args += ['--drain-timeout', '5']
+        server = self._run_server()
+        try:
+            time.sleep(_SERVER_WARMUP_IN_SEC)
+
+            client = client_for_testing.create_client(self._options)
+            try:
+                client.connect()
+                client.send_message('test')
+                client.assert_receive('test')
+
+                os.kill(server.pid, signal.SIGTERM)
+                client.assert_receive_close(
+                    client_for_testing.STATUS_GOING_AWAY)
+                client.send_close(client_for_testing.STATUS_GOING_AWAY)
+                client.assert_connection_closed()
+            finally:
+                client.close_socket()
+            self.assertEqual(0, server.wait())
+        finally:
+            if server.returncode is None:
+                self._kill_process(server.pid)
+
+    def test_drain(self):
+        self._run_drain_test()
+
+    def test_drain_epoll(self):
+        self._options.resource = '/echo_callback'
+        self.server_args = ['--server-mode', 'epoll']
+        self._run_drain_test()
+
+    def test_request_header_timeout_epoll(self):
+        self._options.resource = '/echo_callback'
+        self.server_args = ['--server-mode', 'epoll',
+                            '--request-header-timeout', '0.5']
+
+        def test_function(client):
+            partial_socket = socket.create_connection(
+                ('localhost', self.test_port))
+            try:
+                partial_socket.sendall('GET /echo_callback HTTP/1.1\r\n')
+                partial_socket.settimeout(5)
+                start = time.time()
+                try:
+                    self.assertEqual('', partial_socket.recv(1024))
+                except socket.error, e:
+                    # The server closed it with the request bytes unread.
+                    self.assertEqual(errno.ECONNRESET, e.errno)
+                self.assertTrue(time.time() - start < 2)
+            finally:
+                partial_socket.close()
+
+            _echo_check_procedure(client)
+
+        self._run_test(test_function)
+
+    def test_echo_write_buffer_size_epoll(self):
+        self._options.resource = '/echo_callback'
+        self.server_args = ['--server-mode', 'epoll',
+                            '--event-loop-write-buffer-size', '4096',
+                            '--send-buffer-size', '4096']
+
+        def test_function(client):
+            client.connect()
+
+            # Echoed messages aren't read until all have been sent so that
+            # the handler waits for the queued bytes to be read.
+            messages = [chr(ord('a') + i) * 65536 for i in xrange(16)]
+            for message in messages:
+                client.send_message(message)
+            for message in messages:
+                client.assert_receive(message)
+
+            client.send_close()
+            client.assert_receive_close()
+
+        self._run_test(test_function)
+
+    def _run_restart_test(self):
+        self.server_args += ['--drain-timeout', '5']
+        # The new server started on SIGUSR2 runs in the process group of the
+        # old one, so that both can be killed.
+        server = self._run_server(preexec_fn=os.setsid)
+        try:
+            time.sleep(_SERVER_WARMUP_IN_SEC)
+
+            client = client_for_testing.create_client(self._options)
+            try:
+                client.connect()
+                client.send_message('test')
+                client.assert_receive('test')
+
+                os.kill(server.pid, signal.SIGUSR2)
+                client.assert_receive_close(
+                    client_for_testing.STATUS_GOING_AWAY)
+                client.send_close(client_for_testing.STATUS_GOING_AWAY)
+                client.assert_connection_closed()
+            finally:
+                client.close_socket()
+            self.assertEqual(0, server.wait())
+
+            # The new server serves the same port.
+            client = client_for_testing.create_client(self._options)
+            try:
+                _echo_check_procedure(client)
+            finally:
+                client.close_socket()
+        finally:
+            try:
+                os.killpg(server.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def test_restart(self):
+        self._run_restart_test()
+
+    def test_restart_epoll(self):
+        self._options.resource = '/echo_callback'
+        self.server_args = ['--server-mode', 'epoll']
+        self._run_restart_test()
+
+    def test_restart_processes(self):
+        self.server_args = ['--processes', '2']
+        self._run_restart_test()
+
+    def test_close_on_protocol_error_epoll(self):
+        self._options.resource = '/echo_callback'
+
+        def test_function(client):
+            client.connect()
+
+            client.send_frame_of_arbitrary_bytes('\x80\x80', '')
+            client.assert_receive_close(
+                client_for_testing.STATUS_PROTOCOL_ERROR)
+
+        self._run_epoll_test(test_function)
+
+    def test_echo_processes(self):
+        self.server_args = ['--processes', '2']
+        self._run_test(_echo_check_procedure)
+
+    def test_echo_processes_reuse_port(self):
+        self.server_args = ['--processes', '2', '--reuse-port']
+        self._run_test(_echo_check_procedure)
+
+    def test_echo_processes_epoll(self):
+        self._options.resource = '/echo_callback'
+        self.server_args = ['--processes', '2', '--server-mode', 'epoll']
+        self._run_test(_echo_check_procedure)
+
+    def test_echo_resource_processes(self):
+        self._options.resource = '/echo_callback'
+        self.server_args = ['--server-mode', 'epoll',
+                            '--resource-processes', '/echo_callback=2']
+        self._run_test(_echo_check_procedure_with_goodbye)
+
+    def test_echo_resource_processes_default_workers(self):
+        # /echo is handed off to the default workers.
+        self.server_args = ['--server-mode', 'epoll',
+                            '--resource-processes', '/echo_callback=1']
+        self._run_test(_echo_check_procedure_with_goodbye)
+
+    def test_echo_tcp_options(self):
+        self.server_args = ['--tcp-nodelay',
+                            '--send-buffer-size', '65536',
+                            '--receive-buffer-size', '65536',
+                            '--tcp-keepalive', '--tcp-keepalive-idle', '60',
+                            '--tcp-keepalive-interval', '10',
+                            '--tcp-keepalive-count', '3',
+                            '--tcp-defer-accept', '5']
+        self._run_test(_echo_check_procedure)
+
+    def test_echo_tcp_options_epoll(self):
+        self._options.resource = '/echo_callback'
+        self.server_args = ['--server-mode', 'epoll', '--tcp-nodelay',
+                            '--tcp-keepalive', '--tcp-defer-accept', '5']
+        self._run_test(_echo_check_procedure)
+
+    def test_handler_tcp_nodelay(self):
+        self._options.resource = '/tcp_nodelay'
+        self._run_test(_tcp_nodelay_check_procedure)
+
+    def test_handler_tcp_nodelay_epoll(self):
+        self._options.resource = '/tcp_nodelay'
+        self.server_args = ['--server-mode', 'epoll']
+        self._run_test(_tcp_nodelay_check_procedure)
+
+    def _run_unix_socket_test(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self._options.unix_socket = os.path.join(directory, 'ws.sock')
+            # Leave a socket file as a server which exited does.
+            stale_socket = socket.socket(socket.AF_UNIX)
+            stale_socket.bind(self._options.unix_socket)
+            stale_socket.close()
+
+            self.server_args += ['--unix-socket', self._options.unix_socket,
+                                 '--tcp-nodelay']
+            self._run_test(_echo_check_procedure)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_echo_unix_socket(self):
+        self._run_unix_socket_test()
+
+    def test_echo_unix_socket_epoll(self):
+        self._options.resource = '/echo_callback'
+        self.server_args = ['--server-mode', 'epoll']
+        self._run_unix_socket_test()
+
+    def _run_server_with_systemd_socket(self):
+        """Runs the server with a listening socket passed by the systemd
+        socket activation protocol.
+        """
+
+        # Listen on another port than --port so that the test fails if the
+        # server binds its own socket.
+        listening_socket = socket.socket()
+        listening_socket.bind(('localhost', 0))
+        listening_socket.listen(5)
+        self._options.server_port = listening_socket.getsockname()[1]
+
+        def pass_listening_socket():
+            os.dup2(listening_socket.fileno(), 3)
+            os.environ['LISTEN_PID'] = str(os.getpid())
+            os.environ['LISTEN_FDS'] = '1'
+
+        try:
+            return self._run_server(close_fds=False,
+                                    preexec_fn=pass_listening_socket)
+        finally:
+            listening_socket.close()
+
+    def test_systemd_socket_activation_reuse_port(self):
+        self.server_args = ['--processes', '2', '--reuse-port']
+        server = self._run_server_with_systemd_socket()
+        self.assertEqual(1, server.wait())
+
+    def test_echo_systemd_socket_activation(self):
+        server = self._run_server_with_systemd_socket()
+        try:
+            time.sleep(_SERVER_WARMUP_IN_SEC)
+
+            client = client_for_testing.create_client(self._options)
+            try:
+                _echo_check_procedure(client)
+            finally:
+                client.close_socket()
+        finally:
+            self._kill_process(server.pid)
+
     def test_echo_binary(self):
         self._run_test(_echo_check_procedure_with_binary)
 
@@ -463,6 +835,32 @@ class EndToEndHyBiTest(EndToEndTestBase):
                 response_checker,
                 test_function)
 
+    def test_permessage_deflate_message_too_big_after_inflation(self):
+        self.server_args += ['--deflate-max-inflated-size', '100']
+
+        def test_function(client):
+            compress = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+            compressed_payload = compress.compress('a' * 101)
+            compressed_payload += compress.flush(zlib.Z_SYNC_FLUSH)
+            compressed_payload = compressed_payload[:-4]
+            client._stream.send_data(
+                    compressed_payload,
+                    client_for_testing.OPCODE_TEXT,
+                    rsv1=1)
+
+            client.assert_receive_close(
+                    client_for_testing.STATUS_MESSAGE_TOO_BIG)
+            client.send_close()
+
+        def response_checker(parameter):
+            self.assertEquals('permessage-deflate', parameter.name())
+
+        self._run_permessage_deflate_test(
+                ['permessage-deflate'],
+                response_checker,
+                test_function)
+
     def test_echo_permessage_deflate_preference(self):
         def test_function(client):
             # From the examples in the spec.
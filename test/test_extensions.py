@@ -69,6 +69,38 @@ class ExtensionsTest(unittest.TestCase):
                 ValueError, extensions._parse_window_bits, '10000000')
 
 
+class CompressionStatsTest(unittest.TestCase):
+    """A unittest for CompressionStats class."""
+
+    def test_aggregate(self):
+        aggregator = extensions._CompressionStatsAggregator()
+        stats = extensions.CompressionStats(aggregator=aggregator)
+        other_stats = extensions.CompressionStats(aggregator=aggregator)
+        stats.record_deflate(100, 10, 0.5)
+        other_stats.record_deflate(200, 20, 0.25, message_end=False)
+        other_stats.record_inflate(30, 300, 0.125)
+
+        total = aggregator.copy()
+        self.assertEqual(1, total.outgoing_compressed_messages)
+        self.assertEqual(300, total.outgoing_original_bytes)
+        self.assertEqual(30, total.outgoing_compressed_bytes)
+        self.assertEqual(0.75, total.deflate_time)
+        self.assertEqual(1, total.incoming_compressed_messages)
+        self.assertEqual(300, total.incoming_original_bytes)
+
+        # The values of a closed connection are kept, and counted once.
+        stats.close()
+        stats.close()
+        stats = extensions.CompressionStats(aggregator=aggregator)
+        stats.record_outgoing_uncompressed()
+
+        total = aggregator.copy()
+        self.assertEqual(1, total.outgoing_compressed_messages)
+        self.assertEqual(1, total.outgoing_uncompressed_messages)
+        self.assertEqual(300, total.outgoing_original_bytes)
+        self.assertEqual(0.75, total.deflate_time)
+
+
 class DeflateFrameExtensionProcessorParsingTest(unittest.TestCase):
     """A unittest for checking that DeflateFrameExtensionProcessor parses given
     extension parameter correctly.
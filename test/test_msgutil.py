@@ -43,10 +43,12 @@ import zlib
 import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
 
 from mod_pywebsocket import common
+from mod_pywebsocket import extensions
 from mod_pywebsocket.extensions import DeflateFrameExtensionProcessor
 from mod_pywebsocket.extensions import PerMessageDeflateExtensionProcessor
 from mod_pywebsocket import msgutil
 from mod_pywebsocket.stream import InvalidUTF8Exception
+from mod_pywebsocket.stream import MessageTooBigException
 from mod_pywebsocket.stream import Stream
 from mod_pywebsocket.stream import StreamHixie75
 from mod_pywebsocket.stream import StreamOptions
@@ -197,6 +199,36 @@ class BasicMessageTest(unittest.TestCase):
         self.assertEqual('\x01\x0cHello World!\x80\x00',
                          request.connection.written_data())
 
+    def test_send_binary_buffers(self):
+        request = _create_request()
+        request.ws_stream.send_binary_buffers(['Hello', ' ', 'World'], False)
+        request.ws_stream.send_binary_buffers([], False)
+        request.ws_stream.send_binary_buffers(['a' * 126], True)
+        self.assertEqual('\x02\x0bHello World\x00\x00\x80\x7e\x00\x7e' +
+                         'a' * 126,
+                         request.connection.written_data())
+
+    def test_send_binary_messages(self):
+        request = _create_request()
+        request.ws_stream.send_binary_messages(
+            [['Hello'], [], [' ', 'World']])
+        self.assertEqual('\x82\x05Hello\x82\x00\x82\x06 World',
+                         request.connection.written_data())
+
+    def test_send_binary_buffers_with_frame_filters(self):
+        request = _create_request_from_rawdata(
+            '', deflate_frame_request=common.ExtensionParameter(
+                common.DEFLATE_FRAME_EXTENSION))
+        request.ws_stream.send_binary_buffers(['Hello', 'World'])
+
+        compress = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compress.compress('HelloWorld')
+        compressed += compress.flush(zlib.Z_SYNC_FLUSH)
+        compressed = compressed[:-4]
+        self.assertEqual('\xc2%c' % len(compressed) + compressed,
+                         request.connection.written_data())
+
     def test_receive_message(self):
         request = _create_request(
             ('\x81\x85', 'Hello'), ('\x81\x86', 'World!'))
@@ -908,6 +940,50 @@ class PerMessageDeflateTest(unittest.TestCase):
         expected += compressed_empty
         self.assertEqual(expected, request.connection.written_data())
 
+    def _assert_send_message_split_into_fragments(self, deflate_options):
+        original_deflate_options = extensions.get_deflate_options()
+        extensions.set_deflate_options(deflate_options)
+        try:
+            extension = common.ExtensionParameter(
+                    common.PERMESSAGE_DEFLATE_EXTENSION)
+            request = _create_request_from_rawdata(
+                    '', permessage_deflate_request=extension)
+        finally:
+            extensions.set_deflate_options(original_deflate_options)
+        msgutil.send_message(request, 'HelloGoodbyeWorld')
+
+        compress = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed_hello = compress.compress('HelloGo')
+        compressed_hello += compress.flush(zlib.Z_SYNC_FLUSH)
+        expected = '\x41%c' % len(compressed_hello)
+        expected += compressed_hello
+        compressed_goodbye = compress.compress('odbyeWo')
+        compressed_goodbye += compress.flush(zlib.Z_SYNC_FLUSH)
+        expected += '\x00%c' % len(compressed_goodbye)
+        expected += compressed_goodbye
+        compressed_world = compress.compress('rld')
+        compressed_world += compress.flush(zlib.Z_SYNC_FLUSH)
+        compressed_world = compressed_world[:-4]
+        expected += '\x80%c' % len(compressed_world)
+        expected += compressed_world
+        self.assertEqual(expected, request.connection.written_data())
+
+    def test_send_message_split_into_fragments(self):
+        deflate_options = extensions.DeflateOptions()
+        deflate_options.fragment_size = 7
+        self._assert_send_message_split_into_fragments(deflate_options)
+
+    def test_send_message_split_into_fragments_using_worker_pool(self):
+        deflate_options = extensions.DeflateOptions()
+        deflate_options.fragment_size = 7
+        deflate_options.worker_pool = util.WorkerPool(1)
+        deflate_options.offload_threshold = 0
+        try:
+            self._assert_send_message_split_into_fragments(deflate_options)
+        finally:
+            deflate_options.worker_pool.shutdown()
+
     def test_send_message_using_small_window(self):
         common_part = 'abcdefghijklmnopqrstuvwxyz'
         test_message = common_part + '-' * 30000 + common_part
@@ -1017,6 +1093,81 @@ class PerMessageDeflateTest(unittest.TestCase):
 
         self.assertEqual(None, msgutil.receive_message(request))
 
+    def test_compression_stats(self):
+        compress = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed_hello = compress.compress('Hello')
+        compressed_hello += compress.flush(zlib.Z_SYNC_FLUSH)
+        compressed_hello = compressed_hello[:-4]
+        data = '\xc1%c' % (len(compressed_hello) | 0x80)
+        data += _mask_hybi(compressed_hello)
+        data += '\x81\x85' + _mask_hybi('World')
+
+        extension = common.ExtensionParameter(
+                common.PERMESSAGE_DEFLATE_EXTENSION)
+        request = _create_request_from_rawdata(
+                data, permessage_deflate_request=extension)
+        server_stats_before = extensions.get_server_compression_stats()
+
+        msgutil.send_message(request, 'Hello')
+        self.assertEqual('Hello', msgutil.receive_message(request))
+        self.assertEqual('World', msgutil.receive_message(request))
+
+        stats = extensions.get_compression_stats(request)
+        self.assertEqual(1, stats.outgoing_compressed_messages)
+        self.assertEqual(0, stats.outgoing_uncompressed_messages)
+        self.assertEqual(5, stats.outgoing_original_bytes)
+        self.assertEqual(len(request.connection.written_data()) - 2,
+                         stats.outgoing_compressed_bytes)
+        self.assertEqual(1, stats.incoming_compressed_messages)
+        self.assertEqual(1, stats.incoming_uncompressed_messages)
+        self.assertEqual(len(compressed_hello),
+                         stats.incoming_compressed_bytes)
+        self.assertEqual(5, stats.incoming_original_bytes)
+        self.assertTrue(stats.deflate_time >= 0)
+        self.assertTrue(stats.inflate_time >= 0)
+
+        server_stats = extensions.get_server_compression_stats()
+        self.assertEqual(server_stats_before.outgoing_compressed_messages + 1,
+                         server_stats.outgoing_compressed_messages)
+        self.assertEqual(server_stats_before.incoming_original_bytes + 5,
+                         server_stats.incoming_original_bytes)
+
+        # Closing merges the values into the total without counting them
+        # twice.
+        extensions.close_compression_stats(request)
+        extensions.close_compression_stats(request)
+        server_stats = extensions.get_server_compression_stats()
+        self.assertEqual(server_stats_before.outgoing_compressed_messages + 1,
+                         server_stats.outgoing_compressed_messages)
+        self.assertEqual(server_stats_before.incoming_original_bytes + 5,
+                         server_stats.incoming_original_bytes)
+
+    def test_receive_message_too_big_after_inflation(self):
+        compress = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        compressed_payload = compress.compress('a' * 101)
+        compressed_payload += compress.flush(zlib.Z_SYNC_FLUSH)
+        compressed_payload = compressed_payload[:-4]
+        data = '\xc1%c' % (len(compressed_payload) | 0x80)
+        data += _mask_hybi(compressed_payload)
+
+        deflate_options = extensions.DeflateOptions()
+        deflate_options.max_inflated_size = 100
+        original_deflate_options = extensions.get_deflate_options()
+        extensions.set_deflate_options(deflate_options)
+        try:
+            extension = common.ExtensionParameter(
+                    common.PERMESSAGE_DEFLATE_EXTENSION)
+            request = _create_request_from_rawdata(
+                    data, permessage_deflate_request=extension)
+        finally:
+            extensions.set_deflate_options(original_deflate_options)
+        self.assertRaises(MessageTooBigException,
+                          msgutil.receive_message,
+                          request)
+
     def test_receive_message_random_section(self):
         """Test that a compressed message fragmented into lots of chunks is
         correctly received.
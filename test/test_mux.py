@@ -38,6 +38,7 @@ import logging
 import optparse
 import struct
 import sys
+import threading
 import unittest
 import time
 import zlib
@@ -46,6 +47,7 @@ import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
 
 from mod_pywebsocket import common
 from mod_pywebsocket import mux
+from mod_pywebsocket import util
 from mod_pywebsocket._stream_base import ConnectionTerminatedException
 from mod_pywebsocket._stream_base import UnsupportedFrameException
 from mod_pywebsocket._stream_hybi import Frame
@@ -95,19 +97,24 @@ class _MockMuxConnection(mock.MockBlockingConn):
         self._current_data = data
         self._position = 0
 
-        def _receive_bytes(length):
-            if self._position + length > len(self._current_data):
-                raise ConnectionTerminatedException(
-                    'Failed to receive %d bytes from encapsulated '
-                    'frame' % length)
-            data = self._current_data[self._position:self._position+length]
-            self._position += length
-            return data
+        # The mux writer may coalesce multiple physical frames into a write.
+        while self._position < len(self._current_data):
+            self._process_physical_frame()
 
+    def _receive_bytes(self, length):
+        if self._position + length > len(self._current_data):
+            raise ConnectionTerminatedException(
+                'Failed to receive %d bytes from encapsulated '
+                'frame' % length)
+        data = self._current_data[self._position:self._position+length]
+        self._position += length
+        return data
+
+    def _process_physical_frame(self):
         # Parse physical frames and assemble a message if the message is
         # fragmented.
         opcode, payload, fin, rsv1, rsv2, rsv3 = (
-            parse_frame(_receive_bytes, unmask_receive=False))
+            parse_frame(self._receive_bytes, unmask_receive=False))
 
         self._pending_fragments.append(payload)
 
@@ -481,6 +488,100 @@ class MuxTest(unittest.TestCase):
         self.assertRaises(mux.PhysicalConnectionError,
                           parser._read_size_and_contents)
 
+    def test_read_control_blocks_after_channel_id(self):
+        # Blocks start at varying offsets and use every channel id and number
+        # encoding.
+        data = (mux._encode_channel_id(mux._CONTROL_CHANNEL_ID) +
+                mux._create_flow_control(2 ** 14, 0x10000) +
+                mux._create_drop_channel(2 ** 21, 1001, 'Bye') +
+                '\x00\x03\x7e\x00\x80' + 'h' * 0x80 +
+                mux._create_flow_control(5, 0x7e))
+        parser = mux._MuxFramePayloadParser(data)
+        self.assertEqual(mux._CONTROL_CHANNEL_ID, parser.read_channel_id())
+        blocks = list(parser.read_control_blocks())
+        self.assertEqual(4, len(blocks))
+
+        self.assertEqual(mux._MUX_OPCODE_FLOW_CONTROL, blocks[0].opcode)
+        self.assertEqual(2 ** 14, blocks[0].channel_id)
+        self.assertEqual(0x10000, blocks[0].send_quota)
+
+        self.assertEqual(mux._MUX_OPCODE_DROP_CHANNEL, blocks[1].opcode)
+        self.assertEqual(2 ** 21, blocks[1].channel_id)
+        self.assertEqual(1001, blocks[1].drop_code)
+        self.assertEqual('Bye', blocks[1].drop_message)
+
+        self.assertEqual(mux._MUX_OPCODE_ADD_CHANNEL_REQUEST, blocks[2].opcode)
+        self.assertEqual(3, blocks[2].channel_id)
+        self.assertEqual('h' * 0x80, blocks[2].encoded_handshake)
+
+        self.assertEqual(mux._MUX_OPCODE_FLOW_CONTROL, blocks[3].opcode)
+        self.assertEqual(5, blocks[3].channel_id)
+        self.assertEqual(0x7e, blocks[3].send_quota)
+
+        self.assertEqual(len(data), parser._read_position)
+
+    def test_read_inner_frame_after_channel_id(self):
+        for channel_id in (2, 2 ** 14 - 1, 2 ** 21 - 1, 2 ** 29 - 1):
+            data = (mux._encode_channel_id(channel_id) +
+                    chr(0x80 | common.OPCODE_TEXT) + 'Hello')
+            parser = mux._MuxFramePayloadParser(data)
+            self.assertEqual(channel_id, parser.read_channel_id())
+            self.assertEqual(
+                (True, False, False, False, common.OPCODE_TEXT, 'Hello'),
+                parser.read_inner_frame())
+            self.assertEqual(len(data), parser._read_position)
+
+        # A frame without payload right after a 3 bytes channel id.
+        data = (mux._encode_channel_id(2 ** 14) +
+                chr(0x40 | common.OPCODE_CONTINUATION))
+        parser = mux._MuxFramePayloadParser(data)
+        self.assertEqual(2 ** 14, parser.read_channel_id())
+        self.assertEqual(
+            (False, True, False, False, common.OPCODE_CONTINUATION, ''),
+            parser.read_inner_frame())
+
+    def test_read_truncated_payload(self):
+        # Channel ids missing their last byte.
+        for data in ('', '\x80', '\xc0\x40', '\xe0\x20\x00'):
+            parser = mux._MuxFramePayloadParser(data)
+            self.assertRaises(ValueError, parser.read_channel_id)
+
+        # No inner frame after the channel id.
+        parser = mux._MuxFramePayloadParser(mux._encode_channel_id(2 ** 14))
+        parser.read_channel_id()
+        try:
+            parser.read_inner_frame()
+            self.fail()
+        except mux.PhysicalConnectionError, e:
+            self.assertEqual(mux._DROP_CODE_ENCAPSULATED_FRAME_IS_TRUNCATED,
+                             e.drop_code)
+
+        # A valid block followed by blocks truncated at each field.
+        valid_block = mux._create_flow_control(2, 100)
+        for truncated_block in (
+            # FlowControl without the send quota.
+            '\x40\x02',
+            # FlowControl with a 3 bytes send quota missing a byte.
+            '\x40\x02\x7e\x01',
+            # AddChannelRequest with a 2 bytes channel id missing a byte.
+            '\x00\x80',
+            # AddChannelRequest with an encoded handshake missing a byte.
+            '\x00\x03\x05abcd',
+            # DropChannel with a reason missing a byte.
+            '\x60\x02\x05\x03\xe8ab'):
+            data = (mux._encode_channel_id(mux._CONTROL_CHANNEL_ID) +
+                    valid_block + truncated_block)
+            parser = mux._MuxFramePayloadParser(data)
+            parser.read_channel_id()
+            blocks = parser.read_control_blocks()
+            self.assertEqual(100, blocks.next().send_quota)
+            try:
+                blocks.next()
+                self.fail()
+            except mux.PhysicalConnectionError, e:
+                self.assertEqual(mux._DROP_CODE_INVALID_MUX_CONTROL_BLOCK,
+                                 e.drop_code)
+
     def test_create_add_channel_response(self):
         data = mux._create_add_channel_response(channel_id=1,
                                                 encoded_handshake='FooBar',
@@ -518,6 +619,154 @@ class MuxTest(unittest.TestCase):
         self.assertEqual('server.example.com', headers['Host'])
         self.assertEqual('http://example.com', headers['Origin'])
 
+    def test_logical_connection_read_frame(self):
+        connection = mux._LogicalConnection(None, 2)
+        first = Frame(fin=0, opcode=common.OPCODE_TEXT, payload='Hello')
+        second = Frame(fin=1, opcode=common.OPCODE_CONTINUATION, payload='')
+        connection.append_frame(first)
+        connection.append_frame(second)
+        self.assertTrue(first is connection.read_frame())
+        self.assertTrue(second is connection.read_frame())
+
+        connection.set_read_state(
+            mux._LogicalConnection.STATE_GRACEFULLY_CLOSED)
+        self.assertRaises(mux.LogicalConnectionClosedException,
+                          connection.read_frame)
+
+    def test_writer_batches_outgoing_data(self):
+        request = _create_mock_request()
+        mux_handler = mux._MuxHandler(request, None)
+        writer = mux._PhysicalConnectionWriter(mux_handler)
+        for channel_id in (2, 3, 4):
+            writer.put_outgoing_data(mux._OutgoingData(
+                channel_id=mux._CONTROL_CHANNEL_ID,
+                buffers=[mux._create_flow_control(channel_id, 1024)]))
+        writer.put_outgoing_data(mux._OutgoingData(
+            channel_id=mux._CONTROL_CHANNEL_ID,
+            buffers=['\x00' * mux._MAX_WRITE_BATCH_SIZE]))
+        writer.put_outgoing_data(mux._OutgoingData(
+            channel_id=mux._CONTROL_CHANNEL_ID,
+            buffers=[mux._create_flow_control(5, 1024)]))
+
+        # Control blocks are put in one control channel message.
+        batch = writer._pop_outgoing_data_batch()
+        self.assertEqual(1, len(batch))
+        self.assertEqual(4, len(batch[0].buffers))
+        batch[0].buffers = batch[0].buffers[:3]
+        writer._write_data(batch)
+        self.assertEqual([2, 3, 4],
+                         [block.channel_id for block in
+                          request.connection.get_written_control_blocks()])
+
+        batch = writer._pop_outgoing_data_batch()
+        self.assertEqual(1, len(batch))
+
+    def test_outgoing_data_scheduler_merges_flow_control(self):
+        scheduler = mux._OutgoingDataScheduler(1024)
+        scheduler.append_flow_control(2, 10)
+        scheduler.append(mux._OutgoingData(
+            channel_id=mux._CONTROL_CHANNEL_ID,
+            buffers=[mux._create_drop_channel(3)]))
+        scheduler.append_flow_control(2, 20)
+        scheduler.append_flow_control(3, 5)
+        self.assertEqual(3, len(scheduler))
+
+        self.assertEqual(mux._create_flow_control(2, 30),
+                         scheduler.popleft().buffers[0])
+        self.assertEqual(mux._create_drop_channel(3),
+                         scheduler.popleft().buffers[0])
+        # FlowControl queued after the merged one has been taken isn't
+        # merged.
+        scheduler.append_flow_control(2, 40)
+        self.assertEqual(mux._create_flow_control(3, 5),
+                         scheduler.popleft().buffers[0])
+        self.assertEqual(mux._create_flow_control(2, 40),
+                         scheduler.popleft().buffers[0])
+        self.assertEqual(0, len(scheduler))
+
+    def test_receive_window(self):
+        now = [0.0]
+        window = mux._ReceiveWindow(100, 300, timer=lambda: now[0])
+
+        self.assertFalse(window.consume(101))
+        self.assertTrue(window.consume(100))
+        self.assertEqual(None, window.get_rtt())
+        # The client has used up its quota, so the FlowControl replenishing
+        # the quota starts a round-trip time measurement.
+        self.assertEqual(100, window.replenish(100))
+        now[0] = 0.1
+        self.assertTrue(window.consume(100))
+        self.assertEqual(0.1, window.get_rtt())
+
+        # 100 bytes have been read in the last round-trip time. The window
+        # grows to twice of it.
+        now[0] = 0.2
+        self.assertEqual(100 + 100, window.replenish(100))
+        self.assertEqual(200, window.get_window())
+
+        # The window doesn't exceed the maximum.
+        now[0] = 0.25
+        self.assertTrue(window.consume(200))
+        now[0] = 0.3
+        self.assertEqual(200 + 100, window.replenish(200))
+        self.assertEqual(300, window.get_window())
+
+    def test_logical_connection_write_window(self):
+        class _RecordingMuxHandler(object):
+            def __init__(self):
+                self.sent = []
+
+            def send_data(self, channel_id, buffers, weight):
+                self.sent.append(''.join(buffers))
+
+        mux_options = mux.MuxOptions()
+        mux_options.write_window = 10
+        saved_mux_options = mux.get_mux_options()
+        mux.set_mux_options(mux_options)
+        try:
+            mux_handler = _RecordingMuxHandler()
+            connection = mux._LogicalConnection(mux_handler, 2)
+        finally:
+            mux.set_mux_options(saved_mux_options)
+
+        connection.write('Hello')
+        connection.write_buffers(['Wor', 'ld'])
+        self.assertEqual(['Hello', 'World'], mux_handler.sent)
+
+        # The window is full. The next write must wait until the writer
+        # thread has written queued data.
+        writer = threading.Thread(target=connection.write, args=('!',))
+        writer.start()
+        time.sleep(0.1)
+        self.assertEqual(['Hello', 'World'], mux_handler.sent)
+        connection.on_write_data_done(5)
+        writer.join(5)
+        self.assertFalse(writer.isAlive())
+        self.assertEqual(['Hello', 'World', '!'], mux_handler.sent)
+
+        connection.on_write_data_done(5)
+        connection.on_write_data_done(1)
+        connection.wait_until_write_done()
+
+    def test_outgoing_data_scheduler(self):
+        scheduler = mux._OutgoingDataScheduler(quantum=10)
+        scheduler.append(mux._OutgoingData(2, ['a' * 10]))
+        scheduler.append(mux._OutgoingData(2, ['b' * 10]))
+        scheduler.append(mux._OutgoingData(2, ['c' * 10]))
+        scheduler.append(mux._OutgoingData(3, ['d' * 10], weight=2))
+        scheduler.append(mux._OutgoingData(3, ['e' * 10], weight=2))
+        scheduler.append(mux._OutgoingData(3, ['f' * 10], weight=2))
+        scheduler.append(mux._OutgoingData(4, ['g' * 25]))
+        scheduler.append(mux._OutgoingData(mux._CONTROL_CHANNEL_ID, ['h']))
+        self.assertEqual(8, len(scheduler))
+
+        order = []
+        while scheduler:
+            order.append(scheduler.popleft().buffers[0][0])
+        # Control data comes first. Channel 3 sends twice as much as channel
+        # 2 per round, and channel 4 waits until its deficit covers its data.
+        self.assertEqual(['h', 'a', 'd', 'e', 'b', 'f', 'c', 'g'], order)
+
 
 class MuxHandlerTest(unittest.TestCase):
 
@@ -574,12 +823,24 @@ class MuxHandlerTest(unittest.TestCase):
         self.assertEqual(1, len(messages))
         self.assertEqual('World', messages[0])
         control_blocks = request.connection.get_written_control_blocks()
-        # There should be 8 control blocks:
+        # There should be:
         #   - 1 NewChannelSlot
         #   - 2 AddChannelResponses for channel id 2 and 3
-        #   - 6 FlowControls for channel id 1 (initialize), 'Hello', 'World',
-        #     and 3 'Goodbye's
-        self.assertEqual(9, len(control_blocks))
+        #   - FlowControls for channel id 1 (initialize), 'Hello', 'World',
+        #     and 3 'Goodbye's. FlowControls for the same channel may be
+        #     merged.
+        opcodes = [block.opcode for block in control_blocks]
+        self.assertEqual(1, opcodes.count(mux._MUX_OPCODE_NEW_CHANNEL_SLOT))
+        self.assertEqual(
+            2, opcodes.count(mux._MUX_OPCODE_ADD_CHANNEL_RESPONSE))
+        replenished_quotas = {}
+        for block in control_blocks:
+            if block.opcode == mux._MUX_OPCODE_FLOW_CONTROL:
+                replenished_quotas[block.channel_id] = (
+                    replenished_quotas.get(block.channel_id, 0) +
+                    block.send_quota)
+        self.assertEqual({1: mux._INITIAL_QUOTA_FOR_CLIENT + 8, 2: 14, 3: 14},
+                         replenished_quotas)
 
     def test_physical_connection_write_failure(self):
         # Use _FailOnWriteConnection.
@@ -594,15 +855,38 @@ class MuxHandlerTest(unittest.TestCase):
         request.connection.put_bytes(
             _create_logical_frame(channel_id=1, message='Hello'))
 
-        # Let the worker exit. This will be unnecessary when
-        # _LogicalConnection.write() is changed to throw an exception if
-        # woke up by on_writer_done.
+        # Let the worker exit. Echoing 'Goodbye' raises BadOperationException
+        # since the writer thread has stopped.
         request.connection.put_bytes(
             _create_logical_frame(channel_id=1, message='Goodbye'))
 
         # All threads should be done.
         self.assertTrue(mux_handler.wait_until_done(timeout=2))
 
+    def test_write_after_writer_failure(self):
+        request = _create_mock_request(connection=_FailOnWriteConnection())
+        dispatcher = _MuxMockDispatcher()
+        mux_handler = mux._MuxHandler(request, dispatcher)
+        mux_handler.start()
+
+        # Kill the writer thread by letting it write a message of channel 1.
+        logical_request = mux_handler._logical_channels[1].request
+        logical_request.ws_stream.send_message('Hello')
+        mux_handler._writer.join(2)
+        self.assertFalse(mux_handler._writer.isAlive())
+
+        # Writes must fail rather than queue data nobody will write, even
+        # after more than the write window has been written.
+        for unused_i in xrange(3):
+            self.assertRaises(mux.BadOperationException,
+                              logical_request.connection.write,
+                              'x' * mux.get_mux_options().write_window)
+
+        # Let the worker exit.
+        request.connection.put_bytes(
+            _create_logical_frame(channel_id=1, message='Goodbye'))
+        self.assertTrue(mux_handler.wait_until_done(timeout=2))
+
     def test_send_blocked(self):
         request = _create_mock_request()
         dispatcher = _MuxMockDispatcher()
@@ -986,6 +1270,92 @@ class MuxHandlerTest(unittest.TestCase):
         self.assertTrue(1 in dispatcher.channel_events)
         self.assertTrue(not 2 in dispatcher.channel_events)
 
+    def test_add_channel_over_limit(self):
+        mux_options = mux.MuxOptions()
+        mux_options.max_channels_per_connection = 2
+        mux_options.worker_pool = util.WorkerPool(2)
+        saved_mux_options = mux.get_mux_options()
+        mux.set_mux_options(mux_options)
+        try:
+            request = _create_mock_request()
+            dispatcher = _MuxMockDispatcher()
+            mux_handler = mux._MuxHandler(request, dispatcher)
+        finally:
+            mux.set_mux_options(saved_mux_options)
+        channel_count = mux.get_logical_channel_count()
+        mux_handler.start()
+        mux_handler.add_channel_slots(mux._INITIAL_NUMBER_OF_CHANNEL_SLOTS,
+                                      mux._INITIAL_QUOTA_FOR_CLIENT)
+
+        for channel_id in (2, 3):
+            encoded_handshake = _create_request_header(path='/echo')
+            add_channel_request = _create_add_channel_request_frame(
+                channel_id=channel_id, encoding=0,
+                encoded_handshake=encoded_handshake)
+            request.connection.put_bytes(add_channel_request)
+
+        request.connection.put_bytes(
+            _create_logical_frame(channel_id=1, message='Goodbye'))
+        request.connection.put_bytes(
+            _create_logical_frame(channel_id=2, message='Goodbye'))
+
+        self.assertTrue(mux_handler.wait_until_done(timeout=2))
+        mux_options.worker_pool.shutdown()
+
+        self.assertTrue(2 in dispatcher.channel_events)
+        self.assertFalse(3 in dispatcher.channel_events)
+        responses = [block for block in
+                     request.connection.get_written_control_blocks()
+                     if block.opcode == mux._MUX_OPCODE_ADD_CHANNEL_RESPONSE
+                     and block.channel_id == 3]
+        self.assertEqual(1, len(responses))
+        self.assertTrue(
+            responses[0].encoded_handshake.startswith('HTTP/1.1 503 '))
+        self.assertEqual(channel_count, mux.get_logical_channel_count())
+
+    def test_add_channel_over_worker_pool(self):
+        mux_options = mux.MuxOptions()
+        # The default channel and channel 2 hold both threads.
+        mux_options.worker_pool = util.WorkerPool(2)
+        saved_mux_options = mux.get_mux_options()
+        mux.set_mux_options(mux_options)
+        try:
+            request = _create_mock_request()
+            dispatcher = _MuxMockDispatcher()
+            mux_handler = mux._MuxHandler(request, dispatcher)
+        finally:
+            mux.set_mux_options(saved_mux_options)
+        channel_count = mux.get_logical_channel_count()
+        mux_handler.start()
+        mux_handler.add_channel_slots(mux._INITIAL_NUMBER_OF_CHANNEL_SLOTS,
+                                      mux._INITIAL_QUOTA_FOR_CLIENT)
+
+        for channel_id in (2, 3):
+            encoded_handshake = _create_request_header(path='/echo')
+            add_channel_request = _create_add_channel_request_frame(
+                channel_id=channel_id, encoding=0,
+                encoded_handshake=encoded_handshake)
+            request.connection.put_bytes(add_channel_request)
+
+        request.connection.put_bytes(
+            _create_logical_frame(channel_id=1, message='Goodbye'))
+        request.connection.put_bytes(
+            _create_logical_frame(channel_id=2, message='Goodbye'))
+
+        self.assertTrue(mux_handler.wait_until_done(timeout=2))
+        mux_options.worker_pool.shutdown()
+
+        self.assertTrue(2 in dispatcher.channel_events)
+        self.assertFalse(3 in dispatcher.channel_events)
+        responses = [block for block in
+                     request.connection.get_written_control_blocks()
+                     if block.opcode == mux._MUX_OPCODE_ADD_CHANNEL_RESPONSE
+                     and block.channel_id == 3]
+        self.assertEqual(1, len(responses))
+        self.assertTrue(
+            responses[0].encoded_handshake.startswith('HTTP/1.1 503 '))
+        self.assertEqual(channel_count, mux.get_logical_channel_count())
+
     def test_add_channel_duplicate_channel_id(self):
         request = _create_mock_request()
         dispatcher = _MuxMockDispatcher()
@@ -1016,6 +1386,112 @@ class MuxHandlerTest(unittest.TestCase):
         self.assertEqual(common.STATUS_INTERNAL_ENDPOINT_ERROR,
                          request.connection.server_close_code)
 
+    def test_logical_channel_table_copy_on_write(self):
+        class _BlockingDispatcher(object):
+            """Runs each handler until its channel is to be removed."""
+
+            def __init__(self):
+                self.remove_events = {}
+
+            def transfer_data(self, request):
+                self.remove_events[request.channel_id].wait()
+
+        class _MockLogicalStream(object):
+            def consume_receive_quota(self, size):
+                return True
+
+        dispatcher = _BlockingDispatcher()
+        mux_handler = mux._MuxHandler(_create_mock_request(), dispatcher)
+
+        def add_channel(channel_id):
+            connection = mux._LogicalConnection(mux_handler, channel_id)
+            logical_request = mux._LogicalRequest(
+                channel_id, 'GET', '/echo', 'HTTP/1.1', {}, connection)
+            logical_request.ws_stream = _MockLogicalStream()
+            # Don't send DropChannel. The writer thread isn't running.
+            logical_request.server_terminated = True
+            dispatcher.remove_events[channel_id] = threading.Event()
+            self.assertTrue(mux_handler._reserve_logical_channel())
+            mux_handler._add_logical_channel(logical_request)
+            return logical_request
+
+        def remove_channel(logical_request):
+            channel_data = mux_handler._logical_channels[
+                logical_request.channel_id]
+            dispatcher.remove_events[logical_request.channel_id].set()
+            # The worker removes the channel before it exits.
+            channel_data.worker.join()
+
+        def create_frame(channel_id):
+            return (mux._encode_channel_id(channel_id) +
+                    chr(0x80 | common.OPCODE_TEXT) + 'x')
+
+        errors = []
+        lookups = [0]
+        stop_event = threading.Event()
+
+        def look_up_channels():
+            try:
+                while not stop_event.isSet():
+                    logical_channels = mux_handler._logical_channels
+                    # Channels are added in ascending order of channel id
+                    # and the oldest one is removed first, so a complete
+                    # table always holds a range of channel ids.
+                    channel_ids = sorted(logical_channels.keys())
+                    if channel_ids and channel_ids != range(
+                        channel_ids[0], channel_ids[-1] + 1):
+                        errors.append('Inconsistent table: %r' % channel_ids)
+                    # Iterating the table raises RuntimeError if it's
+                    # updated in place.
+                    for channel_id, channel_data in (
+                        logical_channels.iteritems()):
+                        if channel_data.request.channel_id != channel_id:
+                            errors.append('Wrong channel for %d' % channel_id)
+                        mux_handler.dispatch_message(create_frame(channel_id))
+                        # Frames for channels removed meanwhile are dropped.
+                        if channel_id - 8 >= 2:
+                            mux_handler.dispatch_message(
+                                create_frame(channel_id - 8))
+                    lookups[0] += 1
+            except Exception, e:
+                errors.append(e)
+
+        lookup_thread = threading.Thread(target=look_up_channels)
+        lookup_thread.start()
+
+        open_requests = []
+        removed_requests = []
+        for channel_id in range(2, 2 + 200):
+            open_requests.append(add_channel(channel_id))
+            if len(open_requests) > 8:
+                logical_request = open_requests.pop(0)
+                remove_channel(logical_request)
+                removed_requests.append(logical_request)
+            if channel_id % 50 == 0:
+                # Let the lookup thread see the table.
+                time.sleep(0.01)
+
+        stop_event.set()
+        lookup_thread.join(10)
+        self.assertFalse(lookup_thread.isAlive())
+        self.assertEqual([], errors)
+        self.assertTrue(lookups[0] > 0)
+        self.assertTrue(sum([len(request.connection._incoming_frames)
+                             for request in removed_requests]) > 0)
+
+        for logical_request in open_requests:
+            remove_channel(logical_request)
+        removed_requests.extend(open_requests)
+        self.assertEqual({}, mux_handler._logical_channels)
+
+        # Removed channels don't receive frames any more.
+        for logical_request in removed_requests:
+            num_frames = len(logical_request.connection._incoming_frames)
+            mux_handler.dispatch_message(
+                create_frame(logical_request.channel_id))
+            self.assertEqual(
+                num_frames, len(logical_request.connection._incoming_frames))
+
     def test_receive_drop_channel(self):
         request = _create_mock_request()
         dispatcher = _MuxMockDispatcher()
@@ -1508,10 +1984,10 @@ class MuxHandlerTest(unittest.TestCase):
         received_flow_controls = [
             b for b in request.connection.get_written_control_blocks()
             if b.opcode == mux._MUX_OPCODE_FLOW_CONTROL and b.channel_id == 2]
-        # Replenishment for 'HelloWorld' + 1
-        self.assertEqual(11, received_flow_controls[0].send_quota)
-        # Replenishment for 'Goodbye' + 1
-        self.assertEqual(8, received_flow_controls[1].send_quota)
+        # Replenishment for 'HelloWorld' + 1 and 'Goodbye' + 1. They may
+        # be merged into one FlowControl.
+        self.assertEqual(11 + 8, sum([block.send_quota for block in
+                                      received_flow_controls]))
 
     def test_no_send_quota_on_server(self):
         request = _create_mock_request()
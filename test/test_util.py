@@ -36,7 +36,10 @@
 import os
 import random
 import sys
+import threading
+import time
 import unittest
+import zlib
 
 import set_sys_path  # Update sys.path to locate mod_pywebsocket module.
 
@@ -146,6 +149,136 @@ def get_random_section(source, min_num_chunks):
     return chunks
 
 
+class WorkerPoolTest(unittest.TestCase):
+    """A unittest for WorkerPool class."""
+
+    def test_run(self):
+        pool = util.WorkerPool(2)
+        try:
+            self.assertEqual(5, pool.run(lambda a, b: a + b, 2, 3))
+            jobs = [pool.submit(lambda x: x * x, i) for i in xrange(10)]
+            self.assertEqual([i * i for i in xrange(10)],
+                             [job.result() for job in jobs])
+        finally:
+            pool.shutdown()
+
+    def test_run_raises(self):
+        pool = util.WorkerPool(1)
+        try:
+            self.assertRaises(ZeroDivisionError, pool.run, lambda: 1 / 0)
+        finally:
+            pool.shutdown()
+
+    def test_try_submit(self):
+        pool = util.WorkerPool(1, max_queued_jobs=1)
+        try:
+            started = threading.Event()
+            release = threading.Event()
+
+            def block():
+                started.set()
+                release.wait()
+
+            running_job = pool.try_submit(block)
+            started.wait()
+            queued_job = pool.try_submit(lambda: 1)
+            self.assertEqual(None, pool.try_submit(lambda: 2))
+            self.assertEqual(1, pool.get_active_count())
+            self.assertEqual(1, pool.get_queued_count())
+            self.assertEqual(1, pool.get_rejected_count())
+
+            release.set()
+            running_job.result()
+            self.assertEqual(1, queued_job.result())
+        finally:
+            pool.shutdown()
+        self.assertEqual(0, pool.get_active_count())
+
+    def test_shutdown_without_wait(self):
+        pool = util.WorkerPool(1, max_queued_jobs=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        running_job = pool.try_submit(block)
+        started.wait()
+        queued_job = pool.try_submit(lambda: 1)
+        # Doesn't block although the queue is full.
+        pool.shutdown(wait=False)
+
+        release.set()
+        running_job.result()
+        self.assertEqual(1, queued_job.result())
+
+    def test_invalid_num_threads(self):
+        self.assertRaises(ValueError, util.WorkerPool, 0)
+        self.assertRaises(ValueError, util.WorkerPool, 1, max_queued_jobs=-1)
+
+
+class RFC1979DeflaterWorkerPoolTest(unittest.TestCase):
+    """A unittest for _RFC1979Deflater and _RFC1979Inflater running on
+    WorkerPool.
+    """
+
+    def test_offloaded_output_equals_inline_output(self):
+        pool = util.WorkerPool(2)
+        try:
+            offloaded_deflater = util._RFC1979Deflater(
+                15, False, worker_pool=pool, offload_threshold=10)
+            inline_deflater = util._RFC1979Deflater(15, False)
+            inflater = util._RFC1979Inflater(
+                worker_pool=pool, offload_threshold=10)
+
+            for message in ['Hello', 'World' * 1000, 'Hello' * 3000, 'a']:
+                compressed = offloaded_deflater.filter(message)
+                self.assertEqual(inline_deflater.filter(message), compressed)
+                self.assertEqual(message, inflater.filter(compressed))
+        finally:
+            pool.shutdown()
+
+    def test_filter_time_excludes_wait(self):
+        pool = util.WorkerPool(1)
+        try:
+            started = threading.Event()
+            released = threading.Event()
+
+            def block():
+                started.set()
+                released.wait()
+
+            # Hold the only thread of the pool for 0.2 seconds.
+            pool.submit(block)
+            started.wait()
+            timer = threading.Timer(0.2, released.set)
+            timer.start()
+
+            deflater = util._RFC1979Deflater(
+                15, False, worker_pool=pool, offload_threshold=0)
+            start_time = time.time()
+            deflater.filter('Hello')
+            self.assertTrue(time.time() - start_time >= 0.2)
+            self.assertTrue(deflater.get_filter_time() < 0.2)
+            timer.join()
+        finally:
+            pool.shutdown()
+
+
+class RFC1979InflaterTest(unittest.TestCase):
+    """A unittest for _RFC1979Inflater class."""
+
+    def test_filter_with_max_size(self):
+        compressed = util._RFC1979Deflater(15, False).filter('a' * 100000)
+
+        inflater = util._RFC1979Inflater()
+        self.assertEqual('a' * 100000, inflater.filter(compressed, 100000))
+
+        inflater = util._RFC1979Inflater()
+        self.assertEqual('a' * 1001, inflater.filter(compressed, 1000))
+
+
 class InflaterDeflaterTest(unittest.TestCase):
     """A unittest for _Inflater and _Deflater class."""
 
@@ -166,6 +299,16 @@ class InflaterDeflaterTest(unittest.TestCase):
         self.assertEqual(input, inflater15.decompress(-1))
         self.assertEqual(input, inflater8.decompress(-1))
 
+    def test_deflate_level_and_mem_level(self):
+        input = ''.join([chr(i % 7 + ord('a')) for i in xrange(10000)])
+        for level, mem_level in [(0, 1), (1, 9), (9, 8)]:
+            deflater = util._Deflater(15, level, mem_level)
+            compress = zlib.compressobj(
+                level, zlib.DEFLATED, -15, mem_level)
+            expected = compress.compress(input)
+            expected += compress.flush(zlib.Z_FINISH)
+            self.assertEqual(expected, deflater.compress_and_finish(input))
+
     def test_random_section(self):
         random.seed(a=0)
         source = ''.join(